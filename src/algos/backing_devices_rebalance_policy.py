@@ -1,5 +1,6 @@
 import logging
 from utils.aux import parse_user_list
+from utils.cpu_set import CPUSet
 from utils.vhost import Vhost
 
 __author__ = 'eyalmo'
@@ -73,13 +74,12 @@ class BackingDevicesPreConfiguredBalancePolicy:
         # logging.info("\x1b[37mmoving backing devices to the correct cpu "
         #              "cores\x1b[39m")
         for bd in self.backing_devices.values():
-            cpu_mask = 0
-            for c in backing_devices_conf[bd.id]:
-                cpu_mask += (1 << cpu_mapping[c])
-            # logging.info("\x1b[37mbacking device %s: %x\x1b[39m" %
-            #              (bd.id, cpu_mask))
+            cpu_set = CPUSet(cpu_mapping[c]
+                             for c in backing_devices_conf[bd.id])
+            # logging.info("\x1b[37mbacking device %s: %s\x1b[39m" %
+            #              (bd.id, cpu_set))
             bd.zero_cpu_mask()
-            bd.merge_cpu_mask(cpu_mask)
+            bd.merge_cpu_mask(cpu_set)
             bd.apply_cpu_mask()
 
 
@@ -94,11 +94,16 @@ class BackingDevicesPolicy:
         self.balance(io_workers)
 
     def _disable_shared_workers(self):
+        vms = {dev.id: vm for vm in self.vm_manager.vms
+               for dev in vm.devices}
         for bd in self.backing_devices.values():
             bd.zero_cpu_mask()
-            for dev in bd.devices:
-                for t in dev.vm.vcpus:
-                    bd.merge_cpu_mask(t.cpu_mask)
+            for dev_id in bd.devices:
+                vm = vms[dev_id]
+                # the cores of the vCPUs, or of the whole VM when its vCPU
+                # threads are not known
+                for t in vm.vcpus or [vm]:
+                    bd.merge_cpu_mask(t.cpu_set)
             bd.apply_cpu_mask()
 
     def balance(self, io_workers):
@@ -2,6 +2,8 @@ import logging
 import pprint
 
 from utils.vhost import Vhost
+from utils.k_partiotion import partition, partition_loads
+from algos.move_cost_model import MoveCostModel
 from algos.vq_classifier import LOW_USAGE
 
 __author__ = 'eyalmo'
@@ -35,6 +37,8 @@ class IOCoresPreConfiguredBalancePolicy:
             {len(conf["vhost_workers"]): conf["id"]
              for conf in balancer_info["configurations"]}
 
+        self.move_cost_model = MoveCostModel()
+
         # logging.info("workers_configurations: %s" %
         #              (self.workers_configurations,))
         # logging.info("\x1b[37mconfiguration_mapping:\x1b[39m \n%s" %
@@ -54,23 +58,60 @@ class IOCoresPreConfiguredBalancePolicy:
         devices_conf = self.devices_configurations[conf_id]
 
         # logging.info("devices_conf: %s" % (devices_conf,))
-        worker_mapping = {worker_conf: workers[worker.id]
-                          for worker_conf, worker in zip(workers_conf,
-                                                         io_workers)}
+        worker_mapping = {
+            worker_conf: workers[worker_id]
+            for worker_conf, worker_id in
+            self._map_workers(workers_conf, devices_conf, io_workers).items()}
 
         balance_changes = {}
         # move devices to the correct workers
 
         for dev_id, dev in devices.items():
             dev_conf = devices_conf[dev_id]
-            if dev["worker"] == worker_mapping[dev_conf]:
+            if dev["worker"] == worker_mapping[dev_conf]["id"]:
                 continue
             balance_changes[dev_id] = (workers[dev["worker"]],
                                        worker_mapping[dev_conf])
 
         # logging.info(balance_changes)
+        self.move_cost_model.log(balance_changes)
         return balance_changes
 
+    def _map_workers(self, workers_conf, devices_conf, io_workers):
+        """
+        Any one to one mapping of the configuration workers to the io workers
+        gives the same balance, the mapping keeps in place the devices whose
+        moves cost the most: pairs are taken by the cost of the devices they
+        keep in place, highest first.
+        :return: a dictionary of configuration worker -> io worker id
+        """
+        self.move_cost_model.update()
+        devices = Vhost.INSTANCE.devices
+        io_worker_ids = [w.id for w in io_workers][:len(workers_conf)]
+
+        # (configuration worker, io worker) -> the cost of the devices kept
+        kept = {}
+        for dev_id, dev in devices.items():
+            pair = (devices_conf[dev_id], dev["worker"])
+            kept[pair] = kept.get(pair, 0) + \
+                self.move_cost_model.cost(dev_id)
+
+        mapping = {}
+        used = set()
+        for (worker_conf, worker_id), _ in \
+                sorted(kept.items(), key=lambda x: -x[1]):
+            if worker_conf in mapping or worker_id in used or \
+                    worker_id not in io_worker_ids:
+                continue
+            mapping[worker_conf] = worker_id
+            used.add(worker_id)
+
+        free = [w_id for w_id in io_worker_ids if w_id not in used]
+        for worker_conf in workers_conf:
+            if worker_conf not in mapping:
+                mapping[worker_conf] = free.pop(0)
+        return mapping
+
     def balance_after_addition(self, io_workers, new_worker_ids):
         """
         Re-balance the system after adding a new io worker thread
@@ -98,7 +139,7 @@ class IOCoresPreConfiguredBalancePolicy:
         return self._balance(remaining_workers)
 
     @staticmethod
-    def balance():
+    def balance(io_workers):
         return {}
 
 
@@ -176,7 +217,7 @@ class BalanceByDeviceNumberPolicy:
         return balance_changes
 
     @staticmethod
-    def balance():
+    def balance(io_workers):
         return {}
 
 
@@ -324,9 +365,177 @@ class BalanceByGroupingPolicy:
             self._balance_inactive_devices(remaining_workers))
 
     @staticmethod
-    def balance():
+    def balance(io_workers):
         return {}
 
+
+class BalanceByLoadPolicy:
+    """
+    Balances the devices between the io workers by their load: the cycles
+    the device queues spent in polling and in notifications, smoothed over
+    the epochs (the handled bytes when no cycles were counted).
+
+    The devices that have no io worker (the devices of a removed worker, or
+    all the devices when moving to shared workers) are placed heaviest first
+    on the least loaded worker, then a local search of moves and swaps lowers
+    the load of the most loaded worker until it is within the target
+    imbalance. The search prefers the moves that buy the most balance per
+    cost by the learned move costs of the devices, so a rebalance moves few,
+    cheap devices.
+
+    With the VM accounting, the load of the devices of a VM above its fair
+    share of the IO cores is scaled by its share relative to the fair share,
+    so the devices of the noisy VMs get workers of their own and the other
+    VMs share the rest.
+    """
+    def __init__(self, balancer_info, accounting=None):
+        # rebalance when the most loaded worker is above the average by more
+        # than this ratio
+        self.imbalance_threshold = \
+            float(balancer_info.get("imbalance_threshold", 0.2))
+        # the weight of the last epoch in the device loads
+        self.smoothing = float(balancer_info.get("smoothing", 0.5))
+        # the maximum number of moves and swaps in a rebalance
+        self.max_rounds = int(balancer_info.get("max_rounds", 64))
+        # the maximum number of devices moved in a rebalance, the devices
+        # of a removed worker are not counted
+        self.max_moves = int(balancer_info["max_moves"]) \
+            if "max_moves" in balancer_info else None
+        # a rebalance stops when the most loaded worker is above the average
+        # by at most this ratio
+        self.target_imbalance = \
+            float(balancer_info.get("target_imbalance",
+                                    self.imbalance_threshold / 2))
+
+        # the VMAccounting of the VMs, None to balance the loads as is
+        self.accounting = accounting
+
+        # device id -> load
+        self.loads = {}
+        self.move_cost_model = MoveCostModel(self.smoothing)
+
+    def update_loads(self):
+        light = Vhost.INSTANCE.vhost_light
+        poll_cycles = light.queue_totals_by_device("poll_cycles")
+        notif_cycles = light.queue_totals_by_device("notif_cycles")
+        loads = {dev_id: poll_cycles.get(dev_id, 0) +
+                 notif_cycles.get(dev_id, 0)
+                 for dev_id in Vhost.INSTANCE.devices.keys()}
+        if not any(loads.values()):
+            handled_bytes = light.queue_totals_by_device("handled_bytes")
+            loads = {dev_id: handled_bytes.get(dev_id, 0)
+                     for dev_id in loads.keys()}
+
+        self.loads = {
+            dev_id: float(load) if dev_id not in self.loads else
+            self.smoothing * load + (1 - self.smoothing) * self.loads[dev_id]
+            for dev_id, load in loads.items()}
+
+    def _fairness_scales(self, io_cores):
+        """
+        :param io_cores: the number of IO cores the VMs share
+        :return: a dictionary of device id -> the scale of its load, only
+        for the devices of the VMs above their fair share
+        """
+        if self.accounting is None:
+            return {}
+        self.accounting.update_fair_shares(io_cores)
+        scales = {account.vm.idx: account.fairness
+                  for account in self.accounting.noisy_vms()
+                  if account.fair_share > 0}
+        return {dev_id: scales[vm_id]
+                for dev_id, vm_id in self.accounting.vm_of.items()
+                if vm_id in scales}
+
+    def _device_loads(self, io_cores):
+        if not self.loads:
+            self.update_loads()
+        scales = self._fairness_scales(io_cores)
+        # logging.info("fairness scales: %s" % (scales,))
+        # every device weighs at least 1, so idle devices are spread evenly
+        return {dev_id: self.loads.get(dev_id, 0) * scales.get(dev_id, 1) + 1
+                for dev_id in Vhost.INSTANCE.devices.keys()}
+
+    def _balance(self, worker_ids):
+        """
+        :param worker_ids: the ids of the io workers the devices are divided
+        between
+        :return: the balance changes
+        """
+        devices = Vhost.INSTANCE.devices
+        workers = Vhost.INSTANCE.workers
+        items = self._device_loads(len(worker_ids))
+        current = {dev_id: dev["worker"] for dev_id, dev in devices.items()}
+
+        self.move_cost_model.update()
+        assignment = partition(
+            items, worker_ids, current, max_moves=self.max_moves,
+            max_rounds=self.max_rounds,
+            costs=self.move_cost_model.device_costs(items.keys()),
+            target_imbalance=self.target_imbalance)
+
+        balance_changes = {}
+        for dev_id, worker_id in assignment.items():
+            if current[dev_id] == worker_id:
+                continue
+            balance_changes[dev_id] = (workers[current[dev_id]],
+                                       workers[worker_id])
+        self.move_cost_model.log(balance_changes)
+        return balance_changes
+
+    def imbalance(self, worker_ids):
+        """
+        :return: the ratio between the load of the most loaded io worker and
+        the average load, minus 1
+        """
+        devices = Vhost.INSTANCE.devices
+        items = self._device_loads(len(worker_ids))
+        loads = partition_loads(
+            items,
+            {dev_id: dev["worker"] for dev_id, dev in devices.items()
+             if dev["worker"] in worker_ids},
+            worker_ids)
+        average = float(sum(loads.values())) / len(worker_ids)
+        return max(loads.values()) / average - 1 if average > 0 else 0.0
+
+    def balance_after_addition(self, io_workers, new_worker_ids):
+        """
+        Re-balance the system after adding a new io worker thread
+        :param io_workers: The existing IO worker thread, including the newly
+        added thread
+        :param new_worker_ids: The newly added workers thread id
+        """
+        logging.info("\x1b[37mbalance_after_addition:\x1b[39m worker_ids %s" %
+                     (new_worker_ids,))
+        return self._balance([w.id for w in io_workers])
+
+    def balance_before_removal(self, io_workers, worker_id):
+        """
+        Re-balance the system after removing an io worker thread
+        :param io_workers: The existing IO worker thread, including the io
+        thread for removal
+        :param worker_id: The worker thread id for removal
+        """
+        logging.info("\x1b[37mbalance_before_removal:\x1b[39m worker_id %s" %
+                     (worker_id,))
+        return self._balance([w.id for w in io_workers if w.id != worker_id])
+
+    def balance(self, io_workers):
+        """
+        Re-balance the io workers when their load is imbalanced
+        :param io_workers: The existing IO worker threads
+        """
+        self.update_loads()
+        # without shared workers every device has a worker of its own
+        if len(io_workers) < 2:
+            return {}
+        worker_ids = [w.id for w in io_workers]
+        imbalance = self.imbalance(worker_ids)
+        if imbalance <= self.imbalance_threshold:
+            return {}
+        logging.info("imbalance: %.3f" % (imbalance,))
+        return self._balance(worker_ids)
+
 # TODO: add a balancer that balances each device type individually
 # TODO: add a balancer that balances by trying to give a throughput device that
 # needs more processing time
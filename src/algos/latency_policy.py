@@ -2,72 +2,211 @@
 import logging
 
 from utils.vhost import Vhost
+from algos.vq_classifier import LATENCY
+
+# the service delay a latency sensitive queue may have, in cycles
+DEFAULT_CYCLE_BUDGET = 1 << 17
 
 
 class LatencyPolicy:
+    """
+    Estimates the service delay of every latency sensitive virtual queue
+    from the kernel counters since the last update:
+    - the time a polled queue had pending items (poll_pending_cycles) and the
+      time a notified queue waited for its worker (notif_wait), per work
+    - the time a queue was stuck without service (stuck_cycles), per stuck
+      event (stuck_times)
+    - the time the work waits behind the other pending works of its worker:
+      the pending works per loop (pending_works) times the cycles of a loop
+
+    A queue whose delay is over the cycle budget is violating. When the ratio
+    of violating queues is above add_ratio the policy asks for an IO core,
+    when only a few queues violate it asks to give their devices workers of
+    their own, when the worst delay is under remove_ratio of the budget it
+    allows removing an IO core, otherwise it vetoes the removal.
+    """
     def __init__(self, balancer_info):
-        pass
-        # self.cooling_off_period = 0
-        # self.epochs_last_action = 0
-        #
-        # # the ratio between the total work cycles available and the amount of
-        # # stuck cycles in latency sensitive queues.
-        # self.add_ratio = balancer_info["add_ratio"]  # 0.5
-        # # the ratio between the total work cycles available and the amount of
-        # # stuck cycles in latency sensitive queues.
-        # self.remove_ratio = balancer_info["remove_ratio"]  # 0.01
-        #
-        # self.last_action = None
-
-    @staticmethod
-    def initialize():
-        pass
-        # for vq in Vhost.INSTANCE.queues.values():
-        #     vq["stuck_cycles_last_epoch"] = vq["stuck_cycles"]
+        # the service delay a latency sensitive queue may have, in cycles
+        self.cycle_budget = \
+            float(balancer_info.get("cycle_budget", DEFAULT_CYCLE_BUDGET))
+        # the ratio of latency sensitive queues over the budget that requires
+        # another IO core
+        self.add_ratio = float(balancer_info.get("add_ratio", 0.5))
+        # the ratio of the budget the worst delay must be under to allow
+        # removing an IO core
+        self.remove_ratio = float(balancer_info.get("remove_ratio", 0.5))
+        # the classifications of the latency sensitive queues
+        self.classifications = \
+            set(balancer_info.get("classifications", [LATENCY]))
+
+        # element id -> the counters at the last update
+        self.last = {}
+        # virtual queue id -> the estimated service delay, in cycles
+        self.delays = {}
+        self.last_action = "stay"
+
+    def initialize(self):
+        self.last = {}
+        self.delays = {}
+        self.update_delays()
+
+    def _deltas(self, store, elem_id, fields):
+        """
+        :return: the change of the counters of an element since the last
+        update, None on the first update of the element
+        """
+        current = tuple(store.get(elem_id, f) for f in fields)
+        last = self.last.get(elem_id)
+        self.last[elem_id] = current
+        if last is None:
+            return None
+        return tuple(c - l for c, l in zip(current, last))
+
+    def _worker_queueing_delays(self):
+        """
+        :return: a dictionary of worker id -> the cycles a work waits behind
+        the other pending works of the worker
+        """
+        stats = Vhost.INSTANCE.vhost_light.worker_stats
+        delays = {}
+        for w_id in stats.ids:
+            deltas = self._deltas(stats, w_id,
+                                  ("pending_works", "loops", "cycles"))
+            if deltas is None:
+                continue
+            pending_works, loops, cycles = deltas
+            if loops <= 0:
+                continue
+            delays[w_id] = \
+                float(pending_works) / loops * (float(cycles) / loops)
+        return delays
+
+    def update_delays(self):
+        """
+        Estimates the service delay of the latency sensitive queues.
+        :return: a dictionary of virtual queue id -> delay in cycles
+        """
+        vhost = Vhost.INSTANCE
+        stats = vhost.vhost_light.queue_stats
+        worker_delays = self._worker_queueing_delays()
+
+        delays = {}
+        for vq_id in stats.ids:
+            vq = vhost.queues.get(vq_id)
+            if vq is None:
+                continue
+            deltas = self._deltas(stats, vq_id,
+                                  ("poll_pending_cycles", "poll_kicks",
+                                   "notif_wait", "notif_works",
+                                   "stuck_cycles", "stuck_times"))
+            if deltas is None or \
+                    vq.get("classification") not in self.classifications:
+                continue
+            pending_cycles, polls, notif_wait, notif_works, \
+                stuck_cycles, stuck_times = deltas
+
+            works = polls + notif_works
+            wait = float(pending_cycles + notif_wait) / works \
+                if works > 0 else 0.0
+            stuck = float(stuck_cycles) / stuck_times \
+                if stuck_times > 0 else 0.0
+
+            dev = vhost.devices.get(vq["dev"])
+            queueing = worker_delays.get(dev["worker"], 0.0) \
+                if dev is not None else 0.0
+            delays[vq_id] = max(wait, stuck) + queueing
+        self.delays = delays
+        return delays
+
+    def violations(self):
+        """
+        :return: the ids of the latency sensitive queues over the budget
+        """
+        return [vq_id for vq_id, delay in self.delays.items()
+                if delay > self.cycle_budget]
 
     def update_io_core_number(self, shared_workers):
-        return "stay"
-
-        # vhost = Vhost.INSTANCE
-        #
-        # if self.epochs_last_action < self.cooling_off_period:
-        #     self.epochs_last_action += 1
-        #
-        #     for vq in vhost.queues.values():
-        #         vq["stuck_cycles_last_epoch"] = vq["stuck_cycles"]
-        #     return "stay"
-        #
-        # total_latency_sensitive_stuck_cycles = 0
-        # latency_sensitive_queues = 0
-        # for vq in vhost.queues.values():
-        #     if vq["poll"] == 1 and vq["classification"] == "latency":
-        #         poll_stuck_cycles_delta = vq["stuck_cycles"] - \
-        #             vq["stuck_cycles_last_epoch"]
-        #         total_latency_sensitive_stuck_cycles += poll_stuck_cycles_delta
-        #         latency_sensitive_queues += 1
-        #
-        # # check if we need to change the number of I/O cores in the system
-        # # calculate the number of stuck cycles per workers with devices
-        # # (consider them as one queue)
-        #
-        # cycles_this_epoch = vhost.vhost["cycles_this_epoch"]
-        # if latency_sensitive_queues > 0:
-        #     latency_ratio = total_latency_sensitive_stuck_cycles / \
-        #         float(cycles_this_epoch) / latency_sensitive_queues
-        # else:
-        #     return "stay"
-        #
-        # logging.info("total_latency_sensitive_stuck_cycles: %d" %
-        #              (total_latency_sensitive_stuck_cycles, ))
-        # logging.info("latency_sensitive_queues: %d" %
-        #              (latency_sensitive_queues, ))
-        # logging.info("cycles_this_epoch: %d" % (cycles_this_epoch, ))
-        # logging.info("qos_ratio: %d" % (latency_ratio, ))
-        #
-        # if latency_ratio > self.add_ratio:
-        #     return "add"
-        #
-        # if latency_ratio < self.remove_ratio:
-        #     return "remove"
-        #
-        # return "stay"
\ No newline at end of file
+        """
+        :return: "add" to ask for another IO core, "dedicate" to give the
+        violating devices workers of their own (see dedicate), "remove" to
+        allow removing an IO core and "stay" to veto a removal
+        """
+        if not shared_workers:
+            return "stay"
+
+        delays = self.update_delays()
+        if not delays:
+            self.last_action = "remove"
+            return "remove"
+
+        violations = self.violations()
+        violation_ratio = float(len(violations)) / len(delays)
+        worst = max(delays.values())
+        # logging.info("latency: %d/%d queues over the budget, worst: %.0f" %
+        #              (len(violations), len(delays), worst))
+
+        if violations and violation_ratio >= self.add_ratio:
+            action = "add"
+        elif violations:
+            action = "dedicate"
+        elif worst < self.remove_ratio * self.cycle_budget:
+            action = "remove"
+        else:
+            action = "stay"
+
+        if action != self.last_action:
+            logging.info("latency policy: %s, %d/%d queues over %.0f "
+                         "cycles, worst: %.0f" %
+                         (action, len(violations), len(delays),
+                          self.cycle_budget, worst))
+        self.last_action = action
+        return action
+
+    def dedicate(self, io_workers):
+        """
+        Gives the worst violating device of every IO worker the worker of its
+        own: the other devices of that worker move to the IO workers without
+        violating devices, the ones with the fewest devices first.
+        :param io_workers: the IO workers
+        :return: balance changes: a dictionary of device id -> (old worker,
+        new worker)
+        """
+        vhost = Vhost.INSTANCE
+        worker_ids = set(w.id for w in io_workers)
+
+        # worker id -> (the worst delay, the device with that delay)
+        dedicated = {}
+        for vq_id in self.violations():
+            dev = vhost.devices.get(vhost.queues[vq_id]["dev"])
+            if dev is None or dev["worker"] not in worker_ids:
+                continue
+            worst = dedicated.get(dev["worker"])
+            if worst is None or self.delays[vq_id] > worst[0]:
+                dedicated[dev["worker"]] = (self.delays[vq_id], dev["id"])
+
+        free = worker_ids - set(dedicated.keys())
+        if not dedicated or not free:
+            return {}
+
+        devices_count = {w_id: 0 for w_id in free}
+        moved = []
+        for dev in vhost.devices.values():
+            if dev["worker"] in devices_count:
+                devices_count[dev["worker"]] += 1
+            elif dev["worker"] in dedicated and \
+                    dedicated[dev["worker"]][1] != dev["id"]:
+                moved.append(dev)
+
+        balance_changes = {}
+        for dev in sorted(moved, key=lambda d: d["id"]):
+            target = min(free, key=lambda w_id: (devices_count[w_id], w_id))
+            devices_count[target] += 1
+            balance_changes[dev["id"]] = (vhost.workers[dev["worker"]],
+                                          vhost.workers[target])
+        if balance_changes:
+            logging.info("latency policy: dedicating workers %s to devices "
+                         "%s, moving %d devices" %
+                         (sorted(dedicated.keys()),
+                          sorted(d for _, d in dedicated.values()),
+                          len(balance_changes)))
+        return balance_changes
@@ -0,0 +1,76 @@
+import logging
+
+from utils.vhost import Vhost
+
+__author__ = 'eyalmo'
+
+# the cost of a move when no device was ever moved, every move costs the same
+DEFAULT_MOVE_COST = 1.0
+
+
+class MoveCostModel:
+    """
+    Learns the cost of moving every device between vhost workers from the
+    kernel device counters: device_move_total (the cycles spent in moves)
+    and device_move_count. The cost of a device is the smoothed cycles per
+    move of its recent moves, a device that was never moved costs the
+    average of the devices that were.
+    """
+    def __init__(self, smoothing=0.5):
+        """
+        :param smoothing: the weight of the moves since the last update in
+        the cost
+        """
+        self.smoothing = smoothing
+        # device id -> cycles per move
+        self.costs = {}
+        # device id -> (device_move_total, device_move_count) at the last
+        # update
+        self.last = {}
+
+    def update(self):
+        stats = Vhost.INSTANCE.vhost_light.device_stats
+        for dev_id in stats.ids:
+            total = stats.get(dev_id, "device_move_total")
+            count = stats.get(dev_id, "device_move_count")
+            last_total, last_count = self.last.get(dev_id, (0, 0))
+            self.last[dev_id] = (total, count)
+            if count <= last_count:
+                continue
+
+            cost = float(total - last_total) / (count - last_count)
+            if dev_id in self.costs:
+                cost = self.smoothing * cost + \
+                    (1 - self.smoothing) * self.costs[dev_id]
+            self.costs[dev_id] = cost
+
+    def average(self):
+        if not self.costs:
+            return DEFAULT_MOVE_COST
+        return sum(self.costs.values()) / len(self.costs)
+
+    def cost(self, dev_id):
+        return self.costs.get(dev_id, self.average())
+
+    def device_costs(self, dev_ids):
+        """
+        :return: a dictionary of device id -> the cost of moving it
+        """
+        average = self.average()
+        return {dev_id: self.costs.get(dev_id, average) for dev_id in dev_ids}
+
+    def change_set_cost(self, balance_changes):
+        """
+        :return: the estimated cost of moving the devices of balance changes,
+        in cycles (in moves until a move was observed)
+        """
+        average = self.average()
+        return sum(self.costs.get(dev_id, average)
+                   for dev_id in balance_changes.keys())
+
+    def log(self, balance_changes):
+        if not balance_changes:
+            return
+        logging.info("change set: %d devices, estimated cost: %.0f" %
+                     (len(balance_changes),
+                      self.change_set_cost(balance_changes)))
@@ -3,6 +3,7 @@ import logging
 from utils.aux import parse_user_list
 from utils.cpuusage import CPUUsage
 from utils.vhost import Vhost
+from utils.topology import Topology
 
 __author__ = 'eyalmo'
 
@@ -37,6 +38,11 @@ class PreconfiguredAddPolicy:
                           (self.cpus, number))
         return [self.cpus.pop() for _ in xrange(number)]
 
+    def remove_cpus(self, cpu_ids):
+        for cpu_id in cpu_ids:
+            self.cpus.remove(int(cpu_id))
+        return list(cpu_ids)
+
 
 class LastAddedPolicy:
     @staticmethod
@@ -53,9 +59,21 @@ class LastAddedPolicy:
         return LastAddedPolicy(initial_cpus)
 
     @staticmethod
-    def create_io_cores_policy(workers_info):
+    def create_io_cores_policy(workers_info, io_nodes=None):
+        """
+        :param workers_info: the workers configuration
+        :param io_nodes: the NUMA nodes of the NICs, the IO cores on these
+        nodes are the last to be removed
+        """
         initial_cpus = list(set([int(w["cpu"]) for w in workers_info]))
-        initial_cpus = sorted(initial_cpus, cmp=lambda x, y: x <= y)
+        initial_cpus = sorted(initial_cpus, key=lambda x: -x)
+        if io_nodes:
+            topology = Topology.INSTANCE
+            # stable sort, the cpus off the NIC nodes go to the end and are
+            # popped first
+            initial_cpus = sorted(initial_cpus,
+                                  key=lambda x: topology.node_of(x)
+                                  not in io_nodes)
         logging.info("io cores initial cpus: %s" % (initial_cpus,))
         return LastAddedPolicy(initial_cpus)
 
@@ -72,6 +90,11 @@ class LastAddedPolicy:
                           (self.cpus, number))
         return [self.cpus.pop() for _ in xrange(number)]
 
+    def remove_cpus(self, cpu_ids):
+        for cpu_id in cpu_ids:
+            self.cpus.remove(int(cpu_id))
+        return list(cpu_ids)
+
 
 class MinCPUUsagePolicy:
     def __init__(self, initial_cpus=()):
@@ -90,6 +113,128 @@ class MinCPUUsagePolicy:
         self.cpus = set(sorted_cpus[number:])
         return removed_cpus
 
+    def remove_cpus(self, cpu_ids):
+        for cpu_id in cpu_ids:
+            self.cpus.remove(int(cpu_id))
+        return list(cpu_ids)
+
+
+class ScoredRemovalPolicy:
+    """
+    Removes the cpus that are the cheapest to remove by a score:
+    - the projected usage of the cpu, the work that has to move elsewhere
+    - how good an IO core the cpu is: its network softirq load, minus its
+      NUMA distance to the nodes of the NICs, minus the load of the vCPUs on
+      its SMT siblings
+
+    A policy of VM cores removes the cores that are the cheapest to take from
+    the VMs and the best IO cores, a policy of IO cores removes the cheapest
+    IO cores to give back, which are the worst IO cores. Ties remove the last
+    added cpu first, the same as LastAddedPolicy.
+    """
+    VM_CORES = "vm"
+    IO_CORES = "io"
+
+    @staticmethod
+    def create_vm_policy(vms_info, io_nodes=None, policy_info=None):
+        initial_cpus = set()
+        for vm in vms_info:
+            initial_cpus.update(parse_user_list(vm["cpu"]))
+        initial_cpus = sorted(initial_cpus, key=lambda x: -x)
+        logging.info("vm initial cpus: %s" % (initial_cpus,))
+        return ScoredRemovalPolicy(initial_cpus, ScoredRemovalPolicy.VM_CORES,
+                                   io_nodes, policy_info)
+
+    @staticmethod
+    def create_io_cores_policy(workers_info, io_nodes=None, policy_info=None):
+        initial_cpus = sorted(set([int(w["cpu"]) for w in workers_info]),
+                              key=lambda x: -x)
+        logging.info("io cores initial cpus: %s" % (initial_cpus,))
+        return ScoredRemovalPolicy(initial_cpus, ScoredRemovalPolicy.IO_CORES,
+                                   io_nodes, policy_info)
+
+    def __init__(self, initial_cpus, kind, io_nodes=None, policy_info=None):
+        """
+        :param initial_cpus: the cpus, in the order they were added
+        :param kind: VM_CORES or IO_CORES
+        :param io_nodes: the NUMA nodes of the NICs, None or empty if unknown
+        :param policy_info: the weights of the score terms
+        """
+        policy_info = policy_info or {}
+        self.cpus = list(initial_cpus)
+        self.kind = kind
+        self.io_nodes = io_nodes
+        self.usage_weight = float(policy_info.get("usage_weight", 1.0))
+        self.softirq_weight = float(policy_info.get("softirq_weight", 1.0))
+        self.numa_weight = float(policy_info.get("numa_weight", 1.0))
+        self.smt_weight = float(policy_info.get("smt_weight", 0.5))
+
+    def add(self, cpu_id):
+        self.cpus.append(int(cpu_id))
+
+    def _vcpu_siblings_load(self, cpu_id, chosen, usage):
+        """
+        :return: the load of the SMT siblings of the cpu that run vCPUs and
+        stay VM cores
+        """
+        load = 0.0
+        for sibling in Topology.INSTANCE.siblings_of(cpu_id):
+            is_vm_core = (sibling in self.cpus) == \
+                (self.kind == ScoredRemovalPolicy.VM_CORES)
+            if is_vm_core and sibling not in chosen:
+                load += usage.get(sibling, 0.0)
+        return load
+
+    def cost(self, cpu_id, chosen=()):
+        """
+        :param chosen: the cpus that are removed with this one
+        :return: the cost of removing the cpu, lower is removed first
+        """
+        cpu_usage = CPUUsage.INSTANCE
+        usage = cpu_usage.projected if cpu_usage is not None else {}
+        softirq = cpu_usage.get_net_softirq_cpu(cpu_id) \
+            if cpu_usage is not None else 0.0
+
+        io_fitness = \
+            self.softirq_weight * softirq - \
+            self.numa_weight * Topology.INSTANCE.distance_to_nodes(
+                cpu_id, self.io_nodes) - \
+            self.smt_weight * self._vcpu_siblings_load(cpu_id, chosen, usage)
+        if self.kind == ScoredRemovalPolicy.IO_CORES:
+            io_fitness = -io_fitness
+        return self.usage_weight * usage.get(cpu_id, 0.0) - io_fitness
+
+    def rank(self, number):
+        """
+        :return: the cheapest cpus to remove, in order of choice
+        """
+        remaining = list(enumerate(self.cpus))
+        chosen = []
+        for _ in xrange(min(number, len(remaining))):
+            best = min(remaining,
+                       key=lambda item: (self.cost(item[1], chosen),
+                                         -item[0]))
+            remaining.remove(best)
+            chosen.append(best[1])
+        return chosen
+
+    def remove(self, number=1):
+        if len(self.cpus) < number:
+            logging.error("ScoredRemovalPolicy: trying to remove more CPUs "
+                          "then available. has %s requested: %d" %
+                          (self.cpus, number))
+        chosen = self.rank(number)
+        logging.info("ScoredRemovalPolicy(%s): removing %s, costs: %s" %
+                     (self.kind, chosen,
+                      ", ".join("%d: %.2f" % (c, self.cost(c))
+                                for c in self.cpus)))
+        return self.remove_cpus(chosen)
+
+    def remove_cpus(self, cpu_ids):
+        for cpu_id in cpu_ids:
+            self.cpus.remove(int(cpu_id))
+        return list(cpu_ids)
+
 
 # class MinElementsServedPolicy:
 #     def __init__(self):
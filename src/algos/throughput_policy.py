@@ -1,15 +1,23 @@
 #!/usr/bin/python
 import logging
-import time
 
 import traceback
 from utils.vhost import Vhost
 from utils.cpuusage import CPUUsage
+from utils.get_cycles.get_cycles import Cycles
+from utils.sampler import Sampler
 from utils.aux import parse_user_list
-from utils.cpus import CPU
+from utils.stream_stats import StatsEngine
+
+# log the statistics of the policies every that many rounds
+HISTORY_PRINT_ROUNDS = 100
 
 
 class ThroughputRegretPolicy:
+    # moves that do not change the IO cores or the devices placement, so they
+    # are allowed while another move is evaluated
+    SAFE_MOVES = ("update_vq_classifications", "update_polling")
+
     def __init__(self, policy_info, backing_device_manager):
         self.backing_device_manager = backing_device_manager
         self.interval = float(policy_info["interval"])
@@ -39,6 +47,10 @@ class ThroughputRegretPolicy:
 
         self.good_move_margin = 0.01  # 0.05
 
+        # the move being evaluated, while it is pending only the safe moves
+        # are allowed
+        self.pending = None
+
     def initialize(self):
         pass
 
@@ -85,6 +97,10 @@ class ThroughputRegretPolicy:
             self.can_move_history[move] = 0
         self.can_move_history[move] += 1
 
+        if self.pending is not None and \
+                move not in ThroughputRegretPolicy.SAFE_MOVES:
+            return False
+
         if self.epoch < self.last_good_action + self.history_length * 1.5:
             return False
 
@@ -123,10 +139,19 @@ class ThroughputRegretPolicy:
         ratio = handled_bytes / float(cycles)
         return ratio, handled_bytes, cycles
 
-    def is_move_good(self, move):
-        vhost_inst = Vhost.INSTANCE.vhost_light  # Vhost.INSTANCE
-        logging.info("is_move_good %s", move)
-
+    def is_evaluating(self):
+        return self.pending is not None
+
+    def start_evaluation(self, move, on_revert, on_commit=None):
+        """
+        Starts evaluating a move that was just made. The evaluation is
+        advanced by advance_evaluation once per tick, and until it ends only
+        the safe moves are allowed.
+        :param move: the name of the move
+        :param on_revert: called to roll the move back if it turns out bad
+        :param on_commit: called if the move turns out good
+        """
+        logging.info("start evaluating %s", move)
         for rec in self.history:
             logging.info("")
             logging.info("epoch:        %d", rec[0])
@@ -134,36 +159,50 @@ class ThroughputRegretPolicy:
             logging.info("handled_bytes:%d", rec[2])
             logging.info("ratio_before: %.2f", rec[1])
             logging.info("throughput:   %.2fGbps", rec[1] * 2.2 * 8)
-        ratio_before = sum(rec[1] for rec in self.history) / len(self.history)
-
-        ratio_after_sum = 0
-        ratio_after = 0
-        for i in xrange(self.history_length + self.grace_period):
-            time.sleep(self.interval)
-            # refresh all counters
-            CPUUsage.INSTANCE.update()
-            vhost_inst.update()
-            self.backing_device_manager.update()
-
-            ratio, handled_bytes, cycles = \
-                ThroughputRegretPolicy._calc_cycles_to_bytes_ratio()
-
-            logging.info("")
-            logging.info("cycles:       %d", cycles)
-            logging.info("handled_bytes:%d", handled_bytes)
-            logging.info("ratio_after: %.2f", ratio)
-            logging.info("throughput:   %.2fGbps", ratio * 2.2 * 8)
-            logging.info("ratio_after [%d]:%.2f", i, ratio)
-
-            if i < self.grace_period:
-                continue
-
-            ratio_after_sum += ratio
-            ratio_after = ratio_after_sum / (i - self.grace_period + 1)
-
-            # if ratio_before > ratio_after * 1.3:
-            #     break
+        ratio_before = sum(rec[1] for rec in self.history) / \
+            len(self.history) if self.history else 0.0
+
+        self.pending = PendingEvaluation(move, ratio_before,
+                                         self.history_length,
+                                         self.grace_period,
+                                         on_revert=on_revert,
+                                         on_commit=on_commit)
+
+    def advance_evaluation(self):
+        """
+        Advances the pending evaluation by one tick, must be called after the
+        counters were refreshed. When the evaluation window closes the move is
+        either committed or rolled back.
+        :return: None if there is no evaluation or it is still pending, True
+        if the move was committed and False if it was rolled back
+        """
+        pending = self.pending
+        if pending is None:
+            return None
+
+        ratio, handled_bytes, cycles = \
+            ThroughputRegretPolicy._calc_cycles_to_bytes_ratio()
+        logging.info("")
+        logging.info("cycles:       %d", cycles)
+        logging.info("handled_bytes:%d", handled_bytes)
+        logging.info("ratio_after: %.2f", ratio)
+        logging.info("throughput:   %.2fGbps", ratio * 2.2 * 8)
+        logging.info("ratio_after [%d]:%.2f", pending.ticks, ratio)
+        if not pending.advance(ratio):
+            return None
+
+        self.pending = None
+        good = self._judge_move(pending.move, pending.ratio_before,
+                                pending.ratio_after)
+        if good:
+            if pending.on_commit is not None:
+                pending.on_commit()
+        else:
+            logging.info("roll back %s", pending.move)
+            pending.on_revert()
+        return good
 
+    def _judge_move(self, move, ratio_before, ratio_after):
         logging.info("")
         logging.info("ratio_before :%.2f", ratio_before)
         logging.info("ratio_after  :%.2f", ratio_after)
@@ -202,10 +241,42 @@ class ThroughputRegretPolicy:
                      self.failed_moves_history[move]["last_failed_move_epoch"])
         logging.info("regret_penalty:    %d",
                      self.failed_moves_history[move]["regret_penalty"])
-        # timer.done()
         return False
 
 
+class PendingEvaluation:
+    """
+    A move waiting for its evaluation window to close: the ratio of handled
+    bytes to cycles is ignored for grace_period ticks and then averaged over
+    history_length ticks.
+    """
+    def __init__(self, move, ratio_before, history_length, grace_period,
+                 on_revert, on_commit=None):
+        self.move = move
+        self.ratio_before = ratio_before
+        self.history_length = history_length
+        self.grace_period = grace_period
+        self.on_revert = on_revert
+        self.on_commit = on_commit
+
+        self.ticks = 0
+        self.ratio_after_sum = 0.0
+        self.ratio_after = 0.0
+
+    def advance(self, ratio):
+        """
+        :param ratio: the ratio of this tick
+        :return: True if the evaluation window closed
+        """
+        i = self.ticks
+        self.ticks += 1
+        if i >= self.grace_period:
+            self.ratio_after_sum += ratio
+            self.ratio_after = self.ratio_after_sum / \
+                (i - self.grace_period + 1)
+        return self.ticks >= self.history_length + self.grace_period
+
+
 class AdditionPolicy:
     def __init__(self, policy_info):
         # The ratio of total empty cycles to cycles this epoch
@@ -246,6 +317,8 @@ class IOWorkerThroughputPolicy(AdditionPolicy):
 
         self.average_bytes_per_packet = None
         self.ratio = None
+        # the empty cycles ratio at the saturation bursts of the epoch
+        self.burst_ratio = None
         self.overall_io_ratio = None
         self.io_cores = None
         self.shared_workers = False
@@ -253,17 +326,16 @@ class IOWorkerThroughputPolicy(AdditionPolicy):
         self.throughput = None
 
         self.history_rounds = 0
-        self.history = {
-            "average_bytes_per_packet": [0, 0, 0],
-            "empty_ratio": [0, 0, 0],
-            # "overall_io_ratio": [0, 0, 0],
-            # "effective_io_ratio": [0, 0, 0]
-            "throughput": [0, 0, 0]
-        }
+        # the fields kept in the statistics engine
+        self.history = ("average_bytes_per_packet", "empty_ratio",
+                        # "overall_io_ratio", "effective_io_ratio",
+                        "throughput")
         self.negative_ratio_rounds = 0
-        self._init_history()
 
         self.borrowed_ratio = 0
+        # IO core -> the ratio of the core spent in network softirqs
+        self.softirq_ratios = {}
+        self.softirq_ratio = 0.0
 
     def initialize(self):
         pass
@@ -275,8 +347,15 @@ class IOWorkerThroughputPolicy(AdditionPolicy):
         logging.info("\x1b[37maverage bytes per packet is %d.\x1b[39m" %
                      (self.average_bytes_per_packet,))
         logging.info("\x1b[37mempty ratio is %.2f.\x1b[39m" % (self.ratio,))
+        if self.burst_ratio is not None:
+            logging.info("\x1b[37mburst empty ratio is %.2f.\x1b[39m" %
+                         (self.burst_ratio,))
         logging.info("\x1b[37meffective io ratio is %.2f.\x1b[39m" %
                      (self.effective_io_ratio,))
+        logging.info("\x1b[37msoftirq ratio is %.2f (%s).\x1b[39m" %
+                     (self.softirq_ratio,
+                      ", ".join("cpu %d: %.2f" % (cpu, r) for cpu, r in
+                                sorted(self.softirq_ratios.items()))))
 
         logging.info("----------------")
         for c in sorted(vhost_inst.per_worker_counters.values(),
@@ -295,46 +374,62 @@ class IOWorkerThroughputPolicy(AdditionPolicy):
         logging.info("efficient io ratio: %.2f" %
                      (self.effective_io_ratio / self.overall_io_ratio,))
 
-    def _init_history(self):
-        self.history_rounds = 0
-        self.negative_ratio_rounds = 0
-        self.history = {key: [0, 0, 0] for key in self.history.keys()}
+    @staticmethod
+    def history_key(field):
+        """
+        :return: the statistics engine key of a field of the policy
+        """
+        return "io_throughput", field
 
     def print_history(self):
-        if self.history_rounds == 0:
-            logging.info("\x1b[37mno history recorded.\x1b[39m")
-            return
-
         logging.info("----------------")
-        logging.info("\x1b[37mio cores  %d.\x1b[39m" % (self.io_cores,))
-        for key, (sum_ratio, min_ratio, max_ratio) in self.history.items():
-            logging.info("\x1b[37m %25s: avg: %3.2f, min: %3.2f, "
-                         "max: %3.2f, negative: %d.\x1b[39m" %
-                         (key, sum_ratio / self.history_rounds, min_ratio,
-                          max_ratio, self.negative_ratio_rounds))
+        logging.info("\x1b[37mio cores  %d, negative: %d.\x1b[39m" %
+                     (self.io_cores, self.negative_ratio_rounds))
+        for field in self.history:
+            StatsEngine.INSTANCE.log(self.history_key(field), field)
 
     def update_history(self):
         self.history_rounds += 1
 
-        def update(field, new_val):
-            if self.history_rounds == 1:
-                self.history[field][0] = self.history[field][1] = \
-                    self.history[field][2] = new_val
-                return
-
-            self.history[field][0] += new_val
-            self.history[field][1] = min(new_val, self.history[field][1])
-            self.history[field][2] = max(new_val, self.history[field][2])
-
-        update("average_bytes_per_packet", self.average_bytes_per_packet)
-        update("empty_ratio", self.ratio)
-        # update("overall_io_ratio", self.overall_io_ratio)
-        # update("effective_io_ratio", self.effective_io_ratio)
-        update("throughput", self.throughput)
-
-        if self.history_rounds == 100:
+        stats = StatsEngine.INSTANCE
+        stats.add(self.history_key("average_bytes_per_packet"),
+                  self.average_bytes_per_packet)
+        stats.add(self.history_key("empty_ratio"), self.ratio)
+        # stats.add(self.history_key("overall_io_ratio"),
+        #           self.overall_io_ratio)
+        # stats.add(self.history_key("effective_io_ratio"),
+        #           self.effective_io_ratio)
+        stats.add(self.history_key("throughput"), self.throughput)
+
+        if self.history_rounds == HISTORY_PRINT_ROUNDS:
             self.print_history()
-            self._init_history()
+            self.history_rounds = 0
+            self.negative_ratio_rounds = 0
+
+    def _softirq_ratio(self, workers, cycles_this_epoch):
+        """
+        The network softirq work on the IO cores, in cores. The softirq time
+        of a core is the larger of the network share of its /proc/stat
+        softirq time and the ksoftirq_time of its worker, both count the
+        same softirqs when they run in the worker context.
+        :param cycles_this_epoch: the epoch length in TSC cycles
+        :return: the sum of the softirq ratios of the IO cores
+        """
+        self.softirq_ratios = {}
+        if not cycles_this_epoch:
+            return 0.0
+        worker_stats = Vhost.INSTANCE.vhost_light.worker_stats
+        cpu_usage = CPUUsage.INSTANCE
+        # ksoftirq_time is in ns
+        cycles_per_ns = float(Cycles.cycles_per_second) / 10 ** 9
+        for w_id, w in workers.items():
+            ksoftirq_ratio = \
+                worker_stats.delta(w_id, "ksoftirq_time") * cycles_per_ns / \
+                cycles_this_epoch if w_id in worker_stats else 0.0
+            self.softirq_ratios[w["cpu"]] = \
+                min(max(cpu_usage.get_net_softirq_cpu(w["cpu"]),
+                        ksoftirq_ratio), 1.0)
+        return sum(self.softirq_ratios.values())
 
     def calculate_load(self, shared_workers):
         # timer = Timer("Timer IOWorkerThroughputPolicy.calculate_load")
@@ -373,7 +468,8 @@ class IOWorkerThroughputPolicy(AdditionPolicy):
         # logging.info("ratio_before: %.2f", ratio_before)
         # logging.info("throughput:   %.2fGbps", ratio_before * 2.2 * 8)
 
-        softirq_cpu_ratio = 0
+        softirq_cpu_ratio = self.softirq_ratio = \
+            self._softirq_ratio(workers, cycles_this_epoch)
         # the idle cycles ratio in the iocores not including the ksoftirq
         # activity (which is a useful work). 1 means a full core was wasted.
         self.ratio = float(empty_cycles) / float(cycles_this_epoch) - \
@@ -383,6 +479,15 @@ class IOWorkerThroughputPolicy(AdditionPolicy):
             self.borrowed_ratio = -self.ratio
             self.ratio = 0
 
+        # saturation bursts shorter than the interval, seen by the sampler
+        self.burst_ratio = None
+        sampler = Sampler.INSTANCE
+        if sampler is not None and shared_workers:
+            work = sampler.consume("work_ratio")
+            if work.count:
+                self.burst_ratio = max(len(workers) - work.p95, 0.0)
+                self.ratio = min(self.ratio, self.burst_ratio)
+
         # this the ratio of cycles used to handle virtual IO.
         self.effective_io_ratio = \
             float(vhost_inst.work_cycles.delta) / \
@@ -541,55 +646,36 @@ class VMCoreAdditionPolicy(AdditionPolicy):
 
         self.ratio = 0.0
 
-        self.history_rounds = None
-        self.history = None
-        self._init_history()
-
-    def _init_history(self):
         self.history_rounds = 0
-        self.history = {cpu: [0, 0, 0] for cpu in self.cpus}
 
     def print_history(self):
-        if self.history_rounds == 0:
-            logging.info("\x1b[37mno history recorded.\x1b[39m")
-            return
-
+        # the per cpu usage is kept by CPUUsage in the statistics engine, the
+        # empty cycles ratio is its complement
         logging.info("----------------")
-        for cpu, empty_cpu_ratio in self.history.items():
-            min_ratio, max_ratio, sum_ratio = empty_cpu_ratio
-            logging.info("\x1b[37mvm cores [%2d] empty cycles ratio: "
-                         "avg: %3.2f, min: %3.2f, max: %3.2f.\x1b[39m" %
-                         (cpu, sum_ratio / self.history_rounds, min_ratio,
-                          max_ratio))
+        for cpu in sorted(self.cpus):
+            for window in StatsEngine.INSTANCE.windows(
+                    CPUUsage.usage_key(cpu)):
+                if not window.count:
+                    continue
+                logging.info("\x1b[37mvm cores [%2d] [%gs] empty cycles "
+                             "ratio: avg: %3.2f, min: %3.2f, p5: %3.2f, "
+                             "max: %3.2f.\x1b[39m" %
+                             (cpu, window.length, 1 - window.mean,
+                              1 - window.max, 1 - window.percentile(95),
+                              1 - window.min))
 
     def update_history(self):
         self.history_rounds += 1
-        for cpu, empty_cpu_ratio in self.history.items():
-            ratio = CPUUsage.INSTANCE.get_empty_cpu((cpu,))
-            if self.history_rounds == 1:
-                empty_cpu_ratio[0] = empty_cpu_ratio[1] = \
-                    empty_cpu_ratio[2] = ratio
-                continue
-
-            # min ratio
-            empty_cpu_ratio[0] = min(empty_cpu_ratio[0], ratio)
-            # max ratio
-            empty_cpu_ratio[1] = max(empty_cpu_ratio[1], ratio)
-            # sum ratio
-            empty_cpu_ratio[2] += ratio
-
-        if self.history_rounds == 100:
+        if self.history_rounds == HISTORY_PRINT_ROUNDS:
             self.print_history()
-            self._init_history()
+            self.history_rounds = 0
 
     def add(self, cpu_id):
         self.cpus.append(int(cpu_id))
-        self._init_history()
 
     def remove(self, cpu_ids):
         for cpu_id in cpu_ids:
             self.cpus.remove(int(cpu_id))
-        self._init_history()
 
     def print_load(self):
         logging.info("----------------")
@@ -1,6 +1,7 @@
 import logging
 import pprint
 from utils.aux import parse_user_list, Timer
+from utils.cpu_set import CPUSet
 
 __author__ = 'eyalmo'
 
@@ -60,13 +61,11 @@ class VmsPreConfiguredBalancePolicy:
             # new_cpu_sequence = [cpu_mapping[c] for c in vms_conf[vm.idx]]
             # logging.info("\x1b[37mvm %s: %s\x1b[39m" % (vm.idx,
             #                                             new_cpu_sequence))
-            cpu_mask = 0
-            for c in vms_conf[vm.idx]:
-                cpu_mask += (1 << cpu_mapping[c])
-            if cpu_mask == vm.cpu_mask:
+            cpu_set = CPUSet(cpu_mapping[c] for c in vms_conf[vm.idx])
+            if cpu_set == vm.cpu_set:
                 continue
             # timer.checkpoint("vm %s before set_cpu_mask" % (vm.idx,))
-            vm.set_cpu_mask(cpu_mask)
+            vm.set_cpu_mask(cpu_set)
             # timer.checkpoint("vm %s after set_cpu_mask" % (vm.idx,))
         # timer.done()
 
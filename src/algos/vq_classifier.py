@@ -1,6 +1,9 @@
 #!/usr/bin/python
 import logging
+from itertools import izip
+
 from utils.vhost import vhost_write, Vhost
+from utils.counter_store import CounterStore
 
 LATENCY = "latency"
 THROUGHPUT = "throughput"
@@ -8,57 +11,184 @@ LOW_USAGE = "low_usage"
 HIGH_USAGE = "high_usage"
 
 
+# a device takes the class of its queue that ranks first
+CLASS_RANK = (LATENCY, THROUGHPUT, HIGH_USAGE, LOW_USAGE)
+
+# the virtual queue counters the classification is based on
+CLASSIFIER_FIELDS = ("notif_bytes", "poll_bytes", "poll_limited",
+                     "stuck_times", "handled_bytes", "handled_packets",
+                     "ring_full")
+
+
 class VirtualQueueClassifier:
+    """
+    Classifies every virtual queue by the change of its counters since the
+    last update:
+    - THROUGHPUT: the queue hit its processing limits (poll_limited) or its
+      ring was full (ring_full) at least throughput_threshold times
+    - LATENCY: the queue was stuck without service (stuck_times) at least
+      latency_threshold times, or, when latency_max_bytes_per_packet is
+      configured, it is active with small packets (handled_bytes /
+      handled_packets) and was stuck at least once. Small packets alone are
+      not enough: the TX queue of a bulk receiver carries small ACKs.
+    - LOW_USAGE: less than active_threshold bytes passed through the queue
+    - HIGH_USAGE: any other active queue
+
+    A queue keeps its class while its counters are above exit_ratio of the
+    thresholds of the class, and moves to another class only after it was
+    a candidate for that class in hysteresis consecutive updates. A device
+    takes the class of its highest ranked queue (see CLASS_RANK). The
+    classes are exported in the "classification" entry of every queue and
+    device, and in queue_classes and device_classes.
+    """
     def __init__(self, classifier_info):
         # the amount of bytes that has to pass through the queue to be
         # considered active
-        self.active_threshold = classifier_info["active_threshold"]  # 1 << 20
+        self.active_threshold = \
+            int(classifier_info["active_threshold"])  # 1 << 20
+        # the number of times a queue needs to be stuck during an epoch to be
+        # considered latency sensitive
+        self.latency_threshold = \
+            int(classifier_info.get("latency_threshold", 10))
+        # the number of times a queue needs to be limited during an epoch to be
+        # considered throughput oriented
+        self.throughput_threshold = \
+            int(classifier_info.get("throughput_threshold", 10))
+        # an active queue with at most that many bytes per packet that was
+        # stuck is considered latency sensitive, 0 disables
+        self.latency_max_bytes_per_packet = \
+            int(classifier_info.get("latency_max_bytes_per_packet", 0))
+        # the number of consecutive updates a queue must be a candidate for
+        # a class before it is classified as such
+        self.hysteresis = int(classifier_info.get("hysteresis", 3))
+        # the ratio of the thresholds a queue must stay above to keep its
+        # class
+        self.exit_ratio = float(classifier_info.get("exit_ratio", 0.5))
+
+        self.stats = CounterStore(CLASSIFIER_FIELDS)
+        # virtual queue id -> (candidate class, consecutive updates)
+        self.candidates = {}
+        # virtual queue id -> class
+        self.queue_classes = {}
+        # device id -> class
+        self.device_classes = {}
 
-    @staticmethod
-    def initialize():
+    def initialize(self):
         queues = Vhost.INSTANCE.queues
         devices = Vhost.INSTANCE.devices
 
         for vq in queues.values():
-            vq["bytes_total"] = 0
             vq["classification"] = LOW_USAGE
         for dev in devices.values():
             dev["classification"] = LOW_USAGE
+        self.candidates = {}
+        self.queue_classes = {vq_id: LOW_USAGE for vq_id in queues.keys()}
+        self.device_classes = {d_id: LOW_USAGE for d_id in devices.keys()}
+        self._load()
+
+    def _load(self):
+        """
+        Loads the classifier counters from the vhost queue stats.
+        """
+        queue_stats = Vhost.INSTANCE.vhost_light.queue_stats
+        self.stats.load_columns(
+            queue_stats.ids,
+            [queue_stats.column(f) for f in CLASSIFIER_FIELDS])
+
+    def _candidate(self, current, total_bytes, limited, stuck, handled_bytes,
+                   handled_packets):
+        """
+        :return: the class the counters of a queue point at
+        """
+        def above(value, threshold, cls):
+            if current == cls:
+                threshold *= self.exit_ratio
+            return value >= threshold
+
+        if above(limited, self.throughput_threshold, THROUGHPUT):
+            return THROUGHPUT
+        if above(stuck, self.latency_threshold, LATENCY):
+            return LATENCY
+        active = total_bytes >= self.active_threshold or \
+            (current != LOW_USAGE and
+             total_bytes >= self.active_threshold * self.exit_ratio)
+        if not active:
+            return LOW_USAGE
+        if stuck > 0 and handled_packets > 0 and \
+                handled_bytes <= self.latency_max_bytes_per_packet * \
+                handled_packets:
+            return LATENCY
+        return HIGH_USAGE
 
     def update_classifications(self, can_update):
+        """
+        :param can_update: False only advances the counters, the classes do
+        not change
+        """
+        self._load()
+        if not can_update:
+            return
+
+        stats = self.stats
+        deltas = [stats.deltas(f) for f in CLASSIFIER_FIELDS]
+        queue_classes = {}
+        for vq_id, notif_bytes, poll_bytes, poll_limited, stuck_times, \
+                handled_bytes, handled_packets, ring_full in \
+                izip(stats.ids, *deltas):
+            current = self.queue_classes.get(vq_id, LOW_USAGE)
+            candidate = self._candidate(current, notif_bytes + poll_bytes,
+                                        poll_limited + ring_full, stuck_times,
+                                        handled_bytes, handled_packets)
+            if candidate == current:
+                self.candidates.pop(vq_id, None)
+            else:
+                last, count = self.candidates.get(vq_id, (None, 0))
+                count = count + 1 if last == candidate else 1
+                if count >= self.hysteresis:
+                    # logging.info("vq=%s classified as %s" %
+                    #              (vq_id, candidate))
+                    self.candidates.pop(vq_id, None)
+                    current = candidate
+                else:
+                    self.candidates[vq_id] = (candidate, count)
+            queue_classes[vq_id] = current
+        self._export(queue_classes)
+
+    def _export(self, queue_classes):
         queues = Vhost.INSTANCE.queues
         devices = Vhost.INSTANCE.devices
 
-        possible_low_usage_devices = set()
-        for vq in queues.values():
-            bytes_total = vq["notif_bytes"] + vq["poll_bytes"]
-            bytes_total_last_epoch = vq["bytes_total_last_epoch"] = \
-                vq["bytes_total"]
-            vq["bytes_total"] = bytes_total
-
-            if not can_update:
+        device_ranks = {}
+        for vq_id, cls in queue_classes.items():
+            vq = queues.get(vq_id)
+            if vq is None:
                 continue
+            vq["classification"] = cls
+            rank = CLASS_RANK.index(cls)
+            dev_id = vq["dev"]
+            if rank < device_ranks.get(dev_id, len(CLASS_RANK)):
+                device_ranks[dev_id] = rank
 
-            delta = bytes_total - bytes_total_last_epoch
-            if (delta > self.active_threshold) and \
-                    (vq["classification"] == LOW_USAGE):
-                vq["classification"] = HIGH_USAGE
-                devices[vq["dev"]]["classification"] = HIGH_USAGE
-                continue
+        device_classes = {}
+        for dev_id, dev in devices.items():
+            cls = CLASS_RANK[device_ranks[dev_id]] \
+                if dev_id in device_ranks else LOW_USAGE
+            if cls != self.device_classes.get(dev_id):
+                logging.info("\x1b[37mdev=%s classified as %s.\x1b[39m" %
+                             (dev_id, cls))
+            dev["classification"] = device_classes[dev_id] = cls
 
-            if (delta < self.active_threshold) and \
-                    (vq["classification"] != LOW_USAGE):
-                vq["classification"] = LOW_USAGE
-                possible_low_usage_devices.add(vq["dev"])
-
-        # go over all the devices suspected as low usage and mark the ones that
-        # all their virtual queues are marked as low usage
-        for dev_id in possible_low_usage_devices:
-            dev = devices[dev_id]
-            for vq_id in dev["vq_list"]:
-                if queues[vq_id]["classification"] != LOW_USAGE:
-                    continue
-            dev["classification"] = LOW_USAGE
+        self.queue_classes = queue_classes
+        self.device_classes = device_classes
+        for vq_id in self.candidates.keys():
+            if vq_id not in queue_classes:
+                del self.candidates[vq_id]
+
+    def devices_by_class(self, cls):
+        """
+        :return: the ids of the devices of a class
+        """
+        return [d_id for d_id, c in self.device_classes.items() if c == cls]
 
 # class VirtualQueueClassifier:
 #     def __init__(self, classifier_info):
@@ -111,7 +111,10 @@ class IOManager:
             "latency_max_processed_data_limit": "65536",
             "work_list_max_stuck_cycles": "16384",
             "latency_min_processed_data_limit": "8192",
-            "max_stuck_cycles": "16384"
+            "max_stuck_cycles": "16384",
+            "latency_max_bytes_per_packet": "0",
+            "hysteresis": "3",
+            "exit_ratio": "0.5"
         }
         config["path"] = os.path.dirname(os.path.abspath(__file__))
         config["use_mover"] = False
@@ -8,14 +8,15 @@ import getopt
 
 from io_workers_manager import IOWorkersManager
 from backing_device_manager import BackingDeviceManager
-from poll_policy import NullPollPolicy
+from poll_policy import NullPollPolicy, AdaptivePollPolicy
 from vm_manager import VMManager
 
 from algos.backing_devices_rebalance_policy import \
     BackingDevicesPreConfiguredBalancePolicy, BackingDevicesPolicy
-from algos.io_cores_rebalance_policy import IOCoresPreConfiguredBalancePolicy
+from algos.io_cores_rebalance_policy import \
+    IOCoresPreConfiguredBalancePolicy, BalanceByLoadPolicy
 from algos.vms_rebalance_policy import VmsPreConfiguredBalancePolicy
-from algos.removal_policy import LastAddedPolicy
+from algos.removal_policy import LastAddedPolicy, ScoredRemovalPolicy
 from algos.throughput_policy import VMCoreAdditionPolicy, \
     IOWorkerThroughputPolicy, ThroughputRegretPolicy
 from algos.latency_policy import LatencyPolicy
@@ -24,10 +25,22 @@ from algos.vq_classifier import VirtualQueueClassifier
 from utils.cpuusage import CPUUsage
 from utils.vhost import Vhost
 from utils.aux import msg, Timer, LoggerWriter
+from utils.sched_affinity import sched_setaffinity
 from utils.daemon import Daemon
+from utils.tick_scheduler import TickScheduler
+from utils.stream_stats import StatsEngine
+from utils.phase_scheduler import PhaseScheduler
+from utils.worker_pool import WorkerPool
+from utils.sampler import Sampler, VhostProbe, DEFAULT_SAMPLE_INTERVAL, \
+    DEFAULT_RING_SIZE
 
 IO_MANAGER_PID = "/tmp/io_manager_pid.txt"
 IO_MANAGER_INTERVAL = 1.0
+# the fraction of the interval a tick may spend before skipping its
+# non-essential phases
+TICK_BUDGET = 0.8
+# log the tick statistics every that many ticks
+TICK_STATS_INTERVAL = 1000
 
 
 def usage(program_name, error):
@@ -52,13 +65,41 @@ def usage(program_name, error):
 
 class IOManagerDaemon(Daemon):
     def __init__(self, io_workers_manager, vm_manager, backing_device_manager,
-                 interval):
+                 interval, tick_budget=TICK_BUDGET, sampler_info=None,
+                 phases_info=None, stats_info=None):
         Daemon.__init__(self, IO_MANAGER_PID)
         self.vm_manager = vm_manager
         self.interval = interval
+        self.scheduler = TickScheduler(interval, budget_ratio=tick_budget,
+                                       stats_interval=TICK_STATS_INTERVAL)
+        self.sampler_info = sampler_info
+        self.phases_info = phases_info or {}
         self.io_workers_manager = io_workers_manager
         self.backing_device_manager = backing_device_manager
-        CPUUsage.initialize()
+        stats_info = stats_info or {}
+        StatsEngine.initialize(stats_info)
+        CPUUsage.initialize(
+            projected_window=stats_info.get("cpu_projection_window"))
+
+    def _sample(self):
+        # timer = Timer("Timer IOManager sample")
+        Vhost.INSTANCE.update()
+        # timer.checkpoint("Vhost.INSTANCE.update()")
+        CPUUsage.INSTANCE.update()
+        # timer.checkpoint("CPUUsage.INSTANCE.update()")
+        self.vm_manager.update()
+        # timer.checkpoint("self.vm_manager.update()")
+        # logging.info("cycles: %d" %
+        #              (Vhost.INSTANCE.vhost["cycles"], ))
+        # logging.info("cycles_last_epoch: %d" %
+        #              (Vhost.INSTANCE.vhost["cycles_last_epoch"], ))
+        # logging.info("cycles_this_epoch: %d" %
+        #              (Vhost.INSTANCE.vhost["cycles_this_epoch"], ))
+
+    def _update_io_core_number(self, tick):
+        updated = self.io_workers_manager.update_io_core_number(tick)
+        if updated:
+            logging.info("update in round %d" % (tick,))
 
     def run(self):
         # timer = Timer("Timer IOManager")
@@ -68,44 +109,41 @@ class IOManagerDaemon(Daemon):
         self.io_workers_manager.initialize()
         self.vm_manager.update()
 
-        i = 0  # i = li = 0
-        # lis = 20  # int(1.0 / self.interval) + 1
+        # the sampler thread is started here, after the daemon forked
+        if self.sampler_info is not None:
+            Sampler.initialize(
+                [VhostProbe(Vhost.INSTANCE.vhost_light)],
+                interval=float(self.sampler_info.get(
+                    "interval", DEFAULT_SAMPLE_INTERVAL)),
+                size=int(self.sampler_info.get("size", DEFAULT_RING_SIZE)))
+
+        # the counters are sampled once per tick and shared by the phases,
+        # a slower phase sees the deltas over its own period
+        phases = PhaseScheduler(self.scheduler, self._sample,
+                                counters=[Vhost.INSTANCE.vhost_light,
+                                          CPUUsage.INSTANCE])
+        phases.configure(self.phases_info, [
+            # (name, function, default priority, default skippable)
+            ("regret_evaluation",
+             lambda tick: self.io_workers_manager.update_regret_evaluation(),
+             0, False),
+            ("vq_classification",
+             lambda tick: self.io_workers_manager.update_vq_classifications(),
+             1, False),
+            ("io_core_number", self._update_io_core_number, 2, False),
+            ("balance",
+             lambda tick: self.io_workers_manager.update_balance(), 3, False),
+            # when the tick is late the non-essential phases are skipped
+            ("polling",
+             lambda tick: self.io_workers_manager.update_polling(), 4, True),
+            ("backing_devices",
+             lambda tick: self.backing_device_manager.update(), 5, True),
+            ("worker_pool",
+             lambda tick: self.io_workers_manager.fill_worker_pool(), 6, True)
+        ])
 
         while True:
-            time.sleep(self.interval)
-            # logging.info("round %d" % (i,))
-            # timer.checkpoint("round %d" % (i,))
-            Vhost.INSTANCE.update()
-            # timer.checkpoint("Vhost.INSTANCE.update()")
-            CPUUsage.INSTANCE.update()
-            # timer.checkpoint("CPUUsage.INSTANCE.update()")
-            self.vm_manager.update()
-            # timer.checkpoint("self.vm_manager.update()")
-            # logging.info("cycles: %d" %
-            #              (Vhost.INSTANCE.vhost["cycles"], ))
-            # logging.info("cycles_last_epoch: %d" %
-            #              (Vhost.INSTANCE.vhost["cycles_last_epoch"], ))
-            # logging.info("cycles_this_epoch: %d" %
-            #              (Vhost.INSTANCE.vhost["cycles_this_epoch"], ))
-
-            self.io_workers_manager.update_vq_classifications()
-            # timer.checkpoint("vq_classifier update_classification")
-            updated = self.io_workers_manager.update_io_core_number(i)
-            # timer.checkpoint("io_workers_manager update_io_core_number")
-            self.io_workers_manager.update_balance()
-            # timer.checkpoint("io_workers_manager update_balance")
-            self.io_workers_manager.update_polling()
-            # timer.checkpoint("io_workers_manager update_polling")
-            self.backing_device_manager.update()
-            # timer.checkpoint("backing_device_manager update")
-
-            if updated:
-                logging.info("update in round %d" % (i,))
-
-            i += 1
-            # if i - li > lis:
-            #     timer.done()
-            #     li = i
+            phases.run()
 
         logging.info("*****Done****")
 
@@ -173,7 +211,7 @@ def main(argv):
     logging.info("****** start of a new run: %s ******" % (timestamp,))
 
     # set the process affinity
-    os.system("taskset -cp {0} {1}".format("0", os.getpid()))
+    sched_setaffinity(0, 1 << 0)
 
     # set the interval in which the IO manager works
     interval = float(conf["interval"]) if "interval" in conf \
@@ -199,8 +237,20 @@ def main(argv):
     bdm = BackingDeviceManager(conf["backing_devices"],
                                backing_devices_policy)
 
+    # the NUMA nodes of the NICs, the IO cores are kept on them
+    io_nodes = set()
+    for bd in bdm.backing_devices.values():
+        io_nodes.update(bd.numa_nodes())
+    logging.info("NIC NUMA nodes: %s" % (sorted(io_nodes),))
+
     # start the vm manager
-    vm_policy = LastAddedPolicy.create_vm_policy(conf["vms"])
+    removal_info = conf.get("removal_policy", {})
+    if removal_info.get("id") == "scored":
+        vm_policy = ScoredRemovalPolicy.create_vm_policy(conf["vms"],
+                                                         io_nodes,
+                                                         removal_info)
+    else:
+        vm_policy = LastAddedPolicy.create_vm_policy(conf["vms"])
     vm_balance_policy = \
         VmsPreConfiguredBalancePolicy(conf["vms_balance_policy"],
                                       vm_policy.cpus)
@@ -209,24 +259,42 @@ def main(argv):
         VMCoreAdditionPolicy(conf["vms"], conf["vm_core_addition_policy"])
     vm_manager = VMManager(conf["vms"], bdm.backing_devices,
                            vm_policy, vm_core_addition_policy,
-                           vm_balance_policy)
+                           vm_balance_policy, io_nodes=io_nodes,
+                           fairness_info=conf.get("vm_fairness"))
     # get devices
     devices = [dev for vm in vm_manager.vms for dev in vm.devices]
 
     # set up manager policies
     vq_classifier = VirtualQueueClassifier(conf["virtual_queue_classifier"])
     # poll_policy = PollPolicy(conf["poll_policy"])
-    poll_policy = NullPollPolicy()
-    io_core_policy = LastAddedPolicy.create_io_cores_policy(conf["workers"])
-    io_core_balance_policy = \
-        IOCoresPreConfiguredBalancePolicy(conf["io_cores_balance_policy"],
-                                          devices)
+    if conf.get("poll_policy", {}).get("id") == "adaptive":
+        poll_policy = AdaptivePollPolicy(conf["poll_policy"])
+    else:
+        poll_policy = NullPollPolicy()
+    if removal_info.get("id") == "scored":
+        io_core_policy = \
+            ScoredRemovalPolicy.create_io_cores_policy(conf["workers"],
+                                                       io_nodes, removal_info)
+    else:
+        io_core_policy = \
+            LastAddedPolicy.create_io_cores_policy(conf["workers"], io_nodes)
+    balancer_info = conf["io_cores_balance_policy"]
+    if balancer_info["id"] == "load":
+        io_core_balance_policy = \
+            BalanceByLoadPolicy(balancer_info, vm_manager.accounting)
+    else:
+        io_core_balance_policy = \
+            IOCoresPreConfiguredBalancePolicy(balancer_info, devices)
     # io_core_balance_policy = BalanceByDeviceNumberPolicy()
     throughput_policy = IOWorkerThroughputPolicy(conf["throughput_policy"])
     latency_policy = LatencyPolicy(conf["latency_policy"])
     regret_policy = ThroughputRegretPolicy(conf["throughput_regret_policy"],
                                            bdm)
 
+    # parked workers for fast io core additions, filled by the worker_pool
+    # phase
+    worker_pool = WorkerPool(int(conf.get("worker_pool", {}).get("size", 0)))
+
     # setup the io core controller
     io_workers_manager = IOWorkersManager(devices, vm_manager, bdm,
                                           conf["workers"],
@@ -237,9 +305,16 @@ def main(argv):
                                           latency_policy,
                                           io_core_policy,
                                           io_core_balance_policy,
-                                          regret_policy)
-
-    daemon = IOManagerDaemon(io_workers_manager, vm_manager, bdm, interval)
+                                          regret_policy,
+                                          worker_pool=worker_pool)
+
+    tick_budget = float(conf["tick_budget"]) if "tick_budget" in conf \
+        else TICK_BUDGET
+    daemon = IOManagerDaemon(io_workers_manager, vm_manager, bdm, interval,
+                             tick_budget=tick_budget,
+                             sampler_info=conf.get("sampler"),
+                             phases_info=conf.get("phases"),
+                             stats_info=conf.get("stats"))
     if "daemon" in conf:
         if 'start' == conf["daemon"]:
             daemon.start()
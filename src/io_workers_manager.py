@@ -1,8 +1,11 @@
 import logging
 
-from utils.vhost import Vhost, vhost_write, vhost_read, \
-    vhost_worker_set_cpu_mask, get_cpu_usage
+from utils.vhost import Vhost, vhost_worker_create, \
+    vhost_worker_remove, vhost_worker_set_cpu_mask, get_cpu_usage
 from utils.io_worker import IOWorker
+from utils.cpu_set import CPUSet
+from utils.device_mover import DeviceMover
+from utils.worker_pool import WorkerPool
 from utils.aux import Timer
 
 __author__ = 'eyalmo'
@@ -12,7 +15,8 @@ class IOWorkersManager:
     def __init__(self, devices, vm_manager, backing_devices_manager,
                  io_workers_info, iocores_restrictions,
                  vq_classifier, poll_policy, throughput_policy, latency_policy,
-                 io_core_policy=None, balance_policy=None, regret_policy=None):
+                 io_core_policy=None, balance_policy=None, regret_policy=None,
+                 device_mover=None, worker_pool=None):
         self.io_workers = [IOWorker(w_info) for w_info in io_workers_info]
         self.backing_devices_manager = backing_devices_manager
 
@@ -24,6 +28,10 @@ class IOWorkersManager:
         self.io_core_policy = io_core_policy
         self.balance_policy = balance_policy
         self.regret_policy = regret_policy
+        self.device_mover = device_mover if device_mover is not None \
+            else DeviceMover()
+        self.worker_pool = worker_pool if worker_pool is not None \
+            else WorkerPool()
 
         self.min_iocores = iocores_restrictions["min"]
         self.max_iocores = iocores_restrictions["max"]
@@ -113,7 +121,12 @@ class IOWorkersManager:
             cpu_ids = self.vm_manager.remove_cores(number=suggested_io_cores)
             for cpu_id in cpu_ids:
                 self.io_core_policy.add(cpu_id)
-            self.enable_shared_workers(cpu_ids)
+            if not self.enable_shared_workers(cpu_ids):
+                # give the IO cores back to the VMs
+                self.io_core_policy.remove_cpus(cpu_ids)
+                for cpu_id in cpu_ids:
+                    self.vm_manager.add_core(cpu_id)
+                return False
             return True
             # if suggested_io_cores > 1 or \
             #         self.regret_policy.is_move_good("start_shared_worker"):
@@ -156,6 +169,14 @@ class IOWorkersManager:
         if self.throughput_policy.ratio > 1.3:
             remove_io_core = True
 
+        latency_action = \
+            self.latency_policy.update_io_core_number(shared_workers)
+        if latency_action == "add":
+            add_io_core = True
+        if latency_action != "remove":
+            # the latency sensitive queues are close to their budget
+            remove_io_core = batching_remove_io_core = False
+
         if self.min_iocores > len(self.io_workers):
             add_io_core = can_add_io_core = True
 
@@ -165,24 +186,41 @@ class IOWorkersManager:
         if self.max_iocores == len(self.io_workers):
             add_io_core = can_add_io_core = False
 
+        if add_io_core and latency_action != "add" and \
+                self.vm_manager.accounting.should_veto_addition(
+                    len(self.io_workers)):
+            # the IO cores are busy with VMs over their fair share
+            add_io_core = False
+
         if batching_remove_io_core and \
                 self.regret_policy.can_do_move("batching_remove_io_core"):
             self._remove_io_core()
-            if self.regret_policy.is_move_good("batching_remove_io_core"):
-                return True
-            self._add_io_core()
-            return False
+            self.regret_policy.start_evaluation("batching_remove_io_core",
+                                                self._add_io_core)
+            return True
 
         if add_io_core and can_add_io_core and \
                 self.regret_policy.can_do_move("add_io_core"):
             logging.info("round %d" % (iteration,))
             self.throughput_policy.print_load()
             self.vm_manager.vm_core_addition_policy.print_load()
+            self.vm_manager.accounting.log()
             self._add_io_core()
-            if self.regret_policy.is_move_good("add_io_core"):
+            self.regret_policy.start_evaluation("add_io_core",
+                                                self._remove_io_core)
+            return True
+
+        if latency_action == "dedicate" and \
+                self.regret_policy.can_do_move("dedicate_latency_devices"):
+            balance_changes = self.latency_policy.dedicate(self.io_workers)
+            if balance_changes:
+                logging.info("round %d" % (iteration,))
+                self.move_devices(balance_changes)
+                self.regret_policy.start_evaluation(
+                    "dedicate_latency_devices",
+                    lambda: self.move_devices(
+                        self._revert_balance_changes(balance_changes)))
                 return True
-            self._remove_io_core()
-            return False
 
         if not remove_io_core or not can_remove_io_core or \
                 not self.regret_policy.can_do_move("remove_io_core"):
@@ -193,23 +231,39 @@ class IOWorkersManager:
         self.throughput_policy.print_load()
         self.vm_manager.vm_core_addition_policy.print_load()
         self._remove_io_core()
-        if self.regret_policy.is_move_good("remove_io_core"):
-            return True
-        self._add_io_core()
-        return False
+        self.regret_policy.start_evaluation("remove_io_core",
+                                            self._add_io_core)
+        return True
 
     def update_balance(self):
         if not self.regret_policy.can_do_move("update_balance"):
             return False
 
-        balance_changes = self.balance_policy.balance()
+        balance_changes = self.balance_policy.balance(self.io_workers)
         if not balance_changes:
             return
         self.move_devices(balance_changes)
-        if not self.regret_policy.is_move_good("update_balance"):
-            revert_balance_changes = {}
-            for dev_id, (old_worker, new_worker) in balance_changes.items():
-                revert_balance_changes[dev_id] = (new_worker, old_worker)
+
+        revert_balance_changes = \
+            self._revert_balance_changes(balance_changes)
+        self.regret_policy.start_evaluation(
+            "update_balance",
+            lambda: self.move_devices(revert_balance_changes))
+        return True
+
+    @staticmethod
+    def _revert_balance_changes(balance_changes):
+        revert_balance_changes = {}
+        for dev_id, (old_worker, new_worker) in balance_changes.items():
+            revert_balance_changes[dev_id] = (new_worker, old_worker)
+        return revert_balance_changes
+
+    def update_regret_evaluation(self):
+        """
+        Advances the evaluation of the last move by one tick, the move is
+        committed or rolled back when its evaluation window closes.
+        """
+        return self.regret_policy.advance_evaluation()
 
     def update_polling(self):
         if not self.regret_policy.can_do_move("update_polling"):
@@ -222,33 +276,50 @@ class IOWorkersManager:
         self.vq_classifier.update_classifications(can_update)
 
     def move_devices(self, balance_changes, balance_backing_device=True):
+        """
+        :return: a dictionary of device id -> the reason of the failure, of
+        the devices that did not move (they keep their workers)
+        """
         # timer = Timer("Timer move_devices")
         # logging.info("\x1b[37mMoving devices:\x1b[39m")
         if not balance_changes:
             # logging.info("no balance changes")
-            return
+            return {}
+
+        vhost = Vhost.INSTANCE
+        moves = {dev_id: new_worker["id"]
+                 for dev_id, (_, new_worker) in balance_changes.items()}
+        failures = self.device_mover.move(moves, vhost.devices,
+                                          vhost.workers)
+        # timer.checkpoint("device_mover.move")
 
         for dev_id, (old_worker, new_worker) in balance_changes.items():
             # logging.info("\x1b[37mdev: %s from worker: %s to worker: %s"
             #              "\x1b[39m\n" %
             #              (dev_id, old_worker["id"], new_worker["id"]))
-            # timer.checkpoint("dev %s" % (dev_id,))
-            vhost_write(Vhost.INSTANCE.devices[dev_id], "worker",
-                        new_worker["id"])
-            # timer.checkpoint("dev %s vhost_write" % (dev_id,))
-            Vhost.INSTANCE.devices[dev_id]["worker"] = new_worker["id"]
+            if dev_id in failures:
+                continue
+            vhost.devices[dev_id]["worker"] = new_worker["id"]
 
             new_worker["dev_list"].append(dev_id)
             old_worker["dev_list"].remove(dev_id)
-            # timer.checkpoint("dev %s end" % (dev_id,))
 
         # timer.checkpoint("before backing_devices_manager.balance")
+        # the backing devices are balanced once for the whole batch
         if balance_backing_device:
             self.backing_devices_manager.balance(self.io_workers)
             self.backing_devices_manager.update()
         # timer.done()
+        return failures
 
     def enable_shared_workers(self, io_cores):
+        """
+        Moves all the devices to IO workers on the IO cores and removes the
+        other workers. If a device cannot move the switch is aborted: the
+        devices that moved are moved back, so no device is left on a worker
+        that is removed.
+        :return: True if the IO workers serve all the devices
+        """
         vhost = Vhost.INSTANCE
         worker_ids = \
             sorted(vhost.workers.keys(),
@@ -267,7 +338,11 @@ class IOWorkersManager:
         balance_changes = \
             self.balance_policy.balance_after_addition(self.io_workers,
                                                        worker_ids)
-        self.move_devices(balance_changes)
+        failures = self.move_devices(balance_changes,
+                                     balance_backing_device=False)
+        if failures:
+            self._abort_shared_workers(balance_changes, failures)
+            return False
 
         # notify poll policy that we moved to shared worker configuration
         logging.info("notify poll policy that we moved to shared worker "
@@ -284,28 +359,67 @@ class IOWorkersManager:
 
         self.backing_devices_manager.balance(self.io_workers)
         self.backing_devices_manager.update()
+        return True
+
+    def _abort_shared_workers(self, balance_changes, failures):
+        """
+        Moves the devices that moved to the IO workers back to their workers
+        and lets the IO workers run on all the cpus again.
+        """
+        vhost = Vhost.INSTANCE
+        logging.warning("\x1b[31mdevices %s did not move to the IO workers, "
+                        "keeping the dedicated workers.\x1b[39m" %
+                        (sorted(failures.keys()),))
+        moved = {dev_id: change for dev_id, change in balance_changes.items()
+                 if dev_id not in failures}
+        revert_failures = self.move_devices(
+            self._revert_balance_changes(moved), balance_backing_device=False)
+        if revert_failures:
+            # no worker is removed, so these devices are still served
+            logging.warning("\x1b[31mdevices %s stay on the IO workers."
+                            "\x1b[39m" % (sorted(revert_failures.keys()),))
+
+        online_mask = CPUSet.online().mask
+        for io_worker in self.io_workers:
+            vhost_worker_set_cpu_mask(vhost.workers[io_worker.id],
+                                      online_mask)
+        self.io_workers = []
 
     def disable_shared_workers(self):
         self.poll_policy.disable_shared_workers()
         self.io_workers = []
         vhost = Vhost.INSTANCE
         # create a worker for each device
+        online_mask = CPUSet.online().mask
+        moves = {}
         for dev in self.devices[1:]:
             worker_id = self._add_io_worker()
-            vhost_write(vhost.devices[dev.id], "worker", worker_id)
-            vhost_worker_set_cpu_mask(vhost.workers[worker_id], 0xFF)
+            moves[dev.id] = worker_id
+            vhost_worker_set_cpu_mask(vhost.workers[worker_id], online_mask)
+        failures = self.device_mover.move(moves, vhost.devices, vhost.workers)
+        for dev_id, worker_id in moves.items():
+            if dev_id not in failures:
+                vhost.devices[dev_id]["worker"] = worker_id
+                continue
+            # the device stays on its shared worker, which is no longer
+            # pinned to the IO core that was given back, and the worker
+            # created for it is not needed
+            vhost_worker_set_cpu_mask(
+                vhost.workers[vhost.devices[dev_id]["worker"]], online_mask)
+            self._remove_io_worker(vhost.workers[worker_id])
         vhost.vhost_light.update(rescan=True)
 
         self.backing_devices_manager.balance(self.io_workers)
         self.backing_devices_manager.update()
 
-    @staticmethod
-    def _add_io_worker(new_io_core=0):
-        # add a new worker to the I/O cores
+    def _add_io_worker(self, new_io_core=0):
+        # add a new worker to the I/O cores, a parked worker if there is one
+        new_worker_id = self.worker_pool.take(new_io_core)
+        if new_worker_id is not None:
+            return new_worker_id
         vhost = Vhost.INSTANCE
 
-        vhost_write(vhost.workersGlobal, "create", new_io_core)
-        new_worker_id = vhost_read(vhost.workersGlobal, "create").strip()
+        new_worker_id = vhost_worker_create(vhost, new_io_core)
         vhost.update_all_entries_with_id(new_worker_id)
         vhost.workers[new_worker_id]["cpu_usage_counter"] = \
             get_cpu_usage(vhost.workers[new_worker_id]["pid"])
@@ -318,17 +432,12 @@ class IOWorkersManager:
         vhost.vhost_light.update(rescan=True)
         return new_worker_id
 
-    @staticmethod
-    def _remove_io_worker(removed_worker):
+    def _remove_io_worker(self, removed_worker):
         # logging.info("removed_worker: %s" % (removed_worker["id"],))
         # remove the worker from the cores
         vhost = Vhost.INSTANCE
         workers = vhost.workers
 
-        # lock the worker
-        vhost_write(removed_worker, "locked", 1)
-        removed_worker["locked"] = 1
-
         # remove the worker from the workers dictionary
         # removed_worker_dev_ids = vhost_read(removed_worker,
         #                                     "dev_list").strip().split("\t")
@@ -336,5 +445,15 @@ class IOWorkersManager:
         # assert not removed_worker_dev_ids
 
         del workers[removed_worker["id"]]
-        vhost_write(vhost.workersGlobal, "remove", removed_worker["id"])
+        # park the worker for a later addition, or lock and remove it
+        if self.worker_pool.give(removed_worker):
+            return
+        vhost_worker_remove(vhost, removed_worker)
         vhost.vhost_light.update(rescan=True)
+
+    def fill_worker_pool(self):
+        """
+        Creates a parked worker if the worker pool is not full, outside of
+        the critical path of an IO core addition.
+        """
+        return self.worker_pool.fill(max_new=1)
@@ -9,6 +9,7 @@ from time import sleep
 from utils.aux import msg
 from utils.daemon import Daemon
 from utils.affinity_entity import AffinityEntity
+from utils.cpu_set import CPUSet
 
 IRQ_DIRECTORY = "/proc/irq"
 IRQ_FILENAME = "/proc/interrupts"
@@ -75,10 +76,7 @@ def parse_user_list(user_list):
 
 
 def parse_cpu_mask(_cpu_list):
-    _cpu_mask = 0
-    for cpu in parse_user_list(_cpu_list):
-        _cpu_mask += (1 << cpu)
-    return _cpu_mask
+    return CPUSet.from_user_list(_cpu_list).mask
 
 
 def parse_irq_numbers(numbers_list):
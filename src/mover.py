@@ -8,7 +8,7 @@ import getopt
 
 from io_workers_manager import IOWorkersManager
 from backing_device_manager import BackingDeviceManager
-from poll_policy import NullPollPolicy
+from poll_policy import NullPollPolicy, AdaptivePollPolicy
 from vm_manager import VMManager
 
 from algos.backing_devices_rebalance_policy import \
@@ -202,7 +202,10 @@ def main(argv):
     # set up manager policies
     vq_classifier = VirtualQueueClassifier(config["virtual_queue_classifier"])
     # poll_policy = PollPolicy(config["poll_policy"])
-    poll_policy = NullPollPolicy()
+    if config.get("poll_policy", {}).get("id") == "adaptive":
+        poll_policy = AdaptivePollPolicy(config["poll_policy"])
+    else:
+        poll_policy = NullPollPolicy()
     io_core_policy = LastAddedPolicy.create_io_cores_policy(config["workers"])
     io_core_balance_policy = \
         IOCoresPreConfiguredBalancePolicy(config["io_cores_balance_policy"],
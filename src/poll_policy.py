@@ -2,6 +2,11 @@
 import logging
 
 from utils.vhost import Vhost, vhost_write
+from utils.counter_store import CounterStore
+from utils.get_cycles.get_cycles import Cycles
+
+# the virtual queue counters the adaptive polling is based on
+POLL_FIELDS = ("poll_cycles", "poll_empty_cycles", "notif_works")
 
 
 class PollPolicy:
@@ -109,3 +114,136 @@ class NullPollPolicy:
                 continue
             # logging.info("\x1b[37mvq=%s stop polling.\x1b[39m" % (vq_id,))
             vhost_write(vq, "poll", 0)
+
+
+class AdaptivePollPolicy:
+    """
+    Switches every virtual queue between polling and notifications by its
+    raw counters since the last update:
+    - a polled queue that was mostly empty (poll_empty_cycles out of its
+      polling time, the busy poll_cycles and the empty ones, is at least
+      stop_empty_ratio) goes back to notifications, to save the cycles of
+      its IO core
+    - a notified queue that works more often than every start_rate cycles
+      (notif_works) is polled, to save the cost of the notifications
+
+    A queue is not switched again for cooldown updates after a switch. The
+    switches of an update are written together, at most max_switches of
+    them, the busiest queues first, alternating starts and stops so neither
+    starves the other.
+    """
+    def __init__(self, poll_info):
+        # cycles per work
+        self.poll_start_rate = long(poll_info["start_rate"])  # 1 << 22
+        # the ratio of empty polling cycles to stop polling
+        self.stop_empty_ratio = \
+            float(poll_info.get("stop_empty_ratio", 0.9))
+        # the number of updates a queue keeps its mode after a switch
+        self.cooldown = int(poll_info.get("cooldown", 6))
+        # the maximum number of queues switched in one update
+        self.max_switches = int(poll_info.get("max_switches", 16))
+
+        self.stats = CounterStore(POLL_FIELDS)
+        self.last_cycles = None
+        # virtual queue id -> the updates since its last switch
+        self.cooldowns = {}
+        self.shared_workers = False
+        self.switches = 0
+        Cycles.initialize()
+
+    def initialize(self, shared_workers):
+        self.shared_workers = shared_workers
+        self.cooldowns = {}
+        self._load()
+
+    def _load(self):
+        """
+        Loads the polling counters from the vhost queue stats.
+        :return: the cycles since the last load, None on the first load
+        """
+        queue_stats = Vhost.INSTANCE.vhost_light.queue_stats
+        self.stats.load_columns(
+            queue_stats.ids, [queue_stats.column(f) for f in POLL_FIELDS])
+        cycles = Cycles.get_cycles()
+        last_cycles, self.last_cycles = self.last_cycles, cycles
+        if last_cycles is None or cycles <= last_cycles:
+            return None
+        return cycles - last_cycles
+
+    def _apply(self, switches):
+        """
+        Writes a batch of mode switches.
+        :param switches: a list of (virtual queue, poll)
+        """
+        for vq, poll in switches:
+            try:
+                vhost_write(vq, "poll", poll)
+            except IOError as e:
+                logging.warning("vq=%s poll %d failed: %s" %
+                                (vq["id"], poll, e))
+                continue
+            vq["poll"] = poll
+            self.cooldowns[vq["id"]] = 0
+            self.switches += 1
+
+    def update_polling(self):
+        elapsed = self._load()
+        if not self.shared_workers or elapsed is None:
+            return
+
+        queues = Vhost.INSTANCE.queues
+        stats = self.stats
+        starts = []
+        stops = []
+        for vq_id, poll_cycles, poll_empty_cycles, notif_works \
+                in zip(stats.ids, *[stats.deltas(f) for f in POLL_FIELDS]):
+            vq = queues.get(vq_id)
+            if vq is None:
+                continue
+            updates = self.cooldowns.get(vq_id, self.cooldown)
+            if updates < self.cooldown:
+                self.cooldowns[vq_id] = updates + 1
+                continue
+            if vq["can_poll"] == 0 and vq["poll"] == 0:
+                continue
+
+            if vq["poll"] == 1:
+                polling_cycles = poll_cycles + poll_empty_cycles
+                empty_ratio = float(poll_empty_cycles) / polling_cycles \
+                    if polling_cycles > 0 else 1.0
+                if empty_ratio >= self.stop_empty_ratio:
+                    stops.append((poll_cycles, vq))
+            elif notif_works > 0 and \
+                    elapsed / notif_works < self.poll_start_rate:
+                starts.append((notif_works, vq))
+
+        starts.sort(key=lambda s: s[0], reverse=True)
+        stops.sort(key=lambda s: s[0], reverse=True)
+        switches = []
+        for i in xrange(max(len(starts), len(stops))):
+            if i < len(starts):
+                switches.append((starts[i][1], 1))
+            if i < len(stops):
+                switches.append((stops[i][1], 0))
+        if not switches:
+            return
+        switches = switches[:self.max_switches]
+        self._apply(switches)
+        logging.info("\x1b[37mpolling: %d queues started polling, %d "
+                     "stopped.\x1b[39m" %
+                     (len([s for s in switches if s[1] == 1]),
+                      len([s for s in switches if s[1] == 0])))
+
+    def enable_shared_workers(self):
+        logging.info("\x1b[37menable shared IO workers - start polling."
+                     "\x1b[39m\n")
+        self.initialize(True)
+        self._apply([(vq, 1) for vq in Vhost.INSTANCE.queues.values()
+                     if vq["can_poll"] == 1 and vq["poll"] == 0])
+
+    def disable_shared_workers(self):
+        logging.info("\x1b[37mdisable shared IO workers - stop polling."
+                     "\x1b[39m\n")
+        self.shared_workers = False
+        self._apply([(vq, 0) for vq in Vhost.INSTANCE.queues.values()
+                     if vq["can_poll"] == 1 or vq["poll"] == 1])
@@ -93,6 +93,7 @@ static PyMethodDef VhostWorker_methods[] = {
 
 static PyMemberDef VhostWorker_members[] = {
     {"worker_id", T_STRING, offsetof(VhostWorker, id), 0, "worker id"},
+    {"kernel_address", T_ULONGLONG, offsetof(VhostWorker, kernel_address), READONLY, "kernel address of the worker stats"},
     VHOST_WORKER_STAT(loops, "number of loops performed"),
     VHOST_WORKER_STAT(enabled_interrupts, "number of times interrupts were re-enabled"),
     VHOST_WORKER_STAT(cycles, "cycles spent in the worker, excluding cycles doing queue work"),
@@ -213,6 +214,7 @@ static PyMethodDef VhostDevice_methods[] = {
 
 static PyMemberDef VhostDevice_members[] = {
     {"dev_id", T_STRING, offsetof(VhostDevice, id), 0, "device id"},
+    {"kernel_address", T_ULONGLONG, offsetof(VhostDevice, kernel_address), READONLY, "kernel address of the device stats"},
     VHOST_DEVICE_STAT(delay_per_work, "the number of loops per work we have to delay the calculation."),
     VHOST_DEVICE_STAT(delay_per_kbyte, "the number of loops per kbyte we have to delay the calculation."),
     VHOST_DEVICE_STAT(device_move_total, ""),
@@ -321,6 +323,7 @@ static PyMethodDef VhostVirtqueue_methods[] = {
 
 static PyMemberDef VhostVirtqueue_members[] = {
     {"vq_id", T_STRING, offsetof(VhostVirtqueue, id), 0, "virtual queue id"},
+    {"kernel_address", T_ULONGLONG, offsetof(VhostVirtqueue, kernel_address), READONLY, "kernel address of the virtqueue stats"},
     VHOST_VQ_STAT(poll_kicks, "number of kicks in poll mode"),
     VHOST_VQ_STAT(poll_cycles, "cycles spent handling kicks in poll mode"),
     VHOST_VQ_STAT(poll_bytes, "bytes sent/received by kicks in poll mode"),
@@ -391,6 +394,290 @@ static PyTypeObject VhostVirtqueueType = {
 };
 
 
+// ------------------ vhost snapshot -------------------------------------------
+// Copies the stats of a set of workers, devices and virtqueues in a single
+// call. The records are kept in one contiguous block laid out as:
+// [vhost_worker_stats * n_workers][vhost_device_stats * n_devices]
+// [vhost_virtqueue_stats * n_queues], and exposed without copying through the
+// buffer protocol.
+typedef struct {
+    PyObject_HEAD
+    Py_ssize_t n_workers;
+    Py_ssize_t n_devices;
+    Py_ssize_t n_queues;
+    u64 *kernel_addresses;
+    char *records;
+    Py_ssize_t records_size;
+} Snapshot;
+
+#define SNAPSHOT_WORKERS_OFFSET(self) 0
+#define SNAPSHOT_DEVICES_OFFSET(self) \
+    ((self)->n_workers * sizeof(struct vhost_worker_stats))
+#define SNAPSHOT_QUEUES_OFFSET(self) \
+    (SNAPSHOT_DEVICES_OFFSET(self) + \
+     (self)->n_devices * sizeof(struct vhost_device_stats))
+
+static void Snapshot_dealloc(Snapshot* self)
+{
+    PyMem_Free(self->kernel_addresses);
+    PyMem_Free(self->records);
+    self->ob_type->tp_free((PyObject*)self);
+}
+
+static PyObject *
+Snapshot_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
+{
+    Snapshot *self;
+
+    self = (Snapshot *)type->tp_alloc(type, 0);
+    if (self != NULL) {
+        self->n_workers = 0;
+        self->n_devices = 0;
+        self->n_queues = 0;
+        self->kernel_addresses = NULL;
+        self->records = NULL;
+        self->records_size = 0;
+    }
+    return (PyObject *)self;
+}
+
+// collects the kernel addresses of a sequence of vhost raw objects
+static int
+Snapshot_collect(PyObject *seq, PyTypeObject *type, u64 *addresses,
+                 Py_ssize_t n)
+{
+    Py_ssize_t i;
+    for (i = 0; i < n; i++) {
+        PyObject *item = PySequence_Fast_GET_ITEM(seq, i);
+        if (!PyObject_TypeCheck(item, type)) {
+            PyErr_Format(PyExc_TypeError, "expected %s objects, got %s",
+                         type->tp_name, item->ob_type->tp_name);
+            return -1;
+        }
+        // all the vhost raw objects share the same head layout
+        addresses[i] = ((VhostWorker *)item)->kernel_address;
+    }
+    return 0;
+}
+
+static int
+Snapshot_init(Snapshot *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"workers", "devices", "queues", NULL};
+    PyObject *workers = NULL, *devices = NULL, *queues = NULL;
+    PyObject *workers_seq = NULL, *devices_seq = NULL, *queues_seq = NULL;
+    Py_ssize_t n;
+    int ret = -1;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OOO", kwlist, &workers,
+                                     &devices, &queues))
+        return -1;
+
+    workers_seq = PySequence_Fast(workers, "workers must be a sequence");
+    devices_seq = PySequence_Fast(devices, "devices must be a sequence");
+    queues_seq = PySequence_Fast(queues, "queues must be a sequence");
+    if (workers_seq == NULL || devices_seq == NULL || queues_seq == NULL)
+        goto out;
+
+    PyMem_Free(self->kernel_addresses);
+    PyMem_Free(self->records);
+    self->kernel_addresses = NULL;
+    self->records = NULL;
+
+    self->n_workers = PySequence_Fast_GET_SIZE(workers_seq);
+    self->n_devices = PySequence_Fast_GET_SIZE(devices_seq);
+    self->n_queues = PySequence_Fast_GET_SIZE(queues_seq);
+    n = self->n_workers + self->n_devices + self->n_queues;
+
+    self->records_size = SNAPSHOT_QUEUES_OFFSET(self) +
+        self->n_queues * sizeof(struct vhost_virtqueue_stats);
+    self->kernel_addresses = PyMem_Malloc((n ? n : 1) * sizeof(u64));
+    self->records = PyMem_Malloc(self->records_size ?
+                                 self->records_size : 1);
+    if (self->kernel_addresses == NULL || self->records == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    memset(self->records, 0, self->records_size);
+
+    if (Snapshot_collect(workers_seq, &VhostWorkerType,
+                         self->kernel_addresses, self->n_workers) < 0)
+        goto out;
+    if (Snapshot_collect(devices_seq, &VhostDeviceType,
+                         self->kernel_addresses + self->n_workers,
+                         self->n_devices) < 0)
+        goto out;
+    if (Snapshot_collect(queues_seq, &VhostVirtqueueType,
+                         self->kernel_addresses + self->n_workers +
+                         self->n_devices, self->n_queues) < 0)
+        goto out;
+    ret = 0;
+out:
+    Py_XDECREF(workers_seq);
+    Py_XDECREF(devices_seq);
+    Py_XDECREF(queues_seq);
+    return ret;
+}
+
+static void
+Snapshot_copy(const u64 *addresses, char *to, Py_ssize_t n, size_t size)
+{
+    Py_ssize_t i;
+    for (i = 0; i < n; i++, to += size) {
+        if (addresses[i] != 0UL)
+            copy_to_user(to, addresses[i], size);
+    }
+}
+
+static PyObject *
+Snapshot_update(Snapshot *self){
+    const u64 *addresses = self->kernel_addresses;
+    if (self->records == NULL)
+        Py_RETURN_NONE;
+
+    Snapshot_copy(addresses,
+                  self->records + SNAPSHOT_WORKERS_OFFSET(self),
+                  self->n_workers, sizeof(struct vhost_worker_stats));
+    addresses += self->n_workers;
+    Snapshot_copy(addresses,
+                  self->records + SNAPSHOT_DEVICES_OFFSET(self),
+                  self->n_devices, sizeof(struct vhost_device_stats));
+    addresses += self->n_devices;
+    Snapshot_copy(addresses,
+                  self->records + SNAPSHOT_QUEUES_OFFSET(self),
+                  self->n_queues, sizeof(struct vhost_virtqueue_stats));
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef Snapshot_methods[] = {
+    {"update", (PyCFunction) Snapshot_update, METH_NOARGS, "copy the stats of all the registered elements"},
+    {NULL}
+};
+
+static PyObject *
+Snapshot_records(Snapshot *self, Py_ssize_t offset, Py_ssize_t size)
+{
+    // a read only view that keeps a reference to the snapshot
+    return PyBuffer_FromObject((PyObject *)self, offset, size);
+}
+
+static PyObject *
+Snapshot_get_workers(Snapshot *self, void *closure)
+{
+    return Snapshot_records(self, SNAPSHOT_WORKERS_OFFSET(self),
+                            SNAPSHOT_DEVICES_OFFSET(self));
+}
+
+static PyObject *
+Snapshot_get_devices(Snapshot *self, void *closure)
+{
+    return Snapshot_records(self, SNAPSHOT_DEVICES_OFFSET(self),
+                            SNAPSHOT_QUEUES_OFFSET(self) -
+                            SNAPSHOT_DEVICES_OFFSET(self));
+}
+
+static PyObject *
+Snapshot_get_queues(Snapshot *self, void *closure)
+{
+    return Snapshot_records(self, SNAPSHOT_QUEUES_OFFSET(self),
+                            self->records_size - SNAPSHOT_QUEUES_OFFSET(self));
+}
+
+static PyGetSetDef Snapshot_getset[] = {
+    {"workers", (getter)Snapshot_get_workers, NULL, "vhost_worker_stats records buffer", NULL},
+    {"devices", (getter)Snapshot_get_devices, NULL, "vhost_device_stats records buffer", NULL},
+    {"queues", (getter)Snapshot_get_queues, NULL, "vhost_virtqueue_stats records buffer", NULL},
+    {NULL}  /* Sentinel */
+};
+
+static PyMemberDef Snapshot_members[] = {
+    {"n_workers", T_PYSSIZET, offsetof(Snapshot, n_workers), READONLY, "number of workers"},
+    {"n_devices", T_PYSSIZET, offsetof(Snapshot, n_devices), READONLY, "number of devices"},
+    {"n_queues", T_PYSSIZET, offsetof(Snapshot, n_queues), READONLY, "number of virtqueues"},
+    {NULL}  /* Sentinel */
+};
+
+// old style buffer protocol (buffer objects, array.fromstring, ...)
+static Py_ssize_t
+Snapshot_getreadbuffer(Snapshot *self, Py_ssize_t segment, void **ptrptr)
+{
+    if (segment != 0) {
+        PyErr_SetString(PyExc_SystemError,
+                        "accessing non-existent snapshot segment");
+        return -1;
+    }
+    *ptrptr = self->records;
+    return self->records_size;
+}
+
+static Py_ssize_t
+Snapshot_getsegcount(Snapshot *self, Py_ssize_t *lenp)
+{
+    if (lenp)
+        *lenp = self->records_size;
+    return 1;
+}
+
+// new style buffer protocol (memoryview)
+static int
+Snapshot_getbuffer(Snapshot *self, Py_buffer *view, int flags)
+{
+    return PyBuffer_FillInfo(view, (PyObject *)self, self->records,
+                             self->records_size, 1, flags);
+}
+
+static PyBufferProcs Snapshot_as_buffer = {
+    (readbufferproc)Snapshot_getreadbuffer,   /* bf_getreadbuffer */
+    0,                                        /* bf_getwritebuffer */
+    (segcountproc)Snapshot_getsegcount,       /* bf_getsegcount */
+    (charbufferproc)Snapshot_getreadbuffer,   /* bf_getcharbuffer */
+    (getbufferproc)Snapshot_getbuffer,        /* bf_getbuffer */
+    0,                                        /* bf_releasebuffer */
+};
+
+static PyTypeObject SnapshotType = {
+    PyObject_HEAD_INIT(NULL)
+    0,                                        /*ob_size*/
+    "vhost_raw.Snapshot",                     /*tp_name*/
+    sizeof(Snapshot),                         /*tp_basicsize*/
+    0,                                        /*tp_itemsize*/
+    (destructor)Snapshot_dealloc,             /*tp_dealloc*/
+    0,                                        /*tp_print*/
+    0,                                        /*tp_getattr*/
+    0,                                        /*tp_setattr*/
+    0,                                        /*tp_compare*/
+    0,                                        /*tp_repr*/
+    0,                                        /*tp_as_number*/
+    0,                                        /*tp_as_sequence*/
+    0,                                        /*tp_as_mapping*/
+    0,                                        /*tp_hash */
+    0,                                        /*tp_call*/
+    0,                                        /*tp_str*/
+    0,                                        /*tp_getattro*/
+    0,                                        /*tp_setattro*/
+    &Snapshot_as_buffer,                      /*tp_as_buffer*/
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE |
+        Py_TPFLAGS_HAVE_NEWBUFFER,            /*tp_flags*/
+    "Vhost raw bulk statistics snapshot",     /* tp_doc */
+    0,                                        /* tp_traverse */
+    0,                                        /* tp_clear */
+    0,                                        /* tp_richcompare */
+    0,                                        /* tp_weaklistoffset */
+    0,                                        /* tp_iter */
+    0,                                        /* tp_iternext */
+    Snapshot_methods,                         /* tp_methods */
+    Snapshot_members,                         /* tp_members */
+    Snapshot_getset,                          /* tp_getset */
+    0,                                        /* tp_base */
+    0,                                        /* tp_dict */
+    0,                                        /* tp_descr_get */
+    0,                                        /* tp_descr_set */
+    0,                                        /* tp_dictoffset */
+    (initproc)Snapshot_init,                  /* tp_init */
+    0,                                        /* tp_alloc */
+    Snapshot_new,                             /* tp_new */
+};
+
 // ------------------ vhost module ---------------------------------------------
 
 static PyMethodDef vhost_raw_methods[] = {
@@ -416,6 +703,9 @@ initvhost_raw(void)
 
     if (PyType_Ready(&VhostVirtqueueType) < 0)
         return;
+
+    if (PyType_Ready(&SnapshotType) < 0)
+        return;
 //    printf("%s:%d\n", __func__, __LINE__);
 
     m = Py_InitModule3("vhost_raw", vhost_raw_methods,
@@ -436,4 +726,13 @@ initvhost_raw(void)
     Py_INCREF(&VhostVirtqueueType);
 //    printf("%s:%d\n", __func__, __LINE__);
     PyModule_AddObject(m, "VhostVirtqueue", (PyObject *)&VhostVirtqueueType);
+    Py_INCREF(&SnapshotType);
+    PyModule_AddObject(m, "Snapshot", (PyObject *)&SnapshotType);
+
+    PyModule_AddIntConstant(m, "WORKER_STATS_SIZE",
+                            sizeof(struct vhost_worker_stats));
+    PyModule_AddIntConstant(m, "DEVICE_STATS_SIZE",
+                            sizeof(struct vhost_device_stats));
+    PyModule_AddIntConstant(m, "VIRTQUEUE_STATS_SIZE",
+                            sizeof(struct vhost_virtqueue_stats));
 }
\ No newline at end of file
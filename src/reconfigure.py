@@ -4,13 +4,12 @@ import json
 import sys
 import os
 
-import time
-
 from utils.affinity_entity import parse_cpu_mask_from_cpu_list, \
     set_cpu_mask_to_pid
 from utils.aux import msg
 from utils.vhost import Vhost, vhost_write, vhost_worker_set_cpu_mask, \
-    vhost_read
+    vhost_read, vhost_worker_create, vhost_worker_remove
+from utils.device_mover import DeviceMover
 
 
 def usage(program_name, error):
@@ -26,16 +25,6 @@ def usage(program_name, error):
     sys.exit()
 
 
-def vhost_worker_create():
-    workers_global = Vhost.INSTANCE.workersGlobal
-    vhost_write(workers_global, "create", 0)
-
-
-def vhost_remove_worker(removed_worker):
-    workers_global = Vhost.INSTANCE.workersGlobal
-    vhost_write(removed_worker, "locked", 1)
-    vhost_write(workers_global, "remove", removed_worker["id"])
-
 if __name__ == '__main__':
     if len(sys.argv) < 2:
         usage(sys.argv[0], "Wrong number of arguments, expected 1 got %d" %
@@ -86,6 +75,9 @@ if __name__ == '__main__':
     # msg([w["id"] for w in workers])
     devices = Vhost.INSTANCE.devices
     queues = Vhost.INSTANCE.queues
+    # moves the devices of a batch concurrently, waiting for devices that
+    # are still in transfer
+    mover = DeviceMover()
 
     # fix vms affinity
     msg("fix vms affinity")
@@ -105,7 +97,7 @@ if __name__ == '__main__':
     if workers_for_addition > 0:
         msg("workers_for_addition: %d" % (workers_for_addition,))
         for _ in xrange(workers_for_addition):
-            vhost_worker_create()
+            vhost_worker_create(Vhost.INSTANCE)
         Vhost.INSTANCE.update(light_update=False, update_epoch=False,
                               rescan_files=True)
         workers = sorted(Vhost.INSTANCE.workers.values(),
@@ -130,6 +122,7 @@ if __name__ == '__main__':
 
         # move devices to the correct workers and fix workers affinity
         msg("move devices to the correct workers and fix workers affinity")
+        moves = {}
         for vm in vms_conf:
             for dev in vm["devices"]:
                 # move devices to the correct workers
@@ -137,7 +130,8 @@ if __name__ == '__main__':
                     dev["vhost_worker"] = worker_mapping[dev["vhost_worker"]]
 
                 # msg(dev["vhost_worker"])
-                vhost_write(devices[dev["id"]], "worker", dev["vhost_worker"])
+                moves[dev["id"]] = dev["vhost_worker"]
+        mover.move(moves, devices, Vhost.INSTANCE.workers)
 
         # update the configuration file
         for worker in config["workers"]:
@@ -158,23 +152,22 @@ if __name__ == '__main__':
         msg("move devices to the correct workers:")
         # move devices to the correct workers
         i = 0
+        moves = {}
         for vm in vms_conf:
-            cpu_mask = parse_cpu_mask_from_cpu_list(vm["cpu"])
-            msg("vm: %s, cpu:%s, cpu_mask:0x%x" %
-                (vm["id"], vm["cpu"], cpu_mask))
             for dev in vm["devices"]:
                 msg("dev: %s, old worker: %s, new worker: %s" %
                     (dev["id"], dev["vhost_worker"], workers[i]["id"]))
-
                 dev["vhost_worker"] = workers[i]["id"]
-                for _ in xrange(10):
-                    try:
-                        vhost_write(devices[dev["id"]], "worker",
-                                    dev["vhost_worker"])
-                    except IOError:
-                        msg("device still in transfer waiting 1 second.")
-                        time.sleep(1)
+                moves[dev["id"]] = dev["vhost_worker"]
+                i += 1
+        mover.move(moves, devices, Vhost.INSTANCE.workers)
 
+        i = 0
+        for vm in vms_conf:
+            cpu_mask = parse_cpu_mask_from_cpu_list(vm["cpu"])
+            msg("vm: %s, cpu:%s, cpu_mask:0x%x" %
+                (vm["id"], vm["cpu"], cpu_mask))
+            for dev in vm["devices"]:
                 # fix affinity
                 msg("io worker: worker: %s, cpu_mask: 0x"
                     "%x" %
@@ -198,7 +191,9 @@ if __name__ == '__main__':
         # msg([w["id"] for w in workers[len(workers_conf):]])
         for worker in workers[-workers_for_removal:]:
             # msg(worker["id"])
-            vhost_remove_worker(worker)
+            vhost_worker_remove(Vhost.INSTANCE, worker)
+
+    mover.close()
 
     # save configuration
     with open(config_filename, "w+") as f:
@@ -4,6 +4,7 @@ from utils.affinity_entity import Thread
 from utils.aux import warn
 from utils.device import IRQ, get_irq_numbers
 from utils.vhost import Vhost, vhost_worker_get_cpu_mask
+from utils.topology import Topology
 
 
 class BackingDevice:
@@ -44,6 +45,18 @@ class BackingDevice:
         return [Thread(t["pid"], idx, None)
                 for idx, t in enumerate(threads_info)]
 
+    def numa_nodes(self):
+        """
+        :return: the NUMA nodes of a physical backing device, by the nodes
+        of its IRQs
+        """
+        if "physical" != self.type:
+            return set()
+        nodes = set(Topology.irq_node(irq.id)
+                    for irq in self.affinity_entities)
+        nodes.discard(None)
+        return nodes
+
     def remove_core(self, cpu_id):
         for ea in self.affinity_entities:
             ea.remove_cpu(cpu_id)
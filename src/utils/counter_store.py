@@ -0,0 +1,201 @@
+from array import array
+from itertools import chain, imap, izip
+from operator import attrgetter, itemgetter, sub
+
+__author__ = 'eyalmo'
+
+# 64 bit unsigned, the same as the kernel u64 counters
+TYPECODE = 'L'
+
+
+class CounterStore:
+    """
+    A struct-of-arrays store for the counters of a set of elements (vhost
+    workers, devices or virtual queues): one row per element and one column
+    per counter, kept in a single row-major array of u64 values.
+
+    A column is a strided slice of the array, so totals and deltas are
+    computed by C loops over contiguous memory rather than by a Python loop
+    over per-element dictionaries.
+
+    Every load keeps the previous values, so deltas are always relative to
+    the previous load. If the set of rows changes, the rows that exist in
+    both loads keep their previous values and new rows start with a zero
+    delta.
+    """
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        self.columns = {f: i for i, f in enumerate(self.fields)}
+        self.width = len(self.fields)
+
+        self.ids = []
+        self.rows = {}
+        self.values = array(TYPECODE)
+        self.last_values = array(TYPECODE)
+
+        self._attr_getter = attrgetter(*self.fields)
+        self._item_getter = itemgetter(*self.fields)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, elem_id):
+        return elem_id in self.rows
+
+    def _load(self, ids, values):
+        last_values = self.values
+        if ids != self.ids:
+            last_values = self._remap(ids, values)
+            self.ids = list(ids)
+            self.rows = {elem_id: i for i, elem_id in enumerate(self.ids)}
+        self.last_values = last_values
+        self.values = values
+
+    def _remap(self, ids, values):
+        """
+        Builds the previous values array in the order of the new rows.
+        """
+        w = self.width
+        last_values = array(TYPECODE, values)
+        for i, elem_id in enumerate(ids):
+            row = self.rows.get(elem_id)
+            if row is None:
+                continue
+            last_values[i * w:(i + 1) * w] = self.values[row * w:(row + 1) * w]
+        return last_values
+
+    def load_objects(self, elements):
+        """
+        Loads the counters from objects that expose them as attributes.
+        :param elements: a dictionary of element id -> object
+        """
+        ids = elements.keys()
+        getter = self._attr_getter
+        if self.width == 1:
+            values = array(TYPECODE, (getter(elements[i]) for i in ids))
+        else:
+            values = array(TYPECODE, chain.from_iterable(
+                imap(getter, (elements[i] for i in ids))))
+        self._load(ids, values)
+
+    def load_dicts(self, elements):
+        """
+        Loads the counters from dictionaries (e.g. the vhost sysfs entries).
+        :param elements: a dictionary of element id -> dictionary
+        """
+        ids = elements.keys()
+        getter = self._item_getter
+        if self.width == 1:
+            values = array(TYPECODE, (getter(elements[i]) for i in ids))
+        else:
+            values = array(TYPECODE, chain.from_iterable(
+                imap(getter, (elements[i] for i in ids))))
+        self._load(ids, values)
+
+    def load_buffer(self, ids, buf):
+        """
+        Loads the counters from a raw buffer of records laid out like the
+        store fields.
+        :param ids: the element ids in the order of the records
+        :param buf: a buffer of len(ids) records of u64 fields
+        """
+        values = array(TYPECODE)
+        values.fromstring(buf)
+        self._load(ids, values)
+
+    def load_columns(self, ids, columns):
+        """
+        Loads the counters from one sequence per field, e.g. some of the
+        columns of another store, so a consumer that runs at a rate of its
+        own keeps its own deltas.
+        :param ids: the element ids in the order of the columns
+        :param columns: a sequence of values per field, in the fields order
+        """
+        values = array(TYPECODE, chain.from_iterable(izip(*columns)))
+        self._load(ids, values)
+
+    def baseline(self):
+        """
+        :return: the rows and the values of the last load, to compute deltas
+        over a longer period later (see rebase). A load replaces the values
+        array rather than modifying it, so no copy is needed.
+        """
+        return self.ids, self.values
+
+    def rebase(self, baseline):
+        """
+        Makes the deltas relative to an earlier baseline instead of the
+        previous load, the rows that did not exist then have a zero delta.
+        :param baseline: a baseline() of this store
+        :return: the state restore needs
+        """
+        state = self.values, self.last_values
+        ids, values = baseline
+        if ids == self.ids:
+            self.last_values = values
+            return state
+        w = self.width
+        rows = {elem_id: i for i, elem_id in enumerate(ids)}
+        rebased = array(TYPECODE, self.values)
+        for i, elem_id in enumerate(self.ids):
+            row = rows.get(elem_id)
+            if row is None:
+                continue
+            rebased[i * w:(i + 1) * w] = values[row * w:(row + 1) * w]
+        self.last_values = rebased
+        return state
+
+    def restore(self, state):
+        """
+        Undoes a rebase, unless the store was loaded since: the deltas of
+        that load are relative to the previous load already.
+        """
+        values, last_values = state
+        if self.values is values:
+            self.last_values = last_values
+
+    def column(self, field):
+        return self.values[self.columns[field]::self.width]
+
+    def last_column(self, field):
+        return self.last_values[self.columns[field]::self.width]
+
+    def get(self, elem_id, field):
+        return self.values[self.rows[elem_id] * self.width +
+                           self.columns[field]]
+
+    def total(self, field):
+        return sum(self.column(field))
+
+    def deltas(self, field):
+        """
+        :return: the per row change of a counter since the previous load, in
+        the order of self.ids
+        """
+        return map(sub, self.column(field), self.last_column(field))
+
+    def delta(self, elem_id, field):
+        i = self.rows[elem_id] * self.width + self.columns[field]
+        return self.values[i] - self.last_values[i]
+
+    def deltas_by_id(self, field):
+        return dict(zip(self.ids, self.deltas(field)))
+
+    def group_totals(self, field, group_of, deltas=True):
+        """
+        Aggregates a counter per group, e.g. the virtual queues counters per
+        device or per worker.
+        :param field: the counter
+        :param group_of: a dictionary of element id -> group id, elements
+        without a group are ignored
+        :param deltas: aggregate the deltas (True) or the current values
+        :return: a dictionary of group id -> aggregated value
+        """
+        values = self.deltas(field) if deltas else self.column(field)
+        totals = {}
+        for elem_id, value in zip(self.ids, values):
+            group = group_of.get(elem_id)
+            if group is None:
+                continue
+            totals[group] = totals.get(group, 0) + value
+        return totals
@@ -0,0 +1,159 @@
+from utils.aux import parse_user_list
+
+__author__ = 'eyalmo'
+
+ONLINE_CPUS_FILE = "/sys/devices/system/cpu/online"
+
+# the kernel prints cpu masks in comma separated groups of 32 bits
+KERNEL_MASK_GROUP_BITS = 32
+
+
+class CPUSet:
+    """
+    A set of cpus of any size, kept as a python integer bit mask: cpu n is
+    bit n. Unions, intersections and differences are single integer
+    operations and iteration only visits the set bits.
+    """
+    def __init__(self, cpus=0):
+        """
+        :param cpus: an integer mask, another CPUSet or a sequence of cpu
+        numbers
+        """
+        if isinstance(cpus, CPUSet):
+            self.mask = cpus.mask
+        elif isinstance(cpus, (int, long)):
+            self.mask = cpus
+        else:
+            self.mask = 0
+            for cpu in cpus:
+                self.mask |= 1 << cpu
+
+    @staticmethod
+    def from_user_list(user_list):
+        """
+        :param user_list: a cpu list such as "0-3,8,10-14:2"
+        """
+        return CPUSet(parse_user_list(user_list))
+
+    @staticmethod
+    def from_kernel_mask(mask_str):
+        """
+        :param mask_str: a hex mask with comma separated groups such as
+        "00000001,ffff0000" (e.g. /proc/irq/N/smp_affinity)
+        """
+        return CPUSet(int(mask_str.strip().replace(",", ""), 16))
+
+    @staticmethod
+    def online():
+        with open(ONLINE_CPUS_FILE, "r") as f:
+            return CPUSet.from_user_list(f.read().strip())
+
+    def to_user_list(self):
+        """
+        :return: the cpus as a compact cpu list such as "0-3,8"
+        """
+        ranges = []
+        start = end = None
+        for cpu in self:
+            if end is not None and cpu == end + 1:
+                end = cpu
+                continue
+            if start is not None:
+                ranges.append((start, end))
+            start = end = cpu
+        if start is not None:
+            ranges.append((start, end))
+        return ",".join(str(s) if s == e else "%d-%d" % (s, e)
+                        for s, e in ranges)
+
+    def to_kernel_mask(self):
+        """
+        :return: the cpus as a hex mask with comma separated groups of 32
+        bits, the format of /proc/irq/N/smp_affinity
+        """
+        group_mask = (1 << KERNEL_MASK_GROUP_BITS) - 1
+        mask = self.mask
+        groups = []
+        while True:
+            groups.append("%08x" % (mask & group_mask,))
+            mask >>= KERNEL_MASK_GROUP_BITS
+            if mask == 0:
+                break
+        return ",".join(reversed(groups))
+
+    def first(self):
+        """
+        :return: the lowest cpu in the set, -1 if the set is empty
+        """
+        mask = self.mask
+        return (mask & -mask).bit_length() - 1
+
+    def next(self, cpu):
+        """
+        :return: the lowest cpu in the set above cpu, -1 if there is none
+        """
+        mask = self.mask >> (cpu + 1) << (cpu + 1)
+        return (mask & -mask).bit_length() - 1
+
+    def add(self, cpu):
+        self.mask |= 1 << cpu
+
+    def discard(self, cpu):
+        self.mask &= ~(1 << cpu)
+
+    def update(self, other):
+        self.mask |= CPUSet(other).mask
+
+    def clear(self):
+        self.mask = 0
+
+    def copy(self):
+        return CPUSet(self.mask)
+
+    def __iter__(self):
+        mask = self.mask
+        while mask:
+            low = mask & -mask
+            yield low.bit_length() - 1
+            mask ^= low
+
+    def __len__(self):
+        return bin(self.mask).count("1")
+
+    def __contains__(self, cpu):
+        return (self.mask >> cpu) & 1 == 1
+
+    def __nonzero__(self):
+        return self.mask != 0
+
+    def __int__(self):
+        return self.mask
+
+    __long__ = __int__
+
+    def __or__(self, other):
+        return CPUSet(self.mask | CPUSet(other).mask)
+
+    def __and__(self, other):
+        return CPUSet(self.mask & CPUSet(other).mask)
+
+    def __sub__(self, other):
+        return CPUSet(self.mask & ~CPUSet(other).mask)
+
+    def __xor__(self, other):
+        return CPUSet(self.mask ^ CPUSet(other).mask)
+
+    def __eq__(self, other):
+        return isinstance(other, CPUSet) and self.mask == other.mask
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.mask)
+
+    def __str__(self):
+        return self.to_user_list()
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__, self.__str__())
@@ -1,40 +1,31 @@
 #!/usr/bin/python
 
-import re
+from utils.cpu_set import CPUSet
 
 
 class CPU:
-    processorPattern = re.compile('\s*processor\s*:\s*(\d+)\s*')
-    socketPattern = re.compile('\s*physical\s+id\s*:\s*(\d+)\s*')
-
-    def __init__(self, cpu_id, socket):
+    def __init__(self, cpu_id, socket, core=None, node=None, siblings=None,
+                 llc=None):
+        """
+        :param cpu_id: the logical cpu id
+        :param socket: the physical package id
+        :param core: the core id inside the socket
+        :param node: the NUMA node, None if unknown
+        :param siblings: the SMT siblings of the cpu (including itself)
+        :param llc: the cpus sharing the last level cache with the cpu
+        (including itself)
+        """
         self.id = cpu_id
         self.socket = socket
+        self.core = core
+        self.node = node
+        self.siblings = CPUSet([cpu_id]) if siblings is None else siblings
+        self.llc = CPUSet([cpu_id]) if llc is None else llc
 
-    @staticmethod
-    def parse_cpus():
-        ids = []
-        sockets = []
-        with open("/proc/cpuinfo") as f:
-            for line in f:
-                match = CPU.processorPattern.match(line)
-                if match:
-                    value = match.group(1)
-                    ids.append(int(value))
-                    continue
-                match = CPU.socketPattern.match(line)
-                if match:
-                    value = match.group(1)
-                    sockets.append(int(value))
-                    continue
-
-        cpus = {}
-        for i, cpu_id in enumerate(ids):
-            cpus[cpu_id] = CPU(cpu_id, sockets[i])
-        return cpus
-    
     def __str__(self):
-        return "id: %d, socket: %d" % (self.id, self.socket)
+        return "id: %d, socket: %d, core: %s, node: %s, siblings: %s, " \
+               "llc: %s" % (self.id, self.socket, self.core, self.node,
+                            self.siblings, self.llc)
 
     def __repr__(self):
-        return "%s(%s)" % (self.__class__, self.__str__())
\ No newline at end of file
+        return "%s(%s)" % (self.__class__, self.__str__())
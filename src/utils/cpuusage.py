@@ -3,11 +3,15 @@ import logging
 import time
 import sys
 import os
+from array import array
+from operator import add, sub
 
 import kernel_mapper
 from uptime import UpTimeCounterRaw
 
 from utils.aux import syscmd, err, Timer, spilt_output_into_rows
+from utils.sysfs_reader import SysfsReader
+from utils.stream_stats import StatsEngine
 
 RAW_FIELD_SIZE = 8
 
@@ -107,6 +111,57 @@ class IRQCounter(IRQCounterBase):
         self.interrupts_diff = [e - s for e, s in zip(self.interrupts, old)]
 
 
+class SoftirqCounter:
+    """
+    Reads the per cpu softirq counts of /proc/softirqs, the network ones
+    (NET_RX and NET_TX) and the total, through a file descriptor that stays
+    open between updates.
+    """
+    file_path = "/proc/softirqs"
+    net_rows = ("NET_RX:", "NET_TX:")
+
+    def __init__(self):
+        self.reader = SysfsReader()
+        self.cpu_ids, self.net, self.total = self._parse()
+        self.net_diff = {cpu: 0 for cpu in self.cpu_ids}
+        self.total_diff = {cpu: 0 for cpu in self.cpu_ids}
+
+    def _parse(self):
+        rows = self.reader.read_file(SoftirqCounter.file_path).split("\n")
+        cpu_ids = [int(c[3:]) for c in rows[0].split()]
+        n = len(cpu_ids)
+        net = [0] * n
+        total = [0] * n
+        for row in rows[1:]:
+            fields = row.split(None, n + 1)
+            if len(fields) < n + 1:
+                continue
+            values = map(int, fields[1:n + 1])
+            total = map(add, total, values)
+            if fields[0] in SoftirqCounter.net_rows:
+                net = map(add, net, values)
+        return cpu_ids, net, total
+
+    def update(self):
+        cpu_ids, net, total = self._parse()
+        if cpu_ids != self.cpu_ids:
+            # cpus were added or removed, start over
+            self.net, self.total = net, total
+        self.net_diff = dict(zip(cpu_ids, map(sub, net, self.net)))
+        self.total_diff = dict(zip(cpu_ids, map(sub, total, self.total)))
+        self.cpu_ids, self.net, self.total = cpu_ids, net, total
+
+    def net_share(self, cpu):
+        """
+        :return: the ratio of the network softirqs out of all the softirqs
+        of a cpu since the last update
+        """
+        total = self.total_diff.get(cpu, 0)
+        if total <= 0:
+            return 0.0
+        return float(self.net_diff.get(cpu, 0)) / total
+
+
 class CPUStatCounterBase:
     def __init__(self):
         self.per_cpu_counters_start, self.global_cpu_counters_start = \
@@ -266,13 +321,127 @@ class CPUStatCounter(CPUStatCounterBase):
         return per_cpu_counters, global_cpu_counters
 
 
+class CPUStatCounterProc(CPUStatCounter):
+    """
+    Reads /proc/stat through a file descriptor that stays open between
+    updates (no shell and no cat process per update) and parses the cpu
+    rows with str.split into a flat array of jiffies: the global row first
+    and then one row per cpu. The counters are the same as CPUStatCounter's.
+    """
+    file_path = "/proc/stat"
+    width = len(CPUStatCounter.common_fields)
+    # convert jiffies to nsecs, and / 2.5 convert CLOCK TICKS(HZ) to TICK
+    scale = convert_jiffies_to_ns(1) / 2.5
+
+    def __init__(self):
+        self.reader = SysfsReader()
+        self.cpu_ids = []
+        self.cpu_ids, self.values, self.context_switches = self._parse()
+
+        self.per_cpu_counters = [[cpu] + [0] * self.width
+                                 for cpu in self.cpu_ids]
+        self.global_cpu_counters = [0] * self.width
+
+    def _split_rows(self, raw_str):
+        # only the cpu rows are split, the rest of the file (the long intr
+        # row in particular) is left as one string
+        rows = raw_str.split("\n", len(self.cpu_ids) + 1)
+        if rows[-1].startswith("cpu"):
+            # the first read or cpus were added
+            rows = raw_str.split("\n")
+        return rows
+
+    def _parse(self):
+        raw_str = self.reader.read_file(CPUStatCounterProc.file_path)
+        w = self.width
+
+        cpu_ids = []
+        columns = []
+        for row in self._split_rows(raw_str):
+            if not row.startswith("cpu"):
+                break
+            fields = row.split(None, w + 1)
+            values = fields[1:w + 1]
+            if len(values) < w:
+                # older kernels do not have the last columns
+                values += ["0"] * (w - len(values))
+            columns.extend(values)
+            if fields[0] != "cpu":
+                cpu_ids.append(int(fields[0][3:]))
+
+        values = array('L', map(int, columns))
+
+        start = raw_str.find("\nctxt ") + len("\nctxt ")
+        context_switches = int(raw_str[start:raw_str.find("\n", start)])
+        return cpu_ids, values, context_switches
+
+    def read(self):
+        cpu_ids, values, context_switches = self._parse()
+        w = self.width
+        per_cpu_counters = \
+            [[cpu] + [convert_jiffies_to_ns(v)
+                      for v in values[(r + 1) * w:(r + 2) * w]]
+             for r, cpu in enumerate(cpu_ids)]
+        global_cpu_counters = [convert_jiffies_to_ns(v)
+                               for v in values[:w - 1]]
+        global_cpu_counters.append(convert_jiffies_to_ns(context_switches))
+        return per_cpu_counters, global_cpu_counters
+
+    def update(self):
+        old_values = self.values
+        old_context_switches = self.context_switches
+        cpu_ids, self.values, self.context_switches = self._parse()
+        if cpu_ids != self.cpu_ids:
+            # cpus were added or removed, the rows do not match the previous
+            # read so start over
+            self.cpu_ids = cpu_ids
+            old_values = self.values
+        self._set_deltas(old_values, old_context_switches)
+
+    def _set_deltas(self, old_values, old_context_switches):
+        w = self.width
+        scale = self.scale
+        deltas = [d * scale for d in map(sub, self.values, old_values)]
+        self.per_cpu_counters = [[cpu] + deltas[(r + 1) * w:(r + 2) * w]
+                                 for r, cpu in enumerate(self.cpu_ids)]
+        self.global_cpu_counters = deltas[:w - 1]
+        self.global_cpu_counters.append(
+            (self.context_switches - old_context_switches) * scale)
+
+    def baseline(self):
+        """
+        :return: the counters of the last read, see CPUUsage.baseline
+        """
+        return self.cpu_ids, self.values, self.context_switches
+
+    def rebase(self, baseline):
+        """
+        Makes the deltas relative to an earlier read, unless the cpus
+        changed since.
+        :return: the state restore needs
+        """
+        state = self.values, self.per_cpu_counters, self.global_cpu_counters
+        cpu_ids, values, context_switches = baseline
+        if cpu_ids == self.cpu_ids:
+            self._set_deltas(values, context_switches)
+        return state
+
+    def restore(self, state):
+        values, per_cpu_counters, global_cpu_counters = state
+        if self.values is values:
+            self.per_cpu_counters = per_cpu_counters
+            self.global_cpu_counters = global_cpu_counters
+
+
 class CPUUsage:
     INSTANCE = None
 
     @staticmethod
-    def initialize(historesis=0):
+    def initialize(historesis=0, projected_window=None):
         """
         :param historesis the rate of historesis
+        :param projected_window: project the usage by the EWMA of this
+        window of the statistics engine (secs) rather than by historesis
         initialize the CPU usage object if one is not running yet.
 
         return True if the CPU usage object was initialized successfully,
@@ -281,33 +450,77 @@ class CPUUsage:
         """
         if CPUUsage.INSTANCE is not None:
             return False
-        CPUUsage.INSTANCE = CPUUsage(historesis=historesis)
+        CPUUsage.INSTANCE = CPUUsage(historesis=historesis,
+                                     projected_window=projected_window)
         return True
 
-    def __init__(self, historesis=0.0):
+    @staticmethod
+    def usage_key(cpu):
+        """
+        :return: the statistics engine key of the usage of a cpu
+        """
+        return "cpu", cpu, "usage"
+
+    @staticmethod
+    def softirq_key(cpu):
+        return "cpu", cpu, "softirq"
+
+    @staticmethod
+    def net_softirq_key(cpu):
+        return "cpu", cpu, "net_softirq"
+
+    def __init__(self, historesis=0.0, projected_window=None):
         # gets both user and kernel cpu ticks.
-        self.current = CPUStatCounter() # CPUStatCounterRaw()
+        self.current = CPUStatCounterProc()  # CPUStatCounter()
+        # CPUStatCounterRaw()
         self.projected = {c[0]: 0 for c in self.current.per_cpu_counters}
         self.softirqs = {c[0]: 0 for c in self.current.per_cpu_counters}
+        # the ratio of a core spent in network softirqs
+        self.net_softirqs = {c[0]: 0 for c in self.current.per_cpu_counters}
+        self.softirq_counter = SoftirqCounter()
         self.interrups_counters = IRQCounter(len(self.current.per_cpu_counters))
 
         self.uptime = UpTimeCounterRaw()  # UpTimeCounter()
         self.historesis = historesis
+        self.projected_window = float(projected_window) \
+            if projected_window is not None else None
+        # the per cpu usage and softirqs over time windows
+        StatsEngine.initialize()
+        self.stats = StatsEngine.INSTANCE
+        # the time of the last update, in jiffies
+        self.ticks = 0.0
+        # the number of updates, to tell if a rebased state was updated
+        self.updates = 0
 
     def update(self):
         self.uptime.update()
         self.current.update()
+        self.softirq_counter.update()
 
         h = self.historesis
         # logging.info(self.uptime.up_time_diff)
-        t_diff = float(self.uptime.up_time_diff)
+        t_diff = self.ticks = float(self.uptime.up_time_diff)
+        self.updates += 1
         # logging.info(t_diff)
 
+        stats = self.stats
+        stats.tick()
         for c in self.current.per_cpu_counters:
             # logging.info(str(c))
-            self.projected[c[0]] = self.projected[c[0]] * h + \
-                (1.0 - h) * (1.0 - float(c[self.current.idle]) / t_diff)
-            self.softirqs[c[0]] = float(c[self.current.softirq]) / float(t_diff)
+            cpu = c[0]
+            usage = 1.0 - float(c[self.current.idle]) / t_diff
+            stats.add(CPUUsage.usage_key(cpu), usage)
+            if self.projected_window is not None:
+                self.projected[cpu] = stats.ewma(CPUUsage.usage_key(cpu),
+                                                 self.projected_window)
+            else:
+                self.projected[cpu] = \
+                    self.projected.get(cpu, 0) * h + (1.0 - h) * usage
+            self.softirqs[cpu] = float(c[self.current.softirq]) / float(t_diff)
+            self.net_softirqs[cpu] = self.softirqs[cpu] * \
+                self.softirq_counter.net_share(cpu)
+            stats.add(CPUUsage.softirq_key(cpu), self.softirqs[cpu])
+            stats.add(CPUUsage.net_softirq_key(cpu), self.net_softirqs[cpu])
 
         # for c in self.current.per_cpu_counters[:7]:
         #     cpu_usage_str = "%s: " % (c[0],)
@@ -324,25 +537,62 @@ class CPUUsage:
         self.interrups_counters.update()
         # logging.info("5")
 
+    def baseline(self):
+        """
+        :return: the uptime and the /proc/stat and interrupt counters of the
+        last update, so a consumer that runs every few updates sees the time
+        and the counters since its previous run on the same time base as
+        the vhost counters (see VhostLight.baseline)
+        """
+        return (self.uptime.up_time, self.current.baseline(),
+                self.interrups_counters.interrupts)
+
+    def rebase(self, baseline):
+        """
+        Makes get_ticks, the /proc/stat counters and the interrupts relative
+        to a baseline instead of the previous update, until restore. The
+        ratios (projected, softirqs) stay those of the last update.
+        :return: the state restore needs
+        """
+        up_time, current, interrupts = baseline
+        irqs = self.interrups_counters
+        state = (self.updates, self.ticks, self.current.rebase(current),
+                 irqs.interrupts_diff)
+        self.ticks = float(self.uptime.up_time - up_time)
+        irqs.interrupts_diff = [e - s for e, s in
+                                zip(irqs.interrupts, interrupts)]
+        return state
+
+    def restore(self, state):
+        """
+        Undoes a rebase, unless there was an update since.
+        """
+        updates, ticks, current, interrupts_diff = state
+        if self.updates != updates:
+            return
+        self.ticks = ticks
+        self.current.restore(current)
+        self.interrups_counters.interrupts_diff = interrupts_diff
+
     def get_min_used_cpu(self, requested_cpus):
         if not requested_cpus:
             return None
 
         # return next(iter(requested_cpus))
-        return min({k: v for k, v in self.projected.items()
-                    if k in requested_cpus},
-                   cmp=lambda x, y: x[1] - y[1])[0]
+        return min(requested_cpus, key=lambda c: self.projected.get(c, 0.0))
 
     def get_cpus_by_usage(self, requested_cpus):
+        """
+        :return: the requested cpus, least used first
+        """
         if not requested_cpus:
-            return None
+            return []
 
-        sorted_cpus = sorted({k: v for k, v in self.projected.items()
-                              if k in requested_cpus},
-                             cmp=lambda x, y: x[1] - y[1])
+        sorted_cpus = sorted(requested_cpus,
+                             key=lambda c: self.projected.get(c, 0.0))
         # logging.info("CPUUsage.get_cpus_by_usage: requested_cpus: %s, "
         #              "sorted_cpus: %s" % (requested_cpus, sorted_cpus))
-        return sorted_cpus.keys()
+        return sorted_cpus
 
     def get_empty_cpu(self, requested_cpus):
         if not requested_cpus:
@@ -363,13 +613,27 @@ class CPUUsage:
         return sum(v for k, v in self.softirqs.items()
                    if k in requested_cpus)
 
+    def get_net_softirq_cpu(self, cpu):
+        """
+        :return: the ratio of a core spent in network softirqs
+        """
+        return self.net_softirqs.get(cpu, 0.0)
+
+    def get_usage_stats(self, cpu, length=None):
+        """
+        :param length: the window length (secs), None for the shortest
+        :return: the Window of the usage of a cpu, None before the first
+        update
+        """
+        return self.stats.window(CPUUsage.usage_key(cpu), length)
+
     def get_interrupts(self, requested_cpus):
         return sum(self.interrups_counters[k] for k in requested_cpus)
 
     def get_ticks(self):
         # in jiffies rather then nano-seconds
         # logging.info(self.uptime.up_time_diff)
-        return float(self.uptime.up_time_diff)
+        return self.ticks
 
 
 def main():
@@ -389,6 +653,26 @@ def main():
     timer.checkpoint("CPUUsage.INSTANCE.update()")
     CPUUsage.INSTANCE.update()
     timer.checkpoint("CPUUsage.INSTANCE.update()")
+    timer.done()
+
+    benchmark_cpu_stat_counters()
+
+
+def benchmark_cpu_stat_counters(rounds=1000):
+    """
+    Compares the cost of an update of the /proc/stat counters through a
+    shell (CPUStatCounter) and through a kept open file (CPUStatCounterProc).
+    """
+    for counter_class in (CPUStatCounter, CPUStatCounterProc):
+        counter = counter_class()
+        timer = Timer("Timer %s" % (counter_class.__name__,))
+        for _ in xrange(rounds):
+            counter.update()
+        timer.checkpoint("%d x update()" % (rounds,))
+        timer.done()
+        logging.info("%s: cpus: %d, global counters: %s" %
+                     (counter_class.__name__, len(counter.per_cpu_counters),
+                      counter.global_cpu_counters))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,145 @@
+import time
+import errno
+import logging
+from multiprocessing.pool import ThreadPool
+
+from utils.vhost import vhost_write, vhost_read
+from utils.tick_scheduler import monotonic
+
+__author__ = 'eyalmo'
+
+DEFAULT_THREADS = 8
+DEFAULT_TIMEOUT = 10.0
+DEFAULT_INITIAL_BACKOFF = 0.001
+DEFAULT_MAX_BACKOFF = 0.1
+
+
+class DeviceMover:
+    """
+    Moves a batch of vhost devices between workers. A move writes the new
+    worker id to dev/<id>/worker, the write fails with an IOError while the
+    device is still in transfer from a previous move, and the move is
+    complete when dev/<id>/worker reads the new worker id.
+
+    The moves of different devices are independent, so they are issued
+    concurrently from a thread pool. A failed write is retried and the
+    completion is polled with an exponential backoff, until a timeout.
+    """
+    def __init__(self, threads=DEFAULT_THREADS, timeout=DEFAULT_TIMEOUT,
+                 initial_backoff=DEFAULT_INITIAL_BACKOFF,
+                 max_backoff=DEFAULT_MAX_BACKOFF):
+        """
+        :param threads: the number of moves issued at the same time
+        :param timeout: the time a single move may take, in seconds
+        :param initial_backoff: the first wait between two attempts
+        :param max_backoff: the longest wait between two attempts
+        """
+        self.threads = threads
+        self.timeout = timeout
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.pool = None
+
+    @staticmethod
+    def validate(moves, devices, workers):
+        """
+        Checks the whole change set before any device is moved.
+        :param moves: a dictionary of device id -> new worker id
+        :param devices: the vhost devices, by id
+        :param workers: the vhost workers, by id
+        :raise ValueError: if a device or a worker does not exist
+        """
+        errors = []
+        for dev_id, worker_id in moves.items():
+            if dev_id not in devices:
+                errors.append("unknown device %s" % (dev_id,))
+            if worker_id not in workers:
+                errors.append("device %s: unknown worker %s" %
+                              (dev_id, worker_id))
+        if errors:
+            raise ValueError("invalid device moves: %s" % (", ".join(errors),))
+
+    def _retry(self, attempt, deadline):
+        """
+        Calls attempt until it returns True, waiting with an exponential
+        backoff between the calls.
+        :return: True if attempt succeeded before the deadline
+        """
+        backoff = self.initial_backoff
+        while True:
+            if attempt():
+                return True
+            now = monotonic()
+            if now >= deadline:
+                return False
+            time.sleep(min(backoff, deadline - now))
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def _move_device(self, dev, worker_id):
+        """
+        :return: None if the device moved, otherwise the reason it did not
+        """
+        deadline = monotonic() + self.timeout
+        errors = []
+
+        def write():
+            try:
+                vhost_write(dev, "worker", worker_id)
+                return True
+            except IOError as e:
+                if e.errno == errno.ENOENT:
+                    # the device or the worker is gone
+                    raise
+                # the device is still in transfer
+                errors.append(e)
+                return False
+
+        def moved():
+            return vhost_read(dev, "worker").strip() == worker_id
+
+        try:
+            if not self._retry(write, deadline):
+                return "write timed out after %d attempts: %s" % \
+                    (len(errors), errors[-1])
+            if not self._retry(moved, deadline):
+                return "move did not complete in %.1f seconds" % \
+                    (self.timeout,)
+        except (IOError, OSError) as e:
+            return str(e)
+        return None
+
+    def move(self, moves, devices, workers):
+        """
+        Validates the change set and moves the devices.
+        :param moves: a dictionary of device id -> new worker id
+        :param devices: the vhost devices, by id
+        :param workers: the vhost workers, by id
+        :return: a dictionary of device id -> the reason of the failure, of
+        the devices that did not move
+        """
+        DeviceMover.validate(moves, devices, workers)
+        if not moves:
+            return {}
+
+        dev_ids = list(moves.keys())
+        args = [(devices[dev_id], moves[dev_id]) for dev_id in dev_ids]
+        if len(args) == 1 or self.threads <= 1:
+            results = [self._move_device(*a) for a in args]
+        else:
+            if self.pool is None:
+                self.pool = ThreadPool(self.threads)
+            results = self.pool.map(lambda a: self._move_device(*a), args)
+
+        failures = {dev_id: reason
+                    for dev_id, reason in zip(dev_ids, results)
+                    if reason is not None}
+        for dev_id, reason in failures.items():
+            logging.warning("device %s was not moved to worker %s: %s" %
+                            (dev_id, moves[dev_id], reason))
+        return failures
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
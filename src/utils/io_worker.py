@@ -1,5 +1,5 @@
-from utils.affinity_entity import Thread, \
-    parse_cpu_mask_from_cpu_list
+from utils.affinity_entity import Thread
+from utils.cpu_set import CPUSet
 from utils.vhost import Vhost, vhost_read
 
 __author__ = 'eyalmo'
@@ -13,9 +13,7 @@ class IOWorker(Thread):
         workers = Vhost.INSTANCE.workers
         self.pid = int(vhost_read(workers[self.id], "pid"))
         # only works dif there is only one cpu and it is an integer
-        cpu_mask = 1 << self.cpu
-
-        Thread.__init__(self, self.pid, 0, cpu_mask)
+        Thread.__init__(self, self.pid, 0, CPUSet([self.cpu]))
 
     def __str__(self):
         return "id: %s, cpus: %s" % (self.id, self.cpu)
@@ -1,34 +1,66 @@
+import sys
+import heapq
+import bisect
+import random
+import logging
+
+from utils.tick_scheduler import monotonic
+
 __author__ = 'eyalmo'
 
+LPT = "lpt"
+KARMARKAR_KARP = "kk"
+
+DEFAULT_MAX_ROUNDS = 64
+# the number of bins the local search tries swaps with in every round
+SWAP_BINS = 4
+# the most karmarkar-karp subsets a heavy bin stands for
+MAX_SUBSETS_PER_BIN = 8
+# the price of a free move or swap, so its gain still ranks it
+MIN_PRICE = 1e-9
+
 
 class Permutation:
-    # TODO: add dummy load with 0 that cannot be removed or added
+    """
+    A bin of a partition: its items and the sum of their loads.
+    """
     def __init__(self, loads):
-        self.loads = loads
-        self.sum = sum((load for _, load in loads), start=0)
+        """
+        :param loads: a dictionary of item id -> load
+        """
+        self.loads = dict(loads)
+        self.sum = sum(self.loads.values())
 
     def min(self):
-        l1_id, load1 = self.loads[-1]
-        return l1_id, load1, self.sum - load1
+        """
+        :return: the lightest item, its load and the sum of the rest
+        """
+        l_id = min(self.loads, key=lambda _id: self.loads[_id])
+        return l_id, self.loads[l_id], self.sum - self.loads[l_id]
 
     def max(self):
-        l1_id, load1 = self.loads[0]
-        return l1_id, load1, self.sum - load1
+        """
+        :return: the heaviest item, its load and the sum of the rest
+        """
+        l_id = max(self.loads, key=lambda _id: self.loads[_id])
+        return l_id, self.loads[l_id], self.sum - self.loads[l_id]
 
     @staticmethod
     def get_best_swap(perm1, perm2, average):
-        def swap_value(load1, load2):
-            return abs(perm1.sum - load1 + load2 - average) + \
-                abs(perm2.sum - load2 + load1 - average) - \
-                abs(perm1.sum - average) - \
-                abs(perm2.sum - average)
-        best_id1, best_id2, best_value = perm1[0][0], perm2[-1][0], \
-            swap_value(perm1[1][1], perm2[1][1])
-        for l1_id, l1 in perm1.items():
-            for l2_id, l2 in perm2.items():
-                sv = swap_value(l1, l2)
-                if best_value < sv:
-                    best_id1, best_id2, best_value = l1_id, l2_id, sv
+        """
+        :return: the item of perm1 and the item of perm2 whose swap brings
+        the sums of the two closest to the average, and by how much (the
+        reduction of the total distance, 0 if no swap helps)
+        """
+        distance = abs(perm1.sum - average) + abs(perm2.sum - average)
+        best_id1, best_id2, best_value = None, None, 0
+        for l1_id, l1 in perm1.loads.items():
+            for l2_id, l2 in perm2.loads.items():
+                value = distance - \
+                    abs(perm1.sum - l1 + l2 - average) - \
+                    abs(perm2.sum - l2 + l1 - average)
+                if value > best_value:
+                    best_id1, best_id2, best_value = l1_id, l2_id, value
         return best_id1, best_id2, best_value
 
     def add(self, l_id, load):
@@ -36,40 +68,551 @@ class Permutation:
         self.sum += load
 
     def remove(self, l_id):
-        self.sum -= self.loads[l_id]
-        del self.loads[l_id]
+        self.sum -= self.loads.pop(l_id)
 
     def get_load(self, l_id):
         return self.loads[l_id]
 
 
-def distribute_equally(permutations, average=None):
-    if not average:
-        average = sum(p.sum for p in permutations) / len(permutations)
+def distribute_equally(permutations, max_rounds=DEFAULT_MAX_ROUNDS):
+    """
+    Moves and swaps items between the permutations (in place) to even their
+    sums.
+    :param permutations: a list of Permutation
+    :param max_rounds: the maximum number of moves and swaps
+    """
+    items = {}
+    assignment = {}
+    for idx, p in enumerate(permutations):
+        for l_id, load in p.loads.items():
+            items[l_id] = load
+            assignment[l_id] = idx
+
+    bins = range(len(permutations))
+    balanced = local_search(items, assignment, bins, max_rounds=max_rounds)
+    for l_id, idx in balanced.items():
+        if idx == assignment[l_id]:
+            continue
+        permutations[assignment[l_id]].remove(l_id)
+        permutations[idx].add(l_id, items[l_id])
+
+
+def _bin_weights(bins, weights):
+    if weights is None:
+        return {b: 1.0 for b in bins}
+    return {b: float(weights.get(b, 1.0)) for b in bins}
+
+
+def partition_loads(items, assignment, bins):
+    """
+    :param items: a dictionary of item -> load
+    :param assignment: a dictionary of item -> bin
+    :param bins: the bin ids
+    :return: a dictionary of bin -> the sum of the loads of its items
+    """
+    loads = {b: 0 for b in bins}
+    for item, b in assignment.items():
+        loads[b] += items[item]
+    return loads
+
+
+def imbalance(items, assignment, bins, weights=None):
+    """
+    :return: the ratio between the (weighted) load of the most loaded bin and
+    the average, minus 1
+    """
+    weights = _bin_weights(bins, weights)
+    loads = partition_loads(items, assignment, bins)
+    average = float(sum(loads.values())) / sum(weights.values())
+    if average <= 0:
+        return 0.0
+    return max(loads[b] / weights[b] for b in bins) / average - 1
+
+
+def count_moves(assignment, origin):
+    """
+    :return: the number of items of origin that are on another bin in
+    assignment
+    """
+    return sum(1 for item, b in assignment.items()
+               if item in origin and origin[item] != b)
+
+
+def lpt_partition(items, bins, assignment=None, weights=None, pinned=None):
+    """
+    Longest processing time first: places the items that are not assigned
+    yet, heaviest first, each in the bin it loads the least.
+    :param items: a dictionary of item -> load
+    :param bins: the bin ids
+    :param assignment: a dictionary of item -> bin of the items that keep
+    their bin, items of bins that are not in bins are placed again
+    :param weights: a dictionary of bin -> capacity, a bin of weight 2 takes
+    twice the load of a bin of weight 1. None for equal bins
+    :param pinned: a dictionary of item -> bin of items that must stay in
+    their bin
+    :return: a dictionary of item -> bin of all the items
+    """
+    bin_set = set(bins)
+    placed = {item: b for item, b in (assignment or {}).items()
+              if item in items and b in bin_set}
+    placed.update(pinned or {})
+    loads = partition_loads(items, placed, bins)
+    unplaced = sorted((i for i in items if i not in placed),
+                      key=lambda i: -items[i])
+
+    if weights is None:
+        heap = [(load, b) for b, load in loads.items()]
+        heapq.heapify(heap)
+        for item in unplaced:
+            load, b = heapq.heappop(heap)
+            placed[item] = b
+            heapq.heappush(heap, (load + items[item], b))
+        return placed
+
+    weights = _bin_weights(bins, weights)
+    for item in unplaced:
+        load = items[item]
+        b = min(bins, key=lambda _b: (loads[_b] + load) / weights[_b])
+        placed[item] = b
+        loads[b] += load
+    return placed
+
+
+def _flatten(tree):
+    # a karmarkar-karp subset is None when it is empty, an item id in a
+    # list, or a pair of subsets
+    items = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if node is None:
+            continue
+        if isinstance(node, tuple):
+            stack.extend(node)
+        else:
+            items.extend(node)
+    return items
+
+
+def karmarkar_karp(items, k):
+    """
+    The multiway largest differencing method: every item starts as a
+    partition of k subsets with the item alone in one of them. The two
+    partitions with the largest difference between their heaviest and
+    lightest subsets are merged, the heaviest subset of one with the
+    lightest of the other, until a single partition is left.
+    :param items: a dictionary of item -> load
+    :param k: the number of subsets
+    :return: a list of k lists of items, heaviest first
+    """
+    if not items:
+        return [[] for _ in xrange(k)]
+
+    empty_sums = [0] * (k - 1)
+    empty_subsets = [None] * (k - 1)
+    heap = []
+    for count, (item, load) in enumerate(items.items()):
+        # (-difference, tie breaker, sums heaviest first, subsets)
+        heap.append((-load, count, [load] + empty_sums,
+                     [[item]] + empty_subsets))
+    heapq.heapify(heap)
+    count = len(heap)
+
+    indices = range(k)
+    while len(heap) > 1:
+        _, _, sums1, subsets1 = heapq.heappop(heap)
+        _, _, sums2, subsets2 = heapq.heappop(heap)
+        sums2 = sums2[::-1]
+        subsets2 = subsets2[::-1]
+        sums = [s1 + s2 for s1, s2 in zip(sums1, sums2)]
+        subsets = [s1 if s2 is None else s2 if s1 is None else (s1, s2)
+                   for s1, s2 in zip(subsets1, subsets2)]
+        order = sorted(indices, key=sums.__getitem__, reverse=True)
+        sums = [sums[i] for i in order]
+        subsets = [subsets[i] for i in order]
+        count += 1
+        heapq.heappush(heap, (sums[-1] - sums[0], count, sums, subsets))
+
+    _, _, _, subsets = heap[0]
+    return [_flatten(subset) for subset in subsets]
+
+
+def kk_partition(items, bins, assignment=None, weights=None, pinned=None):
+    """
+    Divides the items that are not pinned with karmarkar_karp, then gives
+    every subset a bin.
+
+    With weights, every bin stands for a number of subsets by its weight
+    (in units of the lightest bin, up to MAX_SUBSETS_PER_BIN). With pinned
+    items or weights the subsets are placed heaviest first on the bins they
+    load the least, otherwise every subset goes to the bin that holds most
+    of its items in assignment, to keep the moves few.
+    :return: a dictionary of item -> bin of all the items
+    """
+    pinned = pinned or {}
+    assignment = assignment or {}
+    k = len(bins)
+    if weights is not None:
+        weights = _bin_weights(bins, weights)
+        unit = min(weights.values())
+        k = sum(min(max(int(round(w / unit)), 1), MAX_SUBSETS_PER_BIN)
+                for w in weights.values())
+    subsets = karmarkar_karp({i: l for i, l in items.items()
+                              if i not in pinned}, k)
+
+    if pinned or weights is not None:
+        subset_loads = {idx: sum(items[i] for i in subset)
+                        for idx, subset in enumerate(subsets)}
+        # the pinned items take part as subsets that are already placed
+        pinned_subsets = {("pinned", item): b for item, b in pinned.items()}
+        subset_loads.update({("pinned", item): items[item]
+                             for item in pinned.keys()})
+        subset_bins = lpt_partition(subset_loads, bins, pinned_subsets,
+                                    weights)
+        placed = dict(pinned)
+        for idx, subset in enumerate(subsets):
+            for item in subset:
+                placed[item] = subset_bins[idx]
+        return placed
 
-    permutations = sorted(permutations, key=lambda x: x.sum)
-    high = permutations[0].sum
-    low = permutations[-1].sum
+    placed = {}
+    # (common items, subset index, bin), most common first
+    overlaps = []
+    for idx, subset in enumerate(subsets):
+        common = {}
+        for item in subset:
+            b = assignment.get(item)
+            if b is not None:
+                common[b] = common.get(b, 0) + 1
+        overlaps.extend((n, idx, b) for b, n in common.items())
+    overlaps.sort(reverse=True)
 
-    best_value = 1
-    while best_value > 0:
-        best_p1, best_id1, best_p2, best_id2 = None, None, None, None
-        best_value = 0
+    subset_bins = {}
+    used = set()
+    for _, idx, b in overlaps:
+        if idx in subset_bins or b in used or b not in bins:
+            continue
+        subset_bins[idx] = b
+        used.add(b)
+    free = [b for b in bins if b not in used]
+    for idx in xrange(len(subsets)):
+        if idx not in subset_bins:
+            subset_bins[idx] = free.pop(0)
 
-        for high_p in permutations:
-            if high_p.sum != high:
+    for idx, subset in enumerate(subsets):
+        for item in subset:
+            placed[item] = subset_bins[idx]
+    return placed
+
+
+def local_search(items, assignment, bins, max_rounds=DEFAULT_MAX_ROUNDS,
+                 weights=None, pinned=None, origin=None, max_moves=None,
+                 costs=None, target_imbalance=None):
+    """
+    Lowers the load of the most loaded bin by moving one of its items to
+    another bin, or swapping it with a lighter item of another bin. Every
+    round applies the single move or swap that leaves the lowest maximum of
+    the two bins (or with costs, that lowers the most loaded bin the most
+    per cost), until no move helps or the target imbalance is reached.
+
+    The items of every bin are kept sorted by load, so the best partner of
+    an item is found by bisection, and the bins are visited by the best
+    split they can reach with the most loaded bin, until no bin can improve
+    on the best candidate.
+
+    With a target imbalance, the items that moved are then returned to
+    their origin bin, most expensive first, as long as the target still
+    holds, so the change set is not larger than needed.
+    :param items: a dictionary of item -> load
+    :param assignment: a dictionary of item -> bin of all the items
+    :param bins: the bin ids
+    :param max_rounds: the maximum number of moves and swaps
+    :param weights: a dictionary of bin -> capacity, None for equal bins
+    :param pinned: items that must stay in their bin
+    :param origin: a dictionary of item -> bin the moves are counted
+    against, by default assignment
+    :param max_moves: the maximum number of items that may end up on a bin
+    other than their origin bin, None for no limit
+    :param costs: a dictionary of item -> the cost of moving it from its
+    origin bin, None to minimize the maximum load regardless of the costs
+    :param target_imbalance: stop when the most loaded bin is above the
+    average by at most this ratio, None to balance as much as possible
+    :return: a new dictionary of item -> bin
+    """
+    origin = dict(assignment) if origin is None else origin
+    assignment = dict(assignment)
+    pinned = pinned or {}
+    weights = _bin_weights(bins, weights)
+    loads = partition_loads(items, assignment, bins)
+    # bin -> a sorted list of (load, item) of the items that may move
+    members = {b: [] for b in bins}
+    for item, b in assignment.items():
+        if item not in pinned:
+            members[b].append((items[item], item))
+    for m in members.values():
+        m.sort()
+    moves = count_moves(assignment, origin)
+
+    target_max = None
+    if target_imbalance is not None:
+        target_max = (1 + target_imbalance) * \
+            sum(loads.values()) / sum(weights.values())
+
+    def move_cost(item, src, dst):
+        # moving an item away from its origin bin costs a move, moving it
+        # back refunds one
+        b = origin.get(item)
+        return (b == src) - (b == dst)
+
+    def move_price(item, src, dst):
+        return move_cost(item, src, dst) * costs.get(item, 1.0)
+
+    for _ in xrange(max_rounds):
+        high = max(bins, key=lambda _b: loads[_b] / weights[_b])
+        high_load = loads[high]
+        high_weight = weights[high]
+        high_norm = high_load / high_weight
+        high_members = members[high]
+        if target_max is not None and high_norm <= target_max:
+            break
+
+        def consider(b, diff, item, other, best):
+            """
+            :return: the candidate of passing diff from high to b, if it is
+            better than best, None otherwise
+            """
+            new_max = max((high_load - diff) / high_weight,
+                          (loads[b] + diff) / weights[b])
+            if new_max >= high_norm:
+                return None
+            key = new_max
+            if costs is not None:
+                gain = high_norm - max(new_max, target_max or 0)
+                price = move_price(item, high, b)
+                if other is not None:
+                    price += move_price(other, b, high)
+                # items that return to their origin bin are free
+                key = -gain / max(price, MIN_PRICE)
+            if best is not None and key >= best[0]:
+                return None
+            cost = move_cost(item, high, b)
+            if other is not None:
+                cost += move_cost(other, b, high)
+            if max_moves is not None and moves + cost > max_moves:
+                return None
+            return key, item, other, b, cost
+
+        # (the candidate key, lower is better, item, swapped item, bin, the
+        # change in moves)
+        best = None
+        # (the best maximum a perfect split with high can reach, the load to
+        # pass from high for that split, bin), best first
+        splits = []
+        for b in bins:
+            load, weight = loads[b], weights[b]
+            target = (high_load * weight - load * high_weight) / \
+                (high_weight + weight)
+            if b != high and target > 0:
+                splits.append(((high_load + load) / (high_weight + weight),
+                               target, b))
+        splits.sort()
+
+        # moves: the item of high closest to the target of every bin
+        for _, target, b in splits:
+            idx = bisect.bisect_left(high_members, (target,))
+            for i in (idx - 1, idx):
+                if 0 <= i < len(high_members):
+                    item_load, item = high_members[i]
+                    best = consider(b, item_load, item, None, best) or best
+
+        # swaps, with the bins of the best bounds only: every item of the
+        # shorter of the two bins with the item of the other bin that brings
+        # the difference closest to the target
+        for bound, target, b in splits[:SWAP_BINS]:
+            # neither this bin nor the next ones can beat best
+            if costs is None and best is not None and bound >= best[0]:
                 break
-            for low_p in reversed(permutations):
-                if low_p.sum != low:
-                    break
+            b_members = members[b]
+            if len(high_members) <= len(b_members):
+                for item_load, item in high_members:
+                    idx = bisect.bisect_left(b_members,
+                                             (item_load - target,))
+                    for i in (idx - 1, idx):
+                        if 0 <= i < len(b_members):
+                            other_load, other = b_members[i]
+                            if other_load < item_load:
+                                best = consider(b, item_load - other_load,
+                                                item, other, best) or best
+            else:
+                for other_load, other in b_members:
+                    idx = bisect.bisect_left(high_members,
+                                             (other_load + target,))
+                    for i in (idx - 1, idx):
+                        if 0 <= i < len(high_members):
+                            item_load, item = high_members[i]
+                            if other_load < item_load:
+                                best = consider(b, item_load - other_load,
+                                                item, other, best) or best
+        if best is None:
+            break
+
+        _, item, other, b, cost = best
+        moves += cost
+        item_load = items[item]
+        high_members.remove((item_load, item))
+        bisect.insort(members[b], (item_load, item))
+        assignment[item] = b
+        diff = item_load
+        if other is not None:
+            other_load = items[other]
+            members[b].remove((other_load, other))
+            bisect.insort(high_members, (other_load, other))
+            assignment[other] = high
+            diff -= other_load
+        loads[high] -= diff
+        loads[b] += diff
+
+    if target_max is None:
+        return assignment
+
+    # return the moves the target does not need, the most expensive first
+    moved = [item for item, b in assignment.items()
+             if item in origin and origin[item] != b and item not in pinned]
+    if costs is not None:
+        moved.sort(key=lambda i: -costs.get(i, 1.0))
+    for item in moved:
+        src, dst = assignment[item], origin[item]
+        limit = max(target_max, max(loads[b] / weights[b] for b in bins))
+        if (loads[dst] + items[item]) / weights[dst] > limit:
+            continue
+        assignment[item] = dst
+        loads[src] -= items[item]
+        loads[dst] += items[item]
+    return assignment
+
+
+def partition(items, bins, assignment=None, method=LPT, weights=None,
+              pinned=None, max_moves=None, max_rounds=DEFAULT_MAX_ROUNDS,
+              costs=None, target_imbalance=None):
+    """
+    Divides the items between the bins so the (weighted) load of the most
+    loaded bin is low, moving few items from their current bins.
+
+    LPT keeps the assigned items in place and places the rest. Karmarkar-
+    Karp divides all the items that are not pinned again, it is used only
+    when it moves at most max_moves items. Both are refined with a local
+    search that keeps the total moves within max_moves.
+    :param items: a dictionary of item -> load
+    :param bins: the bin ids
+    :param assignment: a dictionary of item -> the current bin of the item,
+    items without a bin (or with a bin that is not in bins) are placed
+    anyway and are not counted as moves
+    :param method: LPT or KARMARKAR_KARP
+    :param weights: a dictionary of bin -> capacity, None for equal bins
+    :param pinned: a dictionary of item -> bin of items that must stay in
+    their bin
+    :param max_moves: the maximum number of items moved from their current
+    bin, None for no limit
+    :param max_rounds: the maximum number of local search moves and swaps
+    :param costs: a dictionary of item -> the cost of moving it, to find
+    the cheapest change set that reaches the target imbalance
+    :param target_imbalance: balance only until the most loaded bin is
+    above the average by at most this ratio, None to balance as much as
+    possible
+    :return: a dictionary of item -> bin of all the items
+    """
+    bin_set = set(bins)
+    origin = {item: b for item, b in (assignment or {}).items()
+              if item in items and b in bin_set}
+    pinned = pinned or {}
+
+    initial = lpt_partition(items, bins, origin, weights, pinned)
+    if method == KARMARKAR_KARP:
+        kk = kk_partition(items, bins, origin, weights, pinned)
+        if max_moves is None or count_moves(kk, origin) <= max_moves:
+            initial = kk
+
+    return local_search(items, initial, bins, max_rounds=max_rounds,
+                        weights=weights, pinned=pinned, origin=origin,
+                        max_moves=max_moves, costs=costs,
+                        target_imbalance=target_imbalance)
+
+
+def check_partition(items, bins, result, assignment=None, pinned=None,
+                    max_moves=None):
+    assert set(result.keys()) == set(items.keys()), "items lost or added"
+    assert set(result.values()) <= set(bins), "an item is on an unknown bin"
+    for item, b in (pinned or {}).items():
+        assert result[item] == b, "pinned item %s moved" % (item,)
+    if max_moves is not None:
+        origin = {i: b for i, b in (assignment or {}).items()
+                  if b in set(bins)}
+        assert count_moves(result, origin) <= max_moves, "too many moves"
+
+
+def benchmark_partition(sizes=((100, 4), (1000, 16), (5000, 48)),
+                        rounds=10):
+    """
+    Times every method on random loads, starting from a random assignment
+    (or from no assignment), and checks the results.
+    """
+    rand = random.Random(0)
+    for n, k in sizes:
+        items = {i: rand.expovariate(1.0) for i in xrange(n)}
+        bins = ["w.%d" % (b,) for b in xrange(k)]
+        assignment = {i: rand.choice(bins) for i in items}
+        pinned = {i: assignment[i] for i in rand.sample(items.keys(), n / 20)}
+        weights = {b: rand.choice((1.0, 2.0)) for b in bins}
+        max_moves = n / 10
+        costs = {i: rand.choice((1.0, 10.0)) for i in items}
+
+        logging.info("items: %d, bins: %d, initial imbalance: %.4f" %
+                     (n, k, imbalance(items, assignment, bins)))
+        for title, kwargs in (
+                ("lpt", {"method": LPT}),
+                ("lpt from scratch", {"method": LPT, "assignment": None}),
+                ("kk", {"method": KARMARKAR_KARP}),
+                ("lpt, pinned, weights",
+                 {"method": LPT, "pinned": pinned, "weights": weights}),
+                ("lpt from scratch, pinned, weights",
+                 {"method": LPT, "assignment": None, "pinned": pinned,
+                  "weights": weights}),
+                ("kk, pinned, weights",
+                 {"method": KARMARKAR_KARP, "pinned": pinned,
+                  "weights": weights}),
+                ("lpt, max moves %d" % (max_moves,),
+                 {"method": LPT, "max_moves": max_moves}),
+                ("kk, max moves %d" % (max_moves,),
+                 {"method": KARMARKAR_KARP, "max_moves": max_moves}),
+                ("lpt, target 0.05",
+                 {"method": LPT, "target_imbalance": 0.05}),
+                ("lpt, target 0.05, costs",
+                 {"method": LPT, "target_imbalance": 0.05,
+                  "costs": costs})):
+            current = kwargs.pop("assignment", assignment)
+            start = monotonic()
+            for _ in xrange(rounds):
+                result = partition(items, bins, current, **kwargs)
+            elapsed = (monotonic() - start) / rounds
+
+            check_partition(items, bins, result, current,
+                            kwargs.get("pinned"), kwargs.get("max_moves"))
+            logging.info("  %-34s %8.3f ms, imbalance: %.4f, moves: %d, "
+                         "cost: %d" %
+                         (title, elapsed * 1000,
+                          imbalance(items, result, bins,
+                                    kwargs.get("weights")),
+                          count_moves(result, assignment),
+                          sum(costs[i] for i, b in result.items()
+                              if b != assignment[i])))
+
+
+def main():
+    log_format = "[%(filename)s:%(lineno)s] %(message)s"
+    logging.basicConfig(stream=sys.stdout, format=log_format,
+                        level=logging.INFO)
+    benchmark_partition()
 
-                id1, id2, value = Permutation.get_best_swap(high_p, low_p,
-                                                            average)
-                if value > best_value:
-                    best_p1, best_id1, best_p2,  = high_p, id1, low_p
-                    best_id2, best_value = id2, value
-        best_p1.add(id2, best_p2.get_load(best_id2))
-        best_p2.add(id1, best_p1.get_load(best_id1))
 
-        best_p1.remove(id1)
-        best_p2.remove(id2)
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import logging
+
+__author__ = 'eyalmo'
+
+
+class Phase:
+    def __init__(self, name, func, period_ticks=1, priority=0,
+                 skippable=False):
+        """
+        :param name: the phase name, as it appears in the configuration
+        :param func: called with the tick number when the phase is due
+        :param period_ticks: run the phase every that many ticks
+        :param priority: phases due in the same tick run in ascending
+        priority
+        :param skippable: skip the phase when the tick is over its budget
+        """
+        self.name = name
+        self.func = func
+        self.period_ticks = max(int(period_ticks), 1)
+        self.priority = priority
+        self.skippable = skippable
+
+        self.runs = 0
+        self.skips = 0
+        # the counters baseline at the end of the last run
+        self.baseline = None
+
+    def is_due(self, tick):
+        return tick % self.period_ticks == 0
+
+    def __str__(self):
+        return "%s: period: %d ticks, priority: %d, skippable: %s, " \
+               "runs: %d, skips: %d" % \
+               (self.name, self.period_ticks, self.priority, self.skippable,
+                self.runs, self.skips)
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__, self.__str__())
+
+
+class PhaseScheduler:
+    """
+    Runs the phases of the control loop at different rates on top of a
+    TickScheduler: every phase runs every period_ticks base ticks. The
+    counters are sampled once per tick, and only in ticks in which some
+    phase is due, so all the phases of a tick share the same sample.
+
+    The deltas of the shared counters are relative to the previous sample,
+    so a phase with a longer period runs with all the counters rebased on
+    its own baseline (taken at the end of its previous run) and sees the
+    deltas, and the elapsed time, over its whole period, including the runs
+    it skipped.
+    """
+    def __init__(self, tick_scheduler, sample, counters=()):
+        """
+        :param tick_scheduler: the TickScheduler of the base tick
+        :param sample: refreshes the shared counters, called once before
+        the phases of a tick
+        :param counters: the shared counters, each with baseline(), rebase()
+        and restore() (e.g. a VhostLight and the CPUUsage, so the deltas and
+        the time they are divided by cover the same period), empty to give
+        all the phases the deltas of the last sample
+        """
+        self.tick_scheduler = tick_scheduler
+        self.sample = sample
+        self.counters = list(counters)
+        self.phases = []
+
+    def add(self, name, func, period=None, priority=0, skippable=False):
+        """
+        :param period: the phase period in seconds, rounded to a multiple of
+        the base tick. None runs the phase every tick
+        """
+        interval = self.tick_scheduler.interval
+        period_ticks = 1 if period is None else \
+            int(round(float(period) / interval))
+        if period is not None and abs(period_ticks * interval - period) > \
+                interval / 2:
+            logging.warning("phase %s: period %s is not a multiple of the "
+                            "interval %s" % (name, period, interval))
+        self.phases.append(Phase(name, func, period_ticks, priority,
+                                 skippable))
+        self.phases.sort(key=lambda p: p.priority)
+
+    def configure(self, phases_info, defaults):
+        """
+        Adds the phases by their configuration.
+        :param phases_info: a dictionary of phase name -> {"period": secs,
+        "priority": int, "skippable": bool}, may be partial
+        :param defaults: a list of (name, func, priority, skippable) with the
+        default settings of every phase
+        """
+        for name, func, priority, skippable in defaults:
+            info = phases_info.get(name, {})
+            period = float(info["period"]) if "period" in info else None
+            priority = int(info.get("priority", priority))
+            skippable = str(info.get("skippable", skippable)).lower() in \
+                ("true", "1", "yes")
+            self.add(name, func, period=period, priority=priority,
+                     skippable=skippable)
+        for phase in self.phases:
+            logging.info("phase %s" % (phase,))
+
+    def run(self):
+        """
+        Waits for the next tick and runs the phases that are due.
+        :return: the tick number
+        """
+        tick = self.tick_scheduler.wait()
+        due = [p for p in self.phases if p.is_due(tick)]
+        if not due:
+            return tick
+
+        self.sample()
+        for phase in due:
+            if phase.skippable and self.tick_scheduler.over_budget():
+                phase.skips += 1
+                continue
+            self._run_phase(phase, tick)
+            phase.runs += 1
+        return tick
+
+    def _run_phase(self, phase, tick):
+        counters = self.counters
+        if not counters or phase.period_ticks == 1:
+            phase.func(tick)
+            return
+
+        states = [c.rebase(b) for c, b in zip(counters, phase.baseline)] \
+            if phase.baseline is not None else []
+        try:
+            phase.func(tick)
+        finally:
+            for c, state in reversed(zip(counters, states)):
+                c.restore(state)
+        phase.baseline = [c.baseline() for c in counters]
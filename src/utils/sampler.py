@@ -0,0 +1,184 @@
+import logging
+import threading
+from array import array
+
+from vhost_raw import Snapshot
+
+from utils.get_cycles.get_cycles import Cycles
+from utils.counter_store import CounterStore
+from utils.tick_scheduler import TickScheduler
+from utils.vhost_light import VHOST_WORKER_FIELDS
+
+__author__ = 'eyalmo'
+
+DEFAULT_SAMPLE_INTERVAL = 0.01
+DEFAULT_RING_SIZE = 1024
+
+
+class RingBuffer:
+    """
+    The last size samples of a metric, in a preallocated array.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.values = array('d', [0.0]) * size
+        # the number of samples ever appended
+        self.count = 0
+
+    def append(self, value):
+        self.values[self.count % self.size] = value
+        self.count += 1
+
+    def since(self, cursor):
+        """
+        :param cursor: a sample count returned by an earlier call
+        :return: the samples appended since the cursor (at most size of
+        them) and the new cursor
+        """
+        n = min(self.count - cursor, self.size)
+        start = (self.count - n) % self.size
+        end = start + n
+        if end <= self.size:
+            samples = self.values[start:end].tolist()
+        else:
+            samples = self.values[start:].tolist() + \
+                self.values[:end - self.size].tolist()
+        return samples, self.count
+
+
+class WindowStats:
+    """
+    The aggregation of the samples of a window.
+    """
+    def __init__(self, samples):
+        self.count = len(samples)
+        if not samples:
+            self.mean = self.p95 = self.max = 0.0
+            return
+        ordered = sorted(samples)
+        self.mean = sum(ordered) / len(ordered)
+        self.p95 = ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)]
+        self.max = ordered[-1]
+
+    def __str__(self):
+        return "count: %d, mean: %.3f, p95: %.3f, max: %.3f" % \
+               (self.count, self.mean, self.p95, self.max)
+
+
+class VhostProbe:
+    """
+    Samples the vhost workers through a snapshot of its own, built from the
+    raw objects of a VhostLight. Only the workers are copied, the virtual
+    queues are not sampled.
+    """
+    metrics = ("work_ratio",)
+
+    def __init__(self, vhost_light):
+        self.vhost_light = vhost_light
+        self.generation = None
+        self.snapshot = None
+        self.worker_ids = []
+        self.worker_stats = CounterStore(VHOST_WORKER_FIELDS)
+        self.last_cycles = None
+        Cycles.initialize()
+
+    def _register_snapshot(self):
+        light = self.vhost_light
+        self.worker_ids = list(light.worker_ids)
+        self.snapshot = Snapshot([light.workers[i] for i in self.worker_ids],
+                                 [], [])
+        self.generation = light.generation
+        self.last_cycles = None
+
+    def sample(self):
+        """
+        :return: a dictionary of metric -> value, None if there is no sample
+        this time (e.g. the workers are being changed)
+        """
+        light = self.vhost_light
+        with light.lock:
+            # the kernel objects must not go away while they are copied
+            if not light.snapshot_valid:
+                return None
+            if self.generation != light.generation:
+                self._register_snapshot()
+            self.snapshot.update()
+        cycles = Cycles.get_cycles()
+
+        self.worker_stats.load_buffer(self.worker_ids, self.snapshot.workers)
+        last_cycles, self.last_cycles = self.last_cycles, cycles
+        if last_cycles is None or cycles == last_cycles:
+            return None
+
+        cycles = float(cycles - last_cycles)
+        return {
+            # the number of io cores busy with work during the sample
+            "work_ratio":
+                sum(self.worker_stats.deltas("total_work_cycles")) / cycles
+        }
+
+
+class Sampler(threading.Thread):
+    """
+    Samples the probes in a background thread at a high rate into ring
+    buffers, the decision loop consumes aggregated windows of the samples
+    taken since its previous decision.
+    """
+    INSTANCE = None
+
+    @staticmethod
+    def initialize(probes, interval=DEFAULT_SAMPLE_INTERVAL,
+                   size=DEFAULT_RING_SIZE):
+        """
+        initialize and start the sampler if one is not running yet.
+
+        :return True if the sampler was initialized successfully, False
+        otherwise
+        """
+        if Sampler.INSTANCE is not None:
+            return False
+        Sampler.INSTANCE = Sampler(probes, interval=interval, size=size)
+        Sampler.INSTANCE.start()
+        return True
+
+    def __init__(self, probes, interval=DEFAULT_SAMPLE_INTERVAL,
+                 size=DEFAULT_RING_SIZE):
+        threading.Thread.__init__(self, name="sampler")
+        self.daemon = True
+        self.probes = probes
+        self.scheduler = TickScheduler(interval)
+        self.lock = threading.Lock()
+        self.buffers = {m: RingBuffer(size)
+                        for p in probes for m in p.metrics}
+        # metric -> the sample count of the last consumed window
+        self.cursors = {m: 0 for m in self.buffers.keys()}
+        self.running = True
+
+    def run(self):
+        while self.running:
+            self.scheduler.wait()
+            for probe in self.probes:
+                try:
+                    values = probe.sample()
+                except (IOError, OSError) as e:
+                    logging.warning("sampler: %s failed: %s" %
+                                    (probe.__class__.__name__, e))
+                    continue
+                if values is None:
+                    continue
+                with self.lock:
+                    for metric, value in values.items():
+                        self.buffers[metric].append(value)
+
+    def stop(self):
+        self.running = False
+
+    def consume(self, metric):
+        """
+        :return: the WindowStats of the samples of the metric taken since
+        the previous call
+        """
+        with self.lock:
+            samples, self.cursors[metric] = \
+                self.buffers[metric].since(self.cursors[metric])
+        return WindowStats(samples)
@@ -0,0 +1,151 @@
+import os
+import errno
+import logging
+import ctypes
+import ctypes.util
+
+__author__ = 'eyalmo'
+
+# the same default size as glibc's cpu_set_t, grown on hosts with more cpus
+_WORD_BITS = ctypes.sizeof(ctypes.c_ulong) * 8
+_MASK_WORDS = max(1024, os.sysconf("SC_NPROCESSORS_CONF")) // _WORD_BITS + 1
+_MASK_TYPE = ctypes.c_ulong * _MASK_WORDS
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                    use_errno=True)
+_libc.sched_setaffinity.argtypes = [ctypes.c_int, ctypes.c_size_t,
+                                    ctypes.POINTER(_MASK_TYPE)]
+_libc.sched_getaffinity.argtypes = [ctypes.c_int, ctypes.c_size_t,
+                                    ctypes.POINTER(_MASK_TYPE)]
+
+
+def _raise_errno():
+    e = ctypes.get_errno()
+    raise OSError(e, os.strerror(e))
+
+
+def sched_setaffinity(tid, cpu_mask):
+    """
+    Sets the affinity of a single thread.
+    :param tid: the thread id, 0 is the calling thread
+    :param cpu_mask: the cpu mask as an integer
+    """
+    mask = _MASK_TYPE()
+    for i in xrange(_MASK_WORDS):
+        mask[i] = (cpu_mask >> (i * _WORD_BITS)) & ((1 << _WORD_BITS) - 1)
+    if _libc.sched_setaffinity(tid, ctypes.sizeof(mask), mask) != 0:
+        _raise_errno()
+
+
+def sched_getaffinity(tid):
+    """
+    :param tid: the thread id, 0 is the calling thread
+    :return: the cpu mask of the thread as an integer
+    """
+    mask = _MASK_TYPE()
+    if _libc.sched_getaffinity(tid, ctypes.sizeof(mask), mask) != 0:
+        _raise_errno()
+    cpu_mask = 0
+    for i in xrange(_MASK_WORDS):
+        cpu_mask |= mask[i] << (i * _WORD_BITS)
+    return cpu_mask
+
+
+class AffinityEngine:
+    """
+    Sets the affinity of all the threads of a process with the
+    sched_setaffinity system call, the same as taskset -ap without the fork
+    and exec. The last mask applied to every thread is cached, so applying a
+    mask again only touches the threads that did not have it (e.g. threads
+    that were created since).
+
+    The cache assumes nobody else changes the affinity of the threads, use
+    invalidate (or force) when that is not the case.
+
+    A mask that cannot be applied (e.g. a cpu outside the cpuset of the
+    process, or an offline cpu) is logged and not cached, the same as a
+    failed taskset, so it is tried again on the next apply.
+    """
+    def __init__(self):
+        # pid -> {tid: cpu_mask}
+        self.applied = {}
+
+    @staticmethod
+    def _tids(pid):
+        return [int(tid) for tid in os.listdir("/proc/%d/task" % (pid,))]
+
+    def set_process_affinity(self, pid, cpu_mask, force=False):
+        """
+        :param pid: the process id
+        :param cpu_mask: the cpu mask as an integer
+        :param force: apply the mask even to threads that have it already
+        :return: the number of threads the mask was applied to
+        """
+        pid = int(pid)
+        last_applied = {} if force else self.applied.get(pid, {})
+        applied = {}
+        count = 0
+        try:
+            tids = AffinityEngine._tids(pid)
+        except OSError as e:
+            logging.warning("failed to list the threads of %d: %s" % (pid, e))
+            self.applied.pop(pid, None)
+            return 0
+        for tid in tids:
+            if last_applied.get(tid) != cpu_mask:
+                try:
+                    sched_setaffinity(tid, cpu_mask)
+                except OSError as e:
+                    if e.errno != errno.ESRCH:
+                        logging.warning("failed to set the affinity of %d "
+                                        "(pid %d) to 0x%x: %s" %
+                                        (tid, pid, cpu_mask, e))
+                    # the thread exited or keeps its mask, not cached
+                    continue
+                count += 1
+            applied[tid] = cpu_mask
+        # threads that exited are dropped from the cache
+        self.applied[pid] = applied
+        return count
+
+    def set_thread_affinity(self, pid, tid, cpu_mask, force=False):
+        """
+        Sets the affinity of a single thread of a process, e.g. a vCPU.
+        :param pid: the process id
+        :param tid: the thread id
+        :param cpu_mask: the cpu mask as an integer
+        :param force: apply the mask even if the thread has it already
+        :return: True if the mask was applied, False if the thread already
+        had it, exited or the mask could not be applied
+        """
+        applied = self.applied.setdefault(int(pid), {})
+        tid = int(tid)
+        if not force and applied.get(tid) == cpu_mask:
+            return False
+        try:
+            sched_setaffinity(tid, cpu_mask)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                logging.warning("failed to set the affinity of %d (pid %d) "
+                                "to 0x%x: %s" % (tid, int(pid), cpu_mask, e))
+            applied.pop(tid, None)
+            return False
+        applied[tid] = cpu_mask
+        return True
+
+    def get_process_affinity(self, pid):
+        """
+        :param pid: the process id
+        :return: the cpu mask of the main thread of the process
+        """
+        return sched_getaffinity(int(pid))
+
+    def invalidate(self, pid=None):
+        if pid is None:
+            self.applied.clear()
+        else:
+            self.applied.pop(int(pid), None)
+
+
+# a single engine, so all the callers share the cache of applied masks
+AffinityEngine.INSTANCE = AffinityEngine()
@@ -0,0 +1,272 @@
+import math
+import logging
+from collections import deque
+
+from utils.tick_scheduler import monotonic, RunningStats
+
+__author__ = 'eyalmo'
+
+# the window lengths, in seconds
+DEFAULT_WINDOWS = (1, 10, 60)
+# the relative width of a histogram bucket, the relative error of a
+# percentile
+DEFAULT_PRECISION = 0.05
+# the samples closer to 0 than that share the 0 bucket
+MIN_MAGNITUDE = 1e-9
+
+
+class LogHistogram:
+    """
+    Counts samples in buckets whose bounds grow geometrically, so a
+    percentile is approximated within the precision (relative) whatever the
+    scale of the samples. Negative samples are counted in mirrored buckets.
+    """
+    def __init__(self, precision=DEFAULT_PRECISION):
+        self.log_base = math.log(1 + precision)
+        # bucket -> the number of samples in it
+        self.buckets = {}
+        self.count = 0
+
+    def _bucket(self, x):
+        magnitude = abs(x)
+        if magnitude < MIN_MAGNITUDE:
+            return 0
+        b = int(math.log(magnitude / MIN_MAGNITUDE) / self.log_base) + 1
+        return b if x > 0 else -b
+
+    def _value(self, b):
+        """
+        :return: the geometric middle of a bucket
+        """
+        if b == 0:
+            return 0.0
+        v = MIN_MAGNITUDE * math.exp((abs(b) - 0.5) * self.log_base)
+        return v if b > 0 else -v
+
+    def add(self, x):
+        b = self._bucket(x)
+        self.buckets[b] = self.buckets.get(b, 0) + 1
+        self.count += 1
+
+    def remove(self, x):
+        b = self._bucket(x)
+        n = self.buckets[b] - 1
+        if n:
+            self.buckets[b] = n
+        else:
+            del self.buckets[b]
+        self.count -= 1
+
+    def percentile(self, p):
+        """
+        :param p: the percentile, between 0 and 100
+        :return: the approximate value of the percentile, None if there are
+        no samples
+        """
+        if not self.count:
+            return None
+        rank = max(int(math.ceil(self.count * p / 100.0)), 1)
+        seen = 0
+        for b in sorted(self.buckets):
+            seen += self.buckets[b]
+            if seen >= rank:
+                return self._value(b)
+        return self._value(max(self.buckets))
+
+
+class Window:
+    """
+    The samples of a series in the last length seconds: their EWMA (with a
+    time constant of the window length), mean, min, max and histogram, all
+    updated in amortized O(1) per sample. The min and max are kept by
+    monotonic deques of the samples that may still become the min (max).
+    """
+    def __init__(self, length, precision=DEFAULT_PRECISION):
+        self.length = float(length)
+        # (time, value) of the samples in the window
+        self.samples = deque()
+        self.min_candidates = deque()
+        self.max_candidates = deque()
+        self.histogram = LogHistogram(precision)
+        self.sum = 0.0
+        self.ewma = None
+        self.last_time = None
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, now, x):
+        if self.ewma is None:
+            self.ewma = float(x)
+        else:
+            alpha = 1 - math.exp(-(now - self.last_time) / self.length)
+            self.ewma += alpha * (x - self.ewma)
+        self.last_time = now
+
+        self.samples.append((now, x))
+        self.sum += x
+        self.histogram.add(x)
+        while self.min_candidates and self.min_candidates[-1][1] >= x:
+            self.min_candidates.pop()
+        self.min_candidates.append((now, x))
+        while self.max_candidates and self.max_candidates[-1][1] <= x:
+            self.max_candidates.pop()
+        self.max_candidates.append((now, x))
+        self._expire(now)
+
+    def _expire(self, now):
+        start = now - self.length
+        samples = self.samples
+        while samples and samples[0][0] <= start:
+            _, x = samples.popleft()
+            self.sum -= x
+            self.histogram.remove(x)
+        for candidates in (self.min_candidates, self.max_candidates):
+            while candidates and candidates[0][0] <= start:
+                candidates.popleft()
+
+    @property
+    def count(self):
+        return len(self.samples)
+
+    @property
+    def mean(self):
+        return self.sum / len(self.samples) if self.samples else None
+
+    @property
+    def min(self):
+        return self.min_candidates[0][1] if self.min_candidates else None
+
+    @property
+    def max(self):
+        return self.max_candidates[0][1] if self.max_candidates else None
+
+    def percentile(self, p):
+        value = self.histogram.percentile(p)
+        if value is None:
+            return None
+        # the middle of a bucket may be outside the samples
+        return min(max(value, self.min), self.max)
+
+    def __str__(self):
+        if not self.samples:
+            return "count: 0"
+        return "count: %d, ewma: %.3f, mean: %.3f, min: %.3f, p50: %.3f, " \
+               "p95: %.3f, max: %.3f" % \
+               (self.count, self.ewma, self.mean, self.min,
+                self.percentile(50), self.percentile(95), self.max)
+
+
+class Series:
+    """
+    A stream of samples of one counter: the last sample, a Window per
+    window length and the RunningStats since the first sample.
+    """
+    def __init__(self, lengths, precision=DEFAULT_PRECISION):
+        self.windows = [Window(length, precision) for length in lengths]
+        self.total = RunningStats()
+        self.last = None
+
+    def add(self, now, x):
+        self.last = x
+        self.total.add(x)
+        for window in self.windows:
+            window.add(now, x)
+
+
+class StatsEngine:
+    """
+    Streaming statistics of any number of series (e.g. the usage of every
+    cpu, or a policy counter), each over the same configurable windows.
+    The series are created on their first sample, keyed by any hashable
+    key. The samples of a tick share the time of the tick.
+    """
+    INSTANCE = None
+
+    @staticmethod
+    def initialize(stats_info=None):
+        """
+        initialize the statistics engine if one is not running yet.
+        :param stats_info: the statistics configuration: "windows" (secs)
+        and "precision"
+        :return: True if the engine was initialized, False if it is already
+        running
+        """
+        if StatsEngine.INSTANCE is not None:
+            return False
+        stats_info = stats_info or {}
+        StatsEngine.INSTANCE = \
+            StatsEngine(stats_info.get("windows", DEFAULT_WINDOWS),
+                        float(stats_info.get("precision", DEFAULT_PRECISION)))
+        return True
+
+    def __init__(self, windows=DEFAULT_WINDOWS, precision=DEFAULT_PRECISION):
+        # the window lengths, shortest first
+        self.lengths = tuple(sorted(float(w) for w in windows))
+        self.precision = precision
+        # key -> Series
+        self.series = {}
+        self.now = monotonic()
+
+    def tick(self, now=None):
+        """
+        Starts a new tick, the samples added until the next tick get its
+        time.
+        """
+        self.now = monotonic() if now is None else now
+
+    def add(self, key, x):
+        series = self.series.get(key)
+        if series is None:
+            series = Series(self.lengths, self.precision)
+            self.series[key] = series
+        series.add(self.now, x)
+
+    def _window_index(self, length):
+        if length is None:
+            return 0
+        return min(xrange(len(self.lengths)),
+                   key=lambda i: abs(self.lengths[i] - length))
+
+    def window(self, key, length=None):
+        """
+        :param key: the series key
+        :param length: the window length (secs), the configured window
+        closest to it is used, None for the shortest window
+        :return: the Window, None if the series has no samples
+        """
+        series = self.series.get(key)
+        if series is None:
+            return None
+        return series.windows[self._window_index(length)]
+
+    def windows(self, key):
+        """
+        :return: the Windows of a series, shortest first
+        """
+        series = self.series.get(key)
+        return series.windows if series is not None else []
+
+    def last(self, key, default=None):
+        series = self.series.get(key)
+        return default if series is None else series.last
+
+    def ewma(self, key, length=None, default=None):
+        window = self.window(key, length)
+        return default if window is None else window.ewma
+
+    def percentile(self, key, p, length=None, default=None):
+        window = self.window(key, length)
+        if window is None:
+            return default
+        value = window.percentile(p)
+        return default if value is None else value
+
+    def log(self, key, name=None):
+        series = self.series.get(key)
+        if series is None:
+            return
+        name = name if name is not None else str(key)
+        for window in series.windows:
+            logging.info("\x1b[37m%s [%gs]: %s.\x1b[39m" %
+                         (name, window.length, window))
@@ -0,0 +1,146 @@
+import os
+
+__author__ = 'eyalmo'
+
+# sysfs attributes are at most a page long
+READ_SIZE = 4096
+
+_pread = getattr(os, "pread", None)
+
+
+class SysfsReader:
+    """
+    Reads sysfs attributes through file descriptors that stay open between
+    reads. Every read rewinds the descriptor to offset 0, which makes sysfs
+    regenerate the attribute value, so a directory of attributes costs one
+    read per file per update instead of an open, read and close.
+
+    The descriptors of a directory must be invalidated when the directory
+    goes away (e.g. a vhost worker that was removed), or when its set of
+    attributes changes.
+
+    Large procfs files (e.g. /proc/stat) are read the same way with
+    read_file, which reads until the end of the file.
+    """
+    def __init__(self):
+        # directory path -> [(key, fd), ...]
+        self.directories = {}
+        # directory path -> the keys the descriptors were opened for
+        self.keys = {}
+        # file path -> fd
+        self.files = {}
+        # file path -> the size of the last read, used as the next read size
+        self.sizes = {}
+
+    @staticmethod
+    def _read_fd(fd):
+        if _pread is not None:
+            return _pread(fd, READ_SIZE, 0)
+        os.lseek(fd, 0, os.SEEK_SET)
+        return os.read(fd, READ_SIZE)
+
+    @staticmethod
+    def _read_fd_all(fd, size):
+        chunks = []
+        offset = 0
+        if _pread is None:
+            os.lseek(fd, 0, os.SEEK_SET)
+        while True:
+            if _pread is not None:
+                chunk = _pread(fd, size, offset)
+            else:
+                chunk = os.read(fd, size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            offset += len(chunk)
+        return "".join(chunks)
+
+    def _open_directory(self, dir_path, keys):
+        entries = []
+        try:
+            for key in keys:
+                entries.append((key, os.open(os.path.join(dir_path, key),
+                                             os.O_RDONLY)))
+        except OSError:
+            for _, fd in entries:
+                os.close(fd)
+            raise
+        self.directories[dir_path] = entries
+        self.keys[dir_path] = list(keys)
+        return entries
+
+    def read_directory(self, dir_path, keys):
+        """
+        Reads all the given attributes of a directory in one batch.
+        :param dir_path: the sysfs directory
+        :param keys: the attribute file names in the directory
+        :return: a list of (key, raw value) tuples
+        """
+        entries = self.directories.get(dir_path)
+        if entries is None or self.keys[dir_path] != keys:
+            self.invalidate(dir_path)
+            entries = self._open_directory(dir_path, keys)
+
+        try:
+            return [(key, SysfsReader._read_fd(fd)) for key, fd in entries]
+        except OSError:
+            # the directory (or one of its attributes) is gone
+            self.invalidate(dir_path)
+            raise
+
+    def read_file(self, file_path):
+        """
+        Reads a whole file, however long it is.
+        :param file_path: the file to read
+        :return: the raw content of the file
+        """
+        fd = self.files.get(file_path)
+        if fd is None:
+            fd = os.open(file_path, os.O_RDONLY)
+            self.files[file_path] = fd
+
+        try:
+            # one read is enough as long as the file does not grow
+            content = SysfsReader._read_fd_all(
+                fd, self.sizes.get(file_path, READ_SIZE) + READ_SIZE)
+        except OSError:
+            self.invalidate(file_path)
+            raise
+        self.sizes[file_path] = len(content)
+        return content
+
+    @staticmethod
+    def _close(fd):
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+    def invalidate(self, dir_path=None):
+        """
+        Closes the cached file descriptors.
+        :param dir_path: close only the descriptors of this directory (or
+        file) and its sub directories, None closes everything
+        """
+        if dir_path is None:
+            paths = self.directories.keys()
+            files = self.files.keys()
+        else:
+            prefix = os.path.join(dir_path, "")
+            paths = [p for p in self.directories.keys()
+                     if p == dir_path or p.startswith(prefix)]
+            files = [p for p in self.files.keys()
+                     if p == dir_path or p.startswith(prefix)]
+
+        for path in paths:
+            del self.keys[path]
+            for _, fd in self.directories.pop(path):
+                SysfsReader._close(fd)
+
+        for path in files:
+            self.sizes.pop(path, None)
+            SysfsReader._close(self.files.pop(path))
+
+    def close(self):
+        self.invalidate()
@@ -0,0 +1,153 @@
+import os
+import time
+import math
+import ctypes
+import ctypes.util
+import logging
+
+__author__ = 'eyalmo'
+
+CLOCK_MONOTONIC = 1
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+_librt = ctypes.CDLL(ctypes.util.find_library("rt") or
+                     ctypes.util.find_library("c"), use_errno=True)
+_librt.clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+
+def monotonic():
+    """
+    :return: the monotonic clock in seconds, unaffected by wall clock changes
+    """
+    t = _Timespec()
+    if _librt.clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return t.tv_sec + t.tv_nsec * 1e-9
+
+
+class RunningStats:
+    """
+    Count, mean, standard deviation, min and max of a stream of samples, in
+    constant memory (Welford's algorithm).
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, x):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+        self.min = x if self.min is None else min(self.min, x)
+        self.max = x if self.max is None else max(self.max, x)
+
+    @property
+    def stdev(self):
+        return math.sqrt(self.m2 / self.count) if self.count > 1 else 0.0
+
+    def __str__(self):
+        if not self.count:
+            return "count: 0"
+        return "count: %d, mean: %.6f, stdev: %.6f, min: %.6f, max: %.6f" % \
+               (self.count, self.mean, self.stdev, self.min, self.max)
+
+
+class TickScheduler:
+    """
+    Runs ticks on a fixed grid of monotonic deadlines, so the period does
+    not grow with the processing time of a tick. A tick that ends after the
+    next deadline is an overrun: the deadlines it missed are skipped rather
+    than run back to back.
+
+    Every tick has a processing budget (a fraction of the interval), the
+    caller checks over_budget() to skip its non-essential phases when a tick
+    runs late.
+    """
+    def __init__(self, interval, budget_ratio=0.8, stats_interval=0):
+        """
+        :param interval: the tick period in seconds
+        :param budget_ratio: the fraction of the interval a tick may spend
+        before skipping its non-essential phases
+        :param stats_interval: log the statistics every that many ticks, 0
+        to never log them
+        """
+        self.interval = float(interval)
+        self.budget = self.interval * float(budget_ratio)
+        self.stats_interval = stats_interval
+
+        self.deadline = None
+        self.tick_start = None
+
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped_ticks = 0
+        self.degraded_ticks = 0
+        self._degraded = False
+
+        # how late the ticks woke up after their deadline
+        self.jitter = RunningStats()
+        # the processing time of the ticks
+        self.work = RunningStats()
+
+    def wait(self):
+        """
+        Ends the current tick and sleeps until the deadline of the next one.
+        :return: the tick number
+        """
+        now = monotonic()
+        if self.deadline is None:
+            self.deadline = now + self.interval
+        else:
+            self.work.add(now - self.tick_start)
+            if self._degraded:
+                self.degraded_ticks += 1
+                self._degraded = False
+            self.deadline += self.interval
+            if now > self.deadline:
+                # the tick overran, skip the deadlines that passed
+                missed = int((now - self.deadline) / self.interval) + 1
+                self.overruns += 1
+                self.skipped_ticks += missed
+                self.deadline += missed * self.interval
+
+        delay = self.deadline - now
+        if delay > 0:
+            time.sleep(delay)
+
+        self.tick_start = monotonic()
+        self.jitter.add(self.tick_start - self.deadline)
+        self.ticks += 1
+        if self.stats_interval and self.ticks % self.stats_interval == 0:
+            self.log_stats()
+        return self.ticks
+
+    def elapsed(self):
+        """
+        :return: the time spent in the current tick
+        """
+        return monotonic() - self.tick_start
+
+    def over_budget(self):
+        """
+        :return: True if the current tick spent its budget, in which case the
+        tick is counted as degraded
+        """
+        if self.elapsed() <= self.budget:
+            return False
+        self._degraded = True
+        return True
+
+    def log_stats(self):
+        logging.info("ticks: %d, overruns: %d, skipped: %d, degraded: %d" %
+                     (self.ticks, self.overruns, self.skipped_ticks,
+                      self.degraded_ticks))
+        logging.info("tick jitter: %s" % (self.jitter,))
+        logging.info("tick work: %s" % (self.work,))
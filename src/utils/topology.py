@@ -0,0 +1,195 @@
+import os
+import re
+import logging
+
+from utils.cpu_set import CPUSet
+from utils.cpus import CPU
+
+__author__ = 'eyalmo'
+
+CPU_DIRECTORY = "/sys/devices/system/cpu"
+NODE_DIRECTORY = "/sys/devices/system/node"
+IRQ_DIRECTORY = "/proc/irq"
+
+
+def _read(path, default=None):
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except IOError:
+        return default
+
+
+def _ls_numbered(directory, prefix):
+    """
+    :return: the numbers of the entries named <prefix><number>
+    """
+    regex = re.compile(r"^%s(\d+)$" % (prefix,))
+    if not os.path.isdir(directory):
+        return []
+    return sorted(int(m.group(1)) for m in
+                  (regex.match(e) for e in os.listdir(directory)) if m)
+
+
+class Topology:
+    """
+    The cpu topology of the host as exposed by sysfs: the socket, NUMA node,
+    SMT siblings and last level cache group of every online cpu.
+    """
+    INSTANCE = None
+
+    @staticmethod
+    def initialize():
+        """
+        initialize the topology object if one does not exist yet.
+
+        :return True if the topology object was initialized successfully,
+        False otherwise
+        """
+        if Topology.INSTANCE is not None:
+            return False
+        Topology.INSTANCE = Topology()
+        return True
+
+    def __init__(self):
+        self.cpus = {}
+        # node id -> CPUSet
+        self.nodes = {}
+        for node in _ls_numbered(NODE_DIRECTORY, "node"):
+            cpu_list = _read(os.path.join(NODE_DIRECTORY, "node%d" % (node,),
+                                          "cpulist"), "")
+            self.nodes[node] = CPUSet.from_user_list(cpu_list) \
+                if cpu_list else CPUSet()
+        node_of = {cpu: node for node, cpus in self.nodes.items()
+                   for cpu in cpus}
+        # node id -> {node id: distance}, 10 is the local distance
+        self.distances = {}
+        for node in self.nodes.keys():
+            distances = _read(os.path.join(NODE_DIRECTORY, "node%d" % (node,),
+                                           "distance"), "")
+            self.distances[node] = \
+                dict(zip(sorted(self.nodes.keys()),
+                         [int(d) for d in distances.split()]))
+
+        online = CPUSet.online()
+        for cpu_id in online:
+            cpu_path = os.path.join(CPU_DIRECTORY, "cpu%d" % (cpu_id,))
+            topology_path = os.path.join(cpu_path, "topology")
+            socket = int(_read(os.path.join(topology_path,
+                                            "physical_package_id"), 0))
+            core = int(_read(os.path.join(topology_path, "core_id"),
+                             cpu_id))
+            siblings = _read(os.path.join(topology_path,
+                                          "thread_siblings_list"))
+            siblings = CPUSet.from_user_list(siblings) \
+                if siblings else CPUSet([cpu_id])
+            self.cpus[cpu_id] = CPU(cpu_id, socket, core=core,
+                                    node=node_of.get(cpu_id),
+                                    siblings=siblings & online,
+                                    llc=Topology._parse_llc(cpu_path, cpu_id))
+
+        # socket id -> CPUSet
+        self.sockets = {}
+        for cpu in self.cpus.values():
+            self.sockets.setdefault(cpu.socket, CPUSet()).add(cpu.id)
+
+        # the distinct last level cache groups
+        self.llc_groups = list(set(cpu.llc for cpu in self.cpus.values()))
+        logging.info("topology: sockets: %s, nodes: %s, llc groups: %s" %
+                     (self.sockets, self.nodes, self.llc_groups))
+
+    @staticmethod
+    def _parse_llc(cpu_path, cpu_id):
+        """
+        :return: the cpus sharing the highest level cache of the cpu
+        """
+        cache_path = os.path.join(cpu_path, "cache")
+        llc_level = -1
+        llc = CPUSet([cpu_id])
+        for index in _ls_numbered(cache_path, "index"):
+            index_path = os.path.join(cache_path, "index%d" % (index,))
+            if _read(os.path.join(index_path, "type")) == "Instruction":
+                continue
+            level = int(_read(os.path.join(index_path, "level"), -1))
+            shared = _read(os.path.join(index_path, "shared_cpu_list"))
+            if level > llc_level and shared:
+                llc_level = level
+                llc = CPUSet.from_user_list(shared)
+        return llc
+
+    def cores_per_socket(self):
+        sockets = {}
+        for cpu in self.cpus.values():
+            sockets.setdefault(cpu.socket, set()).add(cpu.core)
+        return max(len(cores) for cores in sockets.values())
+
+    def node_of(self, cpu_id):
+        cpu = self.cpus.get(cpu_id)
+        return None if cpu is None else cpu.node
+
+    def distance_to_nodes(self, cpu_id, nodes):
+        """
+        :return: the NUMA distance of a cpu to the closest of the nodes,
+        relative to the local distance: 0 on one of the nodes, and 1 for a
+        node that is twice as far. 0 when the distance is unknown
+        """
+        node = self.node_of(cpu_id)
+        if node is None or not nodes or node in nodes:
+            return 0.0
+        distances = self.distances.get(node, {})
+        known = [distances[n] for n in nodes if n in distances]
+        local = distances.get(node)
+        if not known or not local:
+            # no distance tables, do not penalize the cpu
+            return 0.0
+        return float(min(known)) / local - 1.0
+
+    def siblings_of(self, cpu_id):
+        """
+        :return: the SMT siblings of the cpu, excluding the cpu itself
+        """
+        cpu = self.cpus.get(cpu_id)
+        if cpu is None:
+            return CPUSet()
+        return cpu.siblings - CPUSet([cpu_id])
+
+    @staticmethod
+    def irq_node(irq_id):
+        """
+        :return: the NUMA node of the device that raises the IRQ, None if
+        unknown
+        """
+        node = _read(os.path.join(IRQ_DIRECTORY, str(irq_id), "node"))
+        if node is None or int(node) < 0:
+            return None
+        return int(node)
+
+    def rank_io_cores(self, candidates, number, io_nodes=None,
+                      cpu_load=None):
+        """
+        Chooses the cpus that should become IO cores: cpus on the NUMA nodes
+        of the NICs first, then cpus whose SMT siblings are not busy with
+        vCPUs that stay in place. Ties keep the order of the candidates.
+        :param candidates: the candidate cpus, in order of preference
+        :param number: how many cpus to choose
+        :param io_nodes: the NUMA nodes of the NICs, None or empty if unknown
+        :param cpu_load: a dictionary of cpu id -> load (0.0-1.0) of the cpus
+        that run vCPUs, cpus not in it are considered idle
+        :return: the chosen cpus, in order of choice
+        """
+        cpu_load = cpu_load or {}
+        remaining = list(candidates)
+        chosen = []
+        for _ in xrange(min(number, len(remaining))):
+            def score(item):
+                position, cpu_id = item
+                off_node = 1 if io_nodes and \
+                    self.node_of(cpu_id) not in io_nodes else 0
+                busy_siblings = sum(cpu_load.get(s, 0.0)
+                                    for s in self.siblings_of(cpu_id)
+                                    if s not in chosen)
+                return off_node, busy_siblings, position
+            _, cpu_id = min(enumerate(remaining), key=score)
+            remaining.remove(cpu_id)
+            chosen.append(cpu_id)
+        return chosen
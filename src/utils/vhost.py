@@ -5,10 +5,12 @@ import os
 import getopt
 
 
-from cpus import CPU
+from utils.topology import Topology
 from aux import syscmd, ls, msg, warn, print_stuff, print_selected_stuff, Timer
 from vhost_light import VhostLight, ProcessCPUUsageCounterBase
+from counter_store import CounterStore
 from affinity_entity import parse_cpu_mask_from_pid, set_cpu_mask_to_pid
+from sysfs_reader import SysfsReader
 
 
 def usage(program_name):
@@ -24,11 +26,6 @@ def usage(program_name):
 MOUNT_POINT = "/sys/class/vhost"
 
 
-def get_cpus_per_sockets():
-    # return 8
-    return int(syscmd('lscpu | grep "Core(s) per socket" | rev | cut -c1'))
-
-
 def vhost_write(elem, key, value):
     file_path = os.path.join(elem["path"], key)
     with open(file_path, "w") as f:
@@ -41,6 +38,34 @@ def vhost_read(elem, key):
         return f.read()
 
 
+def vhost_worker_create(vhost, cpu=0):
+    """
+    Creates a new vhost worker through workersGlobal/create.
+    :param vhost: the Vhost instance
+    :param cpu: the cpu the worker is created on
+    :return: the new worker id
+    """
+    vhost_write(vhost.workersGlobal, "create", cpu)
+    new_worker_id = vhost_read(vhost.workersGlobal, "create").strip()
+    vhost.invalidate(new_worker_id)
+    return new_worker_id
+
+
+def vhost_worker_remove(vhost, worker):
+    """
+    Locks a vhost worker and removes it through workersGlobal/remove.
+    :param vhost: the Vhost instance
+    :param worker: the worker dictionary
+    """
+    vhost_write(worker, "locked", 1)
+    worker["locked"] = 1
+    # stop copying the worker stats before its kernel object goes away
+    vhost.vhost_light.invalidate(worker["id"])
+    # the worker directory is about to disappear, close its descriptors
+    vhost.invalidate(worker["id"])
+    vhost_write(vhost.workersGlobal, "remove", worker["id"])
+
+
 def vhost_worker_set_cpu_mask(worker, cpu_mask):
     pid = vhost_read(worker, "pid")
     set_cpu_mask_to_pid(pid, cpu_mask)
@@ -100,8 +125,10 @@ class VhostCounter:
     def initialize(self, vhost, initial_value=0):
         vhost[self.total] = initial_value
 
-    def update(self, vhost, elements):
-        total = sum(e[self.element_name] for e in elements)
+    def update(self, vhost, store):
+        return self.update_total(vhost, store.total(self.element_name))
+
+    def update_total(self, vhost, total):
         last_epoch = vhost[self.last_epoch] = vhost[self.total]
         vhost[self.total] = total
 
@@ -139,12 +166,18 @@ class Vhost:
         self.vhost = {}
         self.workersGlobal = {}
         self.workers = {}
+        # the workers parked in a WorkerPool, not in workers
+        self.parked_workers = {}
         self.devices = {}
         self.queues = {}
 
-        self.cores_per_socket = get_cpus_per_sockets()
-        self.cpus = CPU.parse_cpus()
-        self.sockets = len(self.cpus) / self.cores_per_socket
+        self.sysfs = SysfsReader()
+
+        Topology.initialize()
+        self.topology = Topology.INSTANCE
+        self.cores_per_socket = self.topology.cores_per_socket()
+        self.cpus = self.topology.cpus
+        self.sockets = len(self.topology.sockets)
 
         self.cycles = VhostCounter("cycles")
         self.work_cycles = VhostCounter("work_cycles", "total_work_cycles")
@@ -170,6 +203,14 @@ class Vhost:
             n: VhostCounter(n) for n in ["handled_bytes", "handled_packets"]
         }
 
+        # the numeric counters of the workers and queues, one row per element
+        self.worker_stats = CounterStore(
+            set(c.element_name for c in
+                [self.work_cycles, self.softirq_interference] +
+                self.per_worker_counters.values()))
+        self.queue_stats = CounterStore(
+            c.element_name for c in self.per_queue_counters.values())
+
         self._initialize()
 
         self.vhost_light = VhostLight(self)
@@ -205,71 +246,89 @@ class Vhost:
         # msg("end")
         return value
 
-    @staticmethod
-    def update_all_entries(dictionary):
+    def update_all_entries(self, dictionary):
         dir_path = dictionary["path"]
         # msg("dir_path: %s" % (dir_path,))
         if "status" in dictionary["keys"]:
-            file_path = os.path.join(dir_path, "status")
-            # msg("file_path: %s" % (file_path,))
-            with open(file_path, "r") as f:
-                for line in f:
+            for _, value in self.sysfs.read_directory(dir_path, ["status"]):
+                for line in value.splitlines():
                     key, value = line.split(":")
                     dictionary[key] = Vhost.parse_value(key, value)
             return
 
-        for key in dictionary["keys"]:
-            # msg("key: %s" % (key,))
-            file_path = os.path.join(dir_path, key)
-            # msg("file_path: %s" % (file_path,))
-            with open(file_path, "r") as f:
-                # msg("file opened successfully")
-                value = f.read().strip()
+        # read all the attributes first and only then parse them, so the
+        # values are as close as possible to a single snapshot
+        for key, value in self.sysfs.read_directory(dir_path,
+                                                    dictionary["keys"]):
             dictionary[key] = Vhost.parse_value(key, value)
 
-    def update_all_entries_with_id(self, elem_id):
+    def invalidate(self, elem_id=None):
+        """
+        Drops the cached sysfs file descriptors of an element (or of all the
+        elements if elem_id is None). Must be called when an element
+        directory is removed or created, e.g. on workersGlobal/create and
+        workersGlobal/remove.
+        :param elem_id: the worker, device or virtual queue id
+        """
+        if elem_id is None:
+            self.sysfs.invalidate()
+            return
+        self.sysfs.invalidate(self.get_path(elem_id))
+
+    def get_path(self, elem_id):
         directory = ""
-        parent = None
         if Vhost.is_worker(elem_id):
             directory = "worker"
-            parent = self.workers
         elif Vhost.is_device(elem_id):
             directory = "dev"
-            parent = self.devices
         elif Vhost.is_virtual_queue(elem_id):
             directory = "vq"
+        return os.path.join(self.path, directory, elem_id)
+
+    def update_all_entries_with_id(self, elem_id):
+        parent = None
+        if Vhost.is_worker(elem_id):
+            parent = self.workers
+        elif Vhost.is_device(elem_id):
+            parent = self.devices
+        elif Vhost.is_virtual_queue(elem_id):
             parent = self.queues
-        dir_path = os.path.join(self.path, directory, elem_id)
+        dir_path = self.get_path(elem_id)
+        self.sysfs.invalidate(dir_path)
         elem = parent[elem_id] = {
             "id": elem_id, "path": dir_path,
             "keys": ls(dir_path, show_dirs=False, show_files=True,
                        show_only_readable=True)}
-        Vhost.update_all_entries(elem)
+        self.update_all_entries(elem)
 
     def _initialize(self):
         # timer = Timer("Timer vhost _initialize")
+        # the set of elements may have changed, reopen all the attributes
+        self.sysfs.invalidate()
         self.vhost["path"] = self.path
         self.vhost["keys"] = ls(self.path, show_dirs=False, show_files=True,
                                 show_only_readable=True)
-        Vhost.update_all_entries(self.vhost)
+        self.update_all_entries(self.vhost)
         # timer.checkpoint("vhost")
 
         self.workersGlobal["path"] = os.path.join(self.path, "worker")
         self.workersGlobal["keys"] = ls(self.workersGlobal["path"],
                                         show_dirs=False, show_files=True,
                                         show_only_readable=True)
-        Vhost.update_all_entries(self.workersGlobal)
+        self.update_all_entries(self.workersGlobal)
         # timer.checkpoint("workersGlobal")
 
         for w_id in ls(os.path.join(self.path, "worker")):
             w_id = w_id.strip()
+            if w_id in self.parked_workers:
+                continue
             # msg("w_id: %s" % (w_id,))
             dir_path = os.path.join(self.path, "worker", w_id)
             w = self.workers[w_id] = {"id": w_id, "path": dir_path,
                                       "keys": ls(dir_path, show_dirs=False,
                                                  show_files=True,
                                                  show_only_readable=True)}
-            Vhost.update_all_entries(w)
+            self.update_all_entries(w)
             w["cpu_usage_counter"] = get_cpu_usage(w["pid"])
             # w["cpu_usage_counter"] = ProcessCPUUsageCounter(w["pid"])
         # timer.checkpoint("worker")
@@ -281,7 +340,7 @@ class Vhost:
                 {"id": d_id, "path": dir_path,
                  "keys": ls(dir_path, show_dirs=False, show_files=True,
                             show_only_readable=True)}
-            Vhost.update_all_entries(dev)
+            self.update_all_entries(dev)
         # timer.checkpoint("dev")
 
         for vq_id in ls(os.path.join(self.path, "vq")):
@@ -291,7 +350,7 @@ class Vhost:
                 {"id": vq_id, "path": dir_path,
                  "keys": ls(dir_path, show_dirs=False, show_files=True,
                             show_only_readable=True)}
-            Vhost.update_all_entries(queue)
+            self.update_all_entries(queue)
             queue["notif_works_last_epoch"] = queue["notif_works"]
         # timer.checkpoint("vq")
 
@@ -324,43 +383,47 @@ class Vhost:
             vhost_write(self.vhost, "epoch", "1")
             # timer.checkpoint("update_epoch")
 
-        Vhost.update_all_entries(self.vhost)
+        self.update_all_entries(self.vhost)
         cycles_this_epoch = self.vhost["cycles"] - \
             self.vhost["cycles_last_epoch"]
         self.vhost["cycles_last_epoch"] = self.vhost["cycles"]
         self.vhost["cycles_this_epoch"] = cycles_this_epoch
         # timer.checkpoint("vhost")
-        Vhost.update_all_entries(self.workersGlobal)
+        self.update_all_entries(self.workersGlobal)
         # timer.checkpoint("workersGlobal")
 
         for w in self.workers.values():
-            Vhost.update_all_entries(w)
+            self.update_all_entries(w)
             w["cpu_usage_counter"] = get_cpu_usage(w["pid"])
             # w["cpu_usage_counter"].update()
         # timer.checkpoint("workers")
 
         for dev in self.devices.values():
-            Vhost.update_all_entries(dev)
+            self.update_all_entries(dev)
         # timer.checkpoint("devices")
 
         for vq in self.queues.values():
-            Vhost.update_all_entries(vq)
+            self.update_all_entries(vq)
             notif_works_this_epoch = vq["notif_works"] - \
                 vq["notif_works_last_epoch"]
             vq["notif_works_last_epoch"] = vq["notif_works"]
             vq["notif_works_this_epoch"] = notif_works_this_epoch
         # timer.checkpoint("queues")
 
-        self.cycles.update(self.vhost, [self.vhost])
-        self.work_cycles.update(self.vhost, self.workers.values())
-        self.softirq_interference.update(self.vhost, self.workers.values())
+        self.worker_stats.load_dicts(self.workers)
+        self.queue_stats.load_dicts(self.queues)
+        # timer.checkpoint("stores load")
+
+        self.cycles.update_total(self.vhost, self.vhost["cycles"])
+        self.work_cycles.update(self.vhost, self.worker_stats)
+        self.softirq_interference.update(self.vhost, self.worker_stats)
         # timer.checkpoint("misc")
 
         for c in self.per_worker_counters.values():
-            c.update(self.vhost, self.workers.values())
+            c.update(self.vhost, self.worker_stats)
         # timer.checkpoint("per_worker_counters")
         for c in self.per_queue_counters.values():
-            c.update(self.vhost, self.queues.values())
+            c.update(self.vhost, self.queue_stats)
         # timer.checkpoint("per_queue_counters")
         self.vhost_light.update(rescan=True)
         # timer.done()
@@ -1,13 +1,47 @@
 import logging
+import threading
 
 import kernel_mapper
 
 from get_cycles.get_cycles import Cycles
 from aux import Timer
-
-from vhost_raw import VhostWorker, VhostDevice, VhostVirtqueue
-
-# RAW_FIELD_SIZE = 8
+from counter_store import CounterStore
+from tick_scheduler import monotonic, RunningStats
+
+from vhost_raw import VhostWorker, VhostDevice, VhostVirtqueue, Snapshot, \
+    WORKER_STATS_SIZE, DEVICE_STATS_SIZE, VIRTQUEUE_STATS_SIZE
+
+# the layout of the stats records copied by vhost_raw.Snapshot, must match
+# struct vhost_worker_stats, vhost_device_stats and vhost_virtqueue_stats in
+# raw_extensions/vhost_raw.h
+VHOST_WORKER_FIELDS = (
+    "loops", "enabled_interrupts", "tsc_cycles", "cycles", "total_cycles",
+    "mm_switches", "wait", "empty_works", "empty_polls", "stuck_works",
+    "noqueue_works", "pending_works", "last_loop_tsc_end", "poll_cycles",
+    "notif_cycles", "nett_work_cycles", "total_work_cycles",
+    "ksoftirq_occurrences", "ksoftirq_time", "ksoftirqs",
+    "ixgbe_poll_cycles", "ixgbe_poll_last_loop_tsc_end",
+    "ixgbe_poll_last_non_empty_loop_tsc_end", "ixgbe_poll_wait",
+    "ixgbe_poll_empty", "ixgbe_poll_empty_cycles",
+    "ixgbe_poll_total_packets", "ixgbe_poll_loops")
+
+VHOST_DEVICE_FIELDS = (
+    "delay_per_work", "delay_per_kbyte", "device_move_total",
+    "device_move_count", "device_detach", "device_attach")
+
+VHOST_VIRTQUEUE_FIELDS = (
+    "poll_kicks", "poll_cycles", "poll_bytes", "poll_wait", "poll_empty",
+    "poll_empty_cycles", "poll_coalesced", "poll_limited",
+    "poll_pending_cycles", "notif_works", "notif_cycles", "notif_bytes",
+    "notif_wait", "notif_limited", "handled_bytes", "handled_packets",
+    "ring_full", "stuck_times", "stuck_cycles", "last_poll_tsc_end",
+    "last_notif_tsc_end", "last_poll_empty_tsc", "handled_bytes_this_work",
+    "was_limited", "ksoftirq_occurrences", "ksoftirq_time", "ksoftirqs")
+
+RAW_FIELD_SIZE = 8
+assert len(VHOST_WORKER_FIELDS) * RAW_FIELD_SIZE == WORKER_STATS_SIZE
+assert len(VHOST_DEVICE_FIELDS) * RAW_FIELD_SIZE == DEVICE_STATS_SIZE
+assert len(VHOST_VIRTQUEUE_FIELDS) * RAW_FIELD_SIZE == VIRTQUEUE_STATS_SIZE
 
 
 class ProcessCPUUsageCounterBase:
@@ -58,6 +92,30 @@ class VhostLight:
         self.devices = {}
         self.queues = {}
 
+        # the counters of all the elements, one row per element
+        self.worker_stats = CounterStore(VHOST_WORKER_FIELDS)
+        self.device_stats = CounterStore(VHOST_DEVICE_FIELDS)
+        self.queue_stats = CounterStore(VHOST_VIRTQUEUE_FIELDS)
+
+        # copies the stats of all the elements in a single native call
+        self.snapshot = None
+        # guards the kernel objects behind the raw objects against removal
+        # while a sampler thread copies them
+        self.lock = threading.Lock()
+        # changes whenever the raw objects are rebuilt
+        self.generation = 0
+        self.snapshot_valid = True
+        self.worker_ids = []
+        self.device_ids = []
+        self.queue_ids = []
+        # the raw objects of the workers parked in a WorkerPool, kept out of
+        # the snapshot
+        self.parked_workers = {}
+        # the ids of removed elements whose raw objects must not be reused
+        self.stale_ids = set()
+        # the duration of the rescans, in seconds
+        self.rescan_time = RunningStats()
+
         self.cycles = VhostCyclesCounter("cycles")
         self.work_cycles = VhostWorkCyclesCounter("work_cycles")
         self.softirq_interference = \
@@ -67,8 +125,8 @@ class VhostLight:
             "cpu_usage_counter": VhostCPUUsageCounter("cpu_usage_counter")
         }
         self.per_queue_counters = \
-            {"notif_bytes": VhostPolledBytesCounter("notif_bytes"),
-             "poll_bytes": VhostNotifBytesCounter("poll_bytes"),
+            {"notif_bytes": VhostNotifBytesCounter("notif_bytes"),
+             "poll_bytes": VhostPolledBytesCounter("poll_bytes"),
              "handled_bytes": VhostHandledBytesCounter("handled_bytes"),
              "handled_packets": VhostHandledPacketsCounter("handled_packets")}
 
@@ -87,58 +145,198 @@ class VhostLight:
             c.initialize(self.vhost.vhost)
 
     def _initialize(self):
-        # timer = Timer("Timer vhost light _initialize")
-
-        for w_id in self.vhost.workers.keys():
-            self.workers[w_id] = VhostWorker(w_id)
-        # timer.checkpoint("initialize workers")
-
-        for d_id in self.vhost.devices.keys():
-            self.devices[d_id] = VhostDevice(d_id)
-        # timer.checkpoint("initialize devices")
-
-        for vq_id in self.vhost.queues.keys():
-            self.queues[vq_id] = VhostVirtqueue(vq_id)
-        # timer.checkpoint("initialize queues")
-        # timer.checkpoint("done")
+        self._rescan()
+        self._register_snapshot()
+        # the later rescans only update the worker counters on changes
+        for c in self.per_worker_counters.values():
+            c.update_workers(self.vhost.workers.values())
+
+    def _rescan(self):
+        """
+        Builds the raw objects of the elements that appeared since the last
+        rescan and drops the objects of the elements that vanished (or that
+        were invalidated), the objects of the rest are kept, and so are the
+        counter baselines of their rows in the stores.
+        :return: the number of raw objects built and dropped
+        """
+        added = removed = 0
+        for raw_objects, elements, raw_class in (
+                (self.workers, self.vhost.workers, VhostWorker),
+                (self.devices, self.vhost.devices, VhostDevice),
+                (self.queues, self.vhost.queues, VhostVirtqueue)):
+            for elem_id in raw_objects.keys():
+                if elem_id not in elements or elem_id in self.stale_ids:
+                    del raw_objects[elem_id]
+                    removed += 1
+            for elem_id in elements.keys():
+                if elem_id not in raw_objects:
+                    raw_objects[elem_id] = raw_class(elem_id)
+                    added += 1
+        self.stale_ids.clear()
+        return added, removed
+
+    def _register_snapshot(self):
+        """
+        Registers the kernel addresses of all the elements in a snapshot.
+        The records in the snapshot buffers follow the order of the ids
+        lists.
+        """
+        self.worker_ids = self.workers.keys()
+        self.device_ids = self.devices.keys()
+        self.queue_ids = self.queues.keys()
+        self.snapshot = Snapshot([self.workers[i] for i in self.worker_ids],
+                                 [self.devices[i] for i in self.device_ids],
+                                 [self.queues[i] for i in self.queue_ids])
+
+    def _set_workers(self):
+        # must be called with the lock held
+        self._register_snapshot()
+        self.generation += 1
+
+    def park_worker(self, w_id):
+        """
+        Takes a worker out of the snapshot and keeps its raw object, so it is
+        added back without a rescan.
+        """
+        with self.lock:
+            raw = self.workers.pop(w_id, None)
+            if raw is None:
+                raw = self.parked_workers.get(w_id) or VhostWorker(w_id)
+            self.parked_workers[w_id] = raw
+            self._set_workers()
+        for c in self.per_worker_counters.values():
+            c.update_workers(self.vhost.workers.values())
+
+    def unpark_worker(self, w_id):
+        """
+        Adds a parked worker back to the snapshot.
+        """
+        with self.lock:
+            self.workers[w_id] = self.parked_workers.pop(w_id)
+            self._set_workers()
+        for c in self.per_worker_counters.values():
+            c.update_workers(self.vhost.workers.values())
+
+    def invalidate(self, elem_id=None):
+        """
+        Stops all copies from the kernel objects until the next rescan, must
+        be called before a kernel object (e.g. a worker) is removed.
+        :param elem_id: the id of the element that is removed, its raw object
+        is built again by the next rescan if the id is reused
+        """
+        with self.lock:
+            self.snapshot_valid = False
+            if elem_id is not None:
+                self.stale_ids.add(elem_id)
 
     def update(self, rescan=False):
         # timer = Timer("Timer vhost light update")
         if rescan:
-            self.workers = {}
-            self.devices = {}
-            self.queues = {}
-            self._initialize()
-            for c in self.per_worker_counters.values():
-                c.update_workers(self.vhost.workers.values())
+            start = monotonic()
+            with self.lock:
+                added, removed = self._rescan()
+                if added or removed or not self.snapshot_valid:
+                    self._register_snapshot()
+                    self.generation += 1
+                self.snapshot_valid = True
+            if added or removed:
+                for c in self.per_worker_counters.values():
+                    c.update_workers(self.vhost.workers.values())
+            elapsed = monotonic() - start
+            self.rescan_time.add(elapsed)
+            if added or removed:
+                logging.info("vhost light rescan: %d built, %d dropped, "
+                             "%.3f ms" % (added, removed, elapsed * 1000))
             # timer.checkpoint("rescan")
 
-        for w in self.workers.values():
-            w.update()
-        # timer.checkpoint("workers update")
-
-        for d in self.devices.values():
-            d.update()
-        # timer.checkpoint("devices update")
-
-        for vq in self.queues.values():
-            vq.update()
-        # timer.checkpoint("vqs update")
-
-        self.cycles.update(self.vhost.vhost, [self.vhost.vhost])
-        self.work_cycles.update(self.vhost.vhost, self.workers.values())
-        self.softirq_interference.update(self.vhost.vhost,
-                                         self.workers.values())
+        if not self.snapshot_valid:
+            # a kernel object was removed, keep the last values until the
+            # rescan
+            return
+        self.snapshot.update()
+        # timer.checkpoint("snapshot update")
+
+        self.worker_stats.load_buffer(self.worker_ids, self.snapshot.workers)
+        self.device_stats.load_buffer(self.device_ids, self.snapshot.devices)
+        self.queue_stats.load_buffer(self.queue_ids, self.snapshot.queues)
+        # timer.checkpoint("stores load")
+
+        self.cycles.update(self.vhost.vhost, None)
+        self.work_cycles.update(self.vhost.vhost, self.worker_stats)
+        self.softirq_interference.update(self.vhost.vhost, self.worker_stats)
         # timer.checkpoint("misc")
 
         for c in self.per_worker_counters.values():
-            c.update(self.vhost.vhost, self.workers.values())
+            c.update(self.vhost.vhost, self.worker_stats)
         # timer.checkpoint("per_worker_counters")
         for c in self.per_queue_counters.values():
-            c.update(self.vhost.vhost, self.queues.values())
+            c.update(self.vhost.vhost, self.queue_stats)
         # timer.checkpoint("per_queue_counters")
         # timer.done()
 
+    def _stores(self):
+        return self.worker_stats, self.device_stats, self.queue_stats
+
+    def _counters(self):
+        return [self.cycles, self.work_cycles, self.softirq_interference] + \
+            self.per_worker_counters.values() + \
+            self.per_queue_counters.values()
+
+    def baseline(self):
+        """
+        :return: the state of the stores and the counters at the last
+        update, so a consumer that runs every few updates sees the deltas
+        since its previous run (see rebase)
+        """
+        return ([(store, store.baseline()) for store in self._stores()],
+                [(c, self.vhost.vhost[c.total]) for c in self._counters()])
+
+    def rebase(self, baseline):
+        """
+        Makes the deltas of the stores and the counters relative to a
+        baseline instead of the previous update, until restore.
+        :return: the state restore needs
+        """
+        stores, counters = baseline
+        return ([(store, store.rebase(b)) for store, b in stores],
+                [(c, c.rebase(self.vhost.vhost, total))
+                 for c, total in counters])
+
+    def restore(self, state):
+        """
+        Makes the deltas relative to the previous update again.
+        """
+        stores, counters = state
+        for store, store_state in stores:
+            store.restore(store_state)
+        for c, counter_state in counters:
+            c.restore(counter_state)
+
+    def queue_totals_by_device(self, field, deltas=True):
+        """
+        :return: a dictionary of device id -> the sum of a virtual queue
+        counter over the device queues
+        """
+        queues = self.vhost.queues
+        group_of = {vq_id: queues[vq_id]["dev"]
+                    for vq_id in self.queue_stats.ids if vq_id in queues}
+        return self.queue_stats.group_totals(field, group_of, deltas)
+
+    def queue_totals_by_worker(self, field, deltas=True):
+        """
+        :return: a dictionary of worker id -> the sum of a virtual queue
+        counter over the queues of the devices the worker serves
+        """
+        devices = self.vhost.devices
+        totals = {}
+        for dev_id, value in \
+                self.queue_totals_by_device(field, deltas).items():
+            if dev_id not in devices:
+                continue
+            w_id = devices[dev_id]["worker"]
+            totals[w_id] = totals.get(w_id, 0) + value
+        return totals
+
 
 class VhostCounterBase:
     def __init__(self, name, element_name=None):
@@ -150,6 +348,8 @@ class VhostCounterBase:
 
         self.last_value = 0
         self.delta = 0
+        # the number of updates, to tell if a rebased counter was updated
+        self.updates = 0
 
     def initialize(self, vhost, initial_value=0):
         Cycles.initialize()
@@ -160,87 +360,101 @@ class VhostCounterBase:
         vhost[self.total] = total
 
         self.delta = total - last_epoch
+        self.updates += 1
         return self.delta
 
+    def rebase(self, vhost, baseline_total):
+        """
+        :return: the state restore needs
+        """
+        state = self.updates, self.delta
+        self.delta = vhost[self.total] - baseline_total
+        return state
+
+    def restore(self, state):
+        """
+        Undoes a rebase, unless the counter was updated since.
+        """
+        updates, delta = state
+        if self.updates == updates:
+            self.delta = delta
+
 
 class VhostCyclesCounter(VhostCounterBase):
     def __init__(self, name, element_name=None):
         VhostCounterBase.__init__(self, name, element_name)
 
-    def update(self, vhost, elements):
+    def update(self, vhost, store):
         return VhostCounterBase.update(self, vhost, Cycles.get_cycles())
 
 
-class VhostWorkCyclesCounter(VhostCounterBase):
-    def __init__(self, name):
-        VhostCounterBase.__init__(self, name, "total_work_cycles")
+class VhostSumCounter(VhostCounterBase):
+    """
+    A counter that sums a single column of a CounterStore.
+    """
+    def __init__(self, name, element_name):
+        VhostCounterBase.__init__(self, name, element_name)
 
-    def update(self, vhost, elements):
-        total = sum(e.total_work_cycles for e in elements)
-        return VhostCounterBase.update(self, vhost, total)
+    def update(self, vhost, store):
+        return VhostCounterBase.update(self, vhost,
+                                       store.total(self.element_name))
 
 
-class VhostSoftirqInterferenceCounter(VhostCounterBase):
+class VhostWorkCyclesCounter(VhostSumCounter):
     def __init__(self, name):
-        VhostCounterBase.__init__(self, name, "ksoftirqs")
+        VhostSumCounter.__init__(self, name, "total_work_cycles")
+
 
-    def update(self, vhost, elements):
-        total = sum(e.ksoftirqs for e in elements)
-        return VhostCounterBase.update(self, vhost, total)
+class VhostSoftirqInterferenceCounter(VhostSumCounter):
+    def __init__(self, name):
+        VhostSumCounter.__init__(self, name, "ksoftirqs")
 
 
 class VhostCPUUsageCounter(VhostCounterBase):
     def __init__(self, name):
         VhostCounterBase.__init__(self, name, "cpu_usage_counter")
+        # pid -> ProcessCPUUsageCounterRaw
         self.workers_cpu_usage = {}
+        # the cpu usage of the workers since the counter was created, a
+        # worker only adds the usage it had since it was added
+        self.accumulated = 0
 
     def update_workers(self, workers):
-        self.workers_cpu_usage = {
-            ProcessCPUUsageCounterRaw(w["pid"]) for w in workers
-        }
-        for c in self.workers_cpu_usage:
-            c.update()
-
-    def update(self, vhost, elements):
-        for c in self.workers_cpu_usage:
-            c.update()
+        """
+        Keeps the counters of the workers that are still there and creates
+        counters for the new workers only.
+        """
+        pids = set(w["pid"] for w in workers)
+        for pid in self.workers_cpu_usage.keys():
+            if pid not in pids:
+                del self.workers_cpu_usage[pid]
+        for pid in pids:
+            if pid not in self.workers_cpu_usage:
+                self.workers_cpu_usage[pid] = ProcessCPUUsageCounterRaw(pid)
+
+    def update(self, vhost, store):
+        for c in self.workers_cpu_usage.values():
+            self.accumulated += c.update()
             # logging.info("%d: current: %d  delta: %d" %
             #              (c.pid, c.current, c.delta))
-        total = sum(c.current for c in self.workers_cpu_usage)
-        return VhostCounterBase.update(self, vhost, total)
+        return VhostCounterBase.update(self, vhost, self.accumulated)
 
 
-class VhostPolledBytesCounter(VhostCounterBase):
+class VhostPolledBytesCounter(VhostSumCounter):
     def __init__(self, name):
-        VhostCounterBase.__init__(self, name, "poll_bytes")
-
-    def update(self, vhost, elements):
-        total = sum(e.poll_bytes for e in elements)
-        return VhostCounterBase.update(self, vhost, total)
+        VhostSumCounter.__init__(self, name, "poll_bytes")
 
 
-class VhostNotifBytesCounter(VhostCounterBase):
+class VhostNotifBytesCounter(VhostSumCounter):
     def __init__(self, name):
-        VhostCounterBase.__init__(self, name, "notif_bytes")
+        VhostSumCounter.__init__(self, name, "notif_bytes")
 
-    def update(self, vhost, elements):
-        total = sum(e.notif_bytes for e in elements)
-        return VhostCounterBase.update(self, vhost, total)
 
-
-class VhostHandledBytesCounter(VhostCounterBase):
+class VhostHandledBytesCounter(VhostSumCounter):
     def __init__(self, name):
-        VhostCounterBase.__init__(self, name, "handled_bytes")
-
-    def update(self, vhost, elements):
-        total = sum(e.handled_bytes for e in elements)
-        return VhostCounterBase.update(self, vhost, total)
+        VhostSumCounter.__init__(self, name, "handled_bytes")
 
 
-class VhostHandledPacketsCounter(VhostCounterBase):
+class VhostHandledPacketsCounter(VhostSumCounter):
     def __init__(self, name):
-        VhostCounterBase.__init__(self, name, "handled_packets")
-
-    def update(self, vhost, elements):
-        total = sum(e.handled_packets for e in elements)
-        return VhostCounterBase.update(self, vhost, total)
+        VhostSumCounter.__init__(self, name, "handled_packets")
@@ -1,33 +1,166 @@
 #!/usr/bin/python
 
+import os
+import re
 import logging
 
 from affinity_entity import Thread, parse_cpu_mask_from_cpu_list
 from device import Device
+from utils.sched_affinity import AffinityEngine
+
+# the name QEMU gives its vCPU threads
+VCPU_COMM_REGEX = re.compile(r"^CPU (\d+)/KVM$")
+
+
+def discover_threads(pid):
+    """
+    Splits the threads of a QEMU process by their /proc/<pid>/task/*/comm.
+    :return: a dictionary of vCPU index -> thread id, and a list of the ids of
+    the other (emulator and IO) threads
+    """
+    vcpus = {}
+    others = []
+    task_path = "/proc/%d/task" % (pid,)
+    for tid in os.listdir(task_path):
+        try:
+            with open(os.path.join(task_path, tid, "comm"), "r") as f:
+                comm = f.read().strip()
+        except IOError:
+            # the thread exited
+            continue
+        r = VCPU_COMM_REGEX.match(comm)
+        if r:
+            vcpus[int(r.group(1))] = int(tid)
+        else:
+            others.append(int(tid))
+    return vcpus, others
+
+
+class VCPU(Thread):
+    """
+    A vCPU thread of a VM, pinned to a single core of the VM.
+    """
+    def __init__(self, vm_pid, tid, index, cpu_mask=0):
+        Thread.__init__(self, tid, index, cpu_mask)
+        self.vm_pid = vm_pid
+
+    def apply_cpu_mask(self):
+        return AffinityEngine.INSTANCE.set_thread_affinity(self.vm_pid,
+                                                           self.pid,
+                                                           self.cpu_mask)
+
+    def __str__(self):
+        return "vCPU %d: tid: %d, cpus: %s" % \
+               (self.idx, self.pid, self.cpu_set)
 
 
 class VM(Thread):
+    """
+    A VM process. The vCPU threads are pinned 1:1 to the cores of the VM
+    (round robin when there are more vCPUs than cores), and the other
+    threads of the process (emulator and IO threads) may run on all the
+    cores of the VM, so none of them runs on an IO core. When a core is
+    removed only the vCPUs that were pinned to it migrate, to the cores
+    with the fewest vCPUs. A process without vCPU threads gets the VM mask
+    on all its threads.
+    """
     def __init__(self, vm_info, backing_devices):
+        # the vCPU threads, ordered by their index
+        self.vcpus = []
+        self.emulator_threads = []
         Thread.__init__(self, int(vm_info["pid"]), vm_info["id"],
                         parse_cpu_mask_from_cpu_list(vm_info["cpu"]))
         self.devices = [Device(self, dev_info, backing_devices)
                         for dev_info in vm_info["devices"]]
+        self.discover_threads()
+
+    def discover_threads(self):
+        """
+        Finds the vCPU threads and the other threads of the process, the
+        vCPUs that were found before keep their cores.
+        """
+        try:
+            vcpu_tids, self.emulator_threads = discover_threads(self.pid)
+        except OSError as e:
+            logging.warning("VM %s: failed to list the threads of %d: %s" %
+                            (self.idx, self.pid, e))
+            return
+        known = {vcpu.idx: vcpu for vcpu in self.vcpus}
+        self.vcpus = []
+        for index, tid in sorted(vcpu_tids.items()):
+            vcpu = known.get(index)
+            if vcpu is None or vcpu.pid != tid:
+                vcpu = VCPU(self.pid, tid, index)
+            self.vcpus.append(vcpu)
+
+    def _place_vcpus(self):
+        """
+        Pins the vCPUs that are not pinned to a core of the VM to the cores
+        with the fewest vCPUs, the rest stay where they are.
+        """
+        cpus = self.cpu_list
+        if not cpus:
+            return
+        load = {cpu: 0 for cpu in cpus}
+        placed = {cpu: [] for cpu in cpus}
+        unplaced = []
+        for vcpu in self.vcpus:
+            cpu = vcpu.first_cpu() if len(vcpu) == 1 else None
+            if cpu in load:
+                load[cpu] += 1
+                placed[cpu].append(vcpu)
+            else:
+                unplaced.append(vcpu)
+
+        for vcpu in unplaced:
+            cpu = min(cpus, key=lambda c: (load[c], c))
+            load[cpu] += 1
+            placed[cpu].append(vcpu)
+            vcpu.set_cpu_mask(cpu_sequence=[cpu])
+
+        # a core without vCPUs (e.g. a new core) takes a vCPU from the most
+        # crowded core
+        for cpu in cpus:
+            if load[cpu] > 0:
+                continue
+            crowded = max(cpus, key=lambda c: load[c])
+            if load[crowded] <= 1:
+                break
+            vcpu = placed[crowded].pop()
+            load[crowded] -= 1
+            load[cpu] += 1
+            vcpu.set_cpu_mask(cpu_sequence=[cpu])
+
+    def apply_cpu_mask(self):
+        self.discover_threads()
+        if not self.vcpus:
+            Thread.apply_cpu_mask(self)
+            return
+
+        self._place_vcpus()
+        moved = [vcpu for vcpu in self.vcpus if vcpu.apply_cpu_mask()]
+        engine = AffinityEngine.INSTANCE
+        for tid in self.emulator_threads:
+            engine.set_thread_affinity(self.pid, tid, self.cpu_mask)
+        if moved:
+            logging.info("VM %s: pinned %s" %
+                         (self.idx, ", ".join(str(v) for v in moved)))
 
     def remove_core(self, cpu_id):
         Thread.remove_cpu(self, cpu_id)
-        Thread.apply_cpu_mask(self)
+        self.apply_cpu_mask()
 
     def add_core(self, cpu_id):
         Thread.add_cpu(self, cpu_id)
-        Thread.apply_cpu_mask(self)
+        self.apply_cpu_mask()
 
     def set_cpu_mask(self, cpu_mask=None, cpu_sequence=None):
         Thread.set_cpu_mask(self, cpu_mask=cpu_mask, cpu_sequence=cpu_sequence)
-        Thread.apply_cpu_mask(self)
+        self.apply_cpu_mask()
 
     def __str__(self):
-        return "VM: {pid: %d, id: %s, cpu_mask: %x}" % \
-               (self.pid, self.idx, self.cpu_mask)
+        return "VM: {pid: %d, id: %s, cpus: %s, vcpus: %d}" % \
+               (self.pid, self.idx, self.cpu_set, len(self.vcpus))
 
     def __repr__(self):
         return "%s(%s)" % (self.__class__, self.__str__())
@@ -0,0 +1,189 @@
+import logging
+
+from utils.vhost import Vhost
+from utils.cpuusage import USER_HZ
+from utils.sysfs_reader import SysfsReader
+from utils.tick_scheduler import monotonic
+
+__author__ = 'eyalmo'
+
+DEFAULT_SMOOTHING = 0.5
+# the share of the IO cores a VM may take over its fair share
+DEFAULT_TOLERANCE = 0.2
+# the IO cores load, without the excess of the VMs over their fair share,
+# that justifies another IO core
+DEFAULT_SATURATION = 0.9
+
+
+class VMAccount:
+    """
+    The resources a single VM used since the last update, in cores: the
+    time of its vCPU threads and the IO core cycles spent on the virtual
+    queues of its devices, and the bytes its devices handled.
+    """
+    def __init__(self, vm, weight=1.0):
+        self.vm = vm
+        self.weight = weight
+        self.last_vcpu_jiffies = None
+
+        # smoothed, in cores
+        self.vcpu_share = 0.0
+        self.io_share = 0.0
+        # smoothed, in bytes per cycle
+        self.handled_bytes = 0.0
+        # the share of the IO cores the VM is entitled to, in cores
+        self.fair_share = 0.0
+
+    @property
+    def total_share(self):
+        return self.vcpu_share + self.io_share
+
+    @property
+    def fairness(self):
+        """
+        :return: the IO share of the VM relative to its fair share, above 1
+        the VM takes more than its fair share
+        """
+        if self.fair_share <= 0:
+            return 0.0 if self.io_share <= 0 else float("inf")
+        return self.io_share / self.fair_share
+
+    def __str__(self):
+        return "VM %s: weight: %.2f, vcpus: %.2f, io: %.2f/%.2f cores, " \
+               "handled bytes: %.2f per cycle" % \
+               (self.vm.idx, self.weight, self.vcpu_share, self.io_share,
+                self.fair_share, self.handled_bytes)
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__, self.__str__())
+
+
+class VMAccounting:
+    """
+    Accounts the CPU and IO usage of every VM: the vCPU time of its vCPU
+    threads (from /proc/<pid>/task/<tid>/stat, or the whole process when the
+    vCPU threads are not known), and the poll and notification cycles and
+    handled bytes of the virtual queues of its devices. The IO cores are
+    divided between the VMs by their weights, so a VM that takes more than
+    its fair share (plus a tolerance) does not justify more IO cores.
+    """
+    def __init__(self, vms, vms_info, fairness_info=None):
+        """
+        :param vms: the VM objects
+        :param vms_info: the VMs configuration, with an optional "weight"
+        :param fairness_info: the fairness settings: "smoothing", "tolerance"
+        and "saturation"
+        """
+        fairness_info = fairness_info or {}
+        self.smoothing = float(fairness_info.get("smoothing",
+                                                 DEFAULT_SMOOTHING))
+        self.tolerance = float(fairness_info.get("tolerance",
+                                                 DEFAULT_TOLERANCE))
+        self.saturation = float(fairness_info.get("saturation",
+                                                  DEFAULT_SATURATION))
+
+        weights = {vm_info["id"]: float(vm_info.get("weight", 1.0))
+                   for vm_info in vms_info}
+        self.accounts = {vm.idx: VMAccount(vm, weights.get(vm.idx, 1.0))
+                         for vm in vms}
+        # device id -> VM id
+        self.vm_of = {dev.id: vm.idx for vm in vms for dev in vm.devices}
+        self.reader = SysfsReader()
+        self.last_time = None
+
+    def _read_jiffies(self, path):
+        """
+        :return: utime + stime of a /proc stat file
+        """
+        stat = self.reader.read_file(path)
+        # the command may contain spaces, the fields start after it
+        fields = stat[stat.rfind(")") + 2:].split()
+        return int(fields[11]) + int(fields[12])
+
+    def _vcpu_jiffies(self, vm):
+        if not vm.vcpus:
+            return self._read_jiffies("/proc/%d/stat" % (vm.pid,))
+        return sum(self._read_jiffies("/proc/%d/task/%d/stat" %
+                                      (vm.pid, vcpu.pid))
+                   for vcpu in vm.vcpus)
+
+    def _smooth(self, old, new):
+        return self.smoothing * new + (1 - self.smoothing) * old
+
+    def update(self):
+        now = monotonic()
+        last_time, self.last_time = self.last_time, now
+        elapsed = now - last_time if last_time is not None else None
+
+        light = Vhost.INSTANCE.vhost_light
+        cycles = float(light.cycles.delta)
+        io_cycles = {}
+        handled_bytes = {}
+        for field, totals in \
+                (("poll_cycles", io_cycles), ("notif_cycles", io_cycles),
+                 ("handled_bytes", handled_bytes)):
+            for dev_id, value in \
+                    light.queue_totals_by_device(field).items():
+                vm_id = self.vm_of.get(dev_id)
+                if vm_id is not None:
+                    totals[vm_id] = totals.get(vm_id, 0) + value
+
+        for vm_id, account in self.accounts.items():
+            try:
+                jiffies = self._vcpu_jiffies(account.vm)
+            except (IOError, OSError, IndexError, ValueError) as e:
+                logging.warning("VM %s: failed to read the vCPU time: %s" %
+                                (vm_id, e))
+                jiffies = None
+            last_jiffies, account.last_vcpu_jiffies = \
+                account.last_vcpu_jiffies, jiffies
+            if elapsed and jiffies is not None and last_jiffies is not None:
+                account.vcpu_share = self._smooth(
+                    account.vcpu_share,
+                    float(jiffies - last_jiffies) / USER_HZ / elapsed)
+            if cycles > 0:
+                account.io_share = self._smooth(
+                    account.io_share, io_cycles.get(vm_id, 0) / cycles)
+                account.handled_bytes = self._smooth(
+                    account.handled_bytes, handled_bytes.get(vm_id, 0) / cycles)
+
+    def update_fair_shares(self, io_cores):
+        """
+        Divides the IO cores between the VMs by their weights.
+        """
+        total_weight = sum(a.weight for a in self.accounts.values())
+        for account in self.accounts.values():
+            account.fair_share = io_cores * account.weight / total_weight \
+                if total_weight > 0 else 0.0
+
+    def noisy_vms(self):
+        """
+        :return: the accounts of the VMs above their fair share of the IO
+        cores and the tolerance
+        """
+        return [a for a in self.accounts.values()
+                if a.fairness > 1 + self.tolerance]
+
+    def should_veto_addition(self, io_cores):
+        """
+        An IO core addition is unfair when the IO cores would not be
+        saturated without the excess of the VMs over their fair share.
+        :param io_cores: the current number of IO cores
+        :return: True if another IO core would only serve noisy VMs
+        """
+        self.update_fair_shares(io_cores)
+        noisy = self.noisy_vms()
+        if not noisy or io_cores == 0:
+            return False
+        fair_load = sum(min(a.io_share, a.fair_share * (1 + self.tolerance))
+                        for a in self.accounts.values())
+        if fair_load >= io_cores * self.saturation:
+            return False
+        logging.info("\x1b[33mVM fairness: no IO core for %s, the other VMs "
+                     "use %.2f of %d IO cores\x1b[39m" %
+                     (", ".join(str(a) for a in noisy), fair_load, io_cores))
+        return True
+
+    def log(self):
+        for account in sorted(self.accounts.values(), key=lambda a: a.vm.idx):
+            logging.info(str(account))
@@ -0,0 +1,92 @@
+import logging
+
+from utils.vhost import Vhost, vhost_write, vhost_worker_create, \
+    vhost_worker_set_cpu_mask, get_cpu_usage
+from utils.cpu_set import CPUSet
+
+__author__ = 'eyalmo'
+
+
+class WorkerPool:
+    """
+    A pool of pre-created vhost workers, so adding an IO core does not wait
+    for the creation of a kernel worker. A parked worker is locked (no
+    device is attached to it), runs on all the online cpus, is not in
+    Vhost.workers and its raw stats object is kept out of the snapshot of
+    VhostLight, ready to be added back.
+
+    Taking a worker unlocks it and pins it to its IO core, giving one back
+    locks it and parks it again instead of removing it. The pool is filled
+    outside of the critical path (fill).
+    """
+    def __init__(self, size=0):
+        """
+        :param size: the number of parked workers to keep, 0 disables the
+        pool
+        """
+        self.size = size
+        # worker id -> the worker dictionary
+        self.parked = {}
+
+    def __len__(self):
+        return len(self.parked)
+
+    def _park(self, worker):
+        vhost = Vhost.INSTANCE
+        vhost_write(worker, "locked", 1)
+        worker["locked"] = 1
+        vhost_worker_set_cpu_mask(worker, CPUSet.online().mask)
+        self.parked[worker["id"]] = worker
+        vhost.parked_workers[worker["id"]] = worker
+        vhost.vhost_light.park_worker(worker["id"])
+
+    def fill(self, max_new=1):
+        """
+        Creates workers until the pool is full.
+        :param max_new: the maximum number of workers to create in this call,
+        None for no limit
+        :return: the number of workers created
+        """
+        vhost = Vhost.INSTANCE
+        created = 0
+        while len(self.parked) < self.size and \
+                (max_new is None or created < max_new):
+            worker_id = vhost_worker_create(vhost)
+            vhost.update_all_entries_with_id(worker_id)
+            worker = vhost.workers.pop(worker_id)
+            worker["cpu_usage_counter"] = get_cpu_usage(worker["pid"])
+            self._park(worker)
+            created += 1
+            logging.info("worker pool: parked a new worker %s" % (worker_id,))
+        return created
+
+    def take(self, cpu_id):
+        """
+        Unparks a worker and pins it to a cpu.
+        :return: the worker id, None if the pool is empty
+        """
+        if not self.parked:
+            return None
+        vhost = Vhost.INSTANCE
+        worker_id, worker = self.parked.popitem()
+        del vhost.parked_workers[worker_id]
+
+        vhost_worker_set_cpu_mask(worker, 1 << cpu_id)
+        worker["cpu"] = cpu_id
+        vhost_write(worker, "locked", 0)
+        worker["locked"] = 0
+        vhost.workers[worker_id] = worker
+        vhost.vhost_light.unpark_worker(worker_id)
+        return worker_id
+
+    def give(self, worker):
+        """
+        Parks a worker that no longer serves devices, if the pool is not
+        full. The worker must already be out of Vhost.workers.
+        :return: True if the worker was parked, False if the caller should
+        remove it
+        """
+        if len(self.parked) >= self.size:
+            return False
+        self._park(worker)
+        return True
@@ -1,14 +1,20 @@
 import logging
 
 from algos.throughput_policy import VMCoreAdditionPolicy
+from algos.removal_policy import ScoredRemovalPolicy
 from utils.vm import VM
-from utils.vhost_light import ProcessCPUUsageCounterRaw
+from utils.cpuusage import CPUUsage
+from utils.topology import Topology
+from utils.vm_accounting import VMAccounting
 
 
 class VMManager:
     def __init__(self, vms_info, backing_devices, vm_policy,
-                 vm_core_addition_policy, vm_balance_policy):
+                 vm_core_addition_policy, vm_balance_policy, io_nodes=None,
+                 fairness_info=None):
         self.vms = [VM(vm_info, backing_devices) for vm_info in vms_info]
+        # the per VM accounting of the vCPU time and the IO cores
+        self.accounting = VMAccounting(self.vms, vms_info, fairness_info)
         self.cpus = VMCoreAdditionPolicy.get_initial_cpus(vms_info)
         # logging.info(self.vms)
         self.backing_devices = backing_devices
@@ -16,15 +22,11 @@ class VMManager:
         self.vm_policy = vm_policy
         self.vm_core_addition_policy = vm_core_addition_policy
         self.vm_balance_policy = vm_balance_policy
-
-        # self.vms_cpu_usage = [ProcessCPUUsageCounterRaw(vm.pid)
-        #                       for vm in self.vms]
+        # the NUMA nodes of the NICs, IO cores are taken from them first
+        self.io_nodes = io_nodes
 
     def update(self):
-        pass
-        # for idx, c in enumerate(self.vms_cpu_usage):
-        #     c.update()
-        #     # logging.info("vm %s: %s" % (self.vms[idx].idx, str(c)))
+        self.accounting.update()
 
     def should_update_core_number(self):
         return self.vm_core_addition_policy.should_update_core_number()
@@ -32,7 +34,7 @@ class VMManager:
     def remove_cores(self, number=1):
         logging.info("\x1b[33mVM Manager: remove %d VM cores\x1b[39m" %
                      (number,))
-        removed_cpus = self.vm_policy.remove(number=number)
+        removed_cpus = self._choose_io_cores(number)
         self.vm_core_addition_policy.remove(removed_cpus)
         logging.info("removed_cpus = %s" % (str(removed_cpus),))
         self.vm_balance_policy.balance_before_removal(self.vms, removed_cpus)
@@ -40,6 +42,34 @@ class VMManager:
             del self.cpus[self.cpus.index(cpu_id)]
         return removed_cpus
 
+    def _choose_io_cores(self, number):
+        """
+        Removes from the VM policy the cpus that should become IO cores: the
+        cheapest by the score of a ScoredRemovalPolicy, otherwise the policy
+        order, on the NIC NUMA nodes first and away from the SMT siblings of
+        busy vCPUs.
+        """
+        if isinstance(self.vm_policy, ScoredRemovalPolicy):
+            chosen = self.vm_policy.remove(number)
+            if len(chosen) < number:
+                logging.error("VM Manager: trying to remove more CPUs then "
+                              "available. requested: %d" % (number,))
+            return chosen
+
+        # the policy pops its cpus from the end
+        candidates = list(reversed(self.vm_policy.cpus))
+        cpu_usage = CPUUsage.INSTANCE
+        cpu_load = {cpu_id: cpu_usage.projected.get(cpu_id, 0.0)
+                    if cpu_usage else 1.0 for cpu_id in candidates}
+        chosen = Topology.INSTANCE.rank_io_cores(candidates, number,
+                                                 io_nodes=self.io_nodes,
+                                                 cpu_load=cpu_load)
+        if len(chosen) < number:
+            logging.error("VM Manager: trying to remove more CPUs then "
+                          "available. has %s requested: %d" %
+                          (candidates, number))
+        return self.vm_policy.remove_cpus(chosen)
+
     def add_core(self, cpu_id):
         logging.info("\x1b[33mVM Manager: add a VM core on core %s.\x1b["
                      "39m" % (cpu_id, ))